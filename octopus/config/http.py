@@ -12,6 +12,27 @@ HTTP_MAX_BACK_OFF = 30
 # maximum amount of time to wait for an ack from the server on an HTTP request
 HTTP_TIMEOUT = 30
 
+# should requests be sent over a shared, keep-alive connection pool (one per host)?  If False, every
+# request opens (and handshakes) a new connection
+HTTP_POOL_CONNECTIONS = True
+
+# maximum number of connections to keep open to any single host.  Should be at least the number of
+# threads which will talk to the same host concurrently
+HTTP_POOL_SIZE = 10
+
+# when all the pooled connections to a host are in use, should further requests wait for one to
+# become free (True), or open an extra, non-pooled connection (False)
+HTTP_POOL_BLOCK = False
+
+# maximum number of requests to have in flight at once when making many requests concurrently (e.g. through
+# octopus.lib.http.map_concurrent, or the *_many methods on the service clients)
+HTTP_MAX_CONCURRENCY = 10
+
+# per-host rate limits, in requests per second, which are applied to every request (including each retry)
+# made to that host, across all threads. Hosts which are not listed are not rate limited. e.g.
+# {"www.ebi.ac.uk" : 10, "doaj.org" : 5}
+HTTP_RATE_LIMITS = {}
+
 # should we try again if we receive a timeout from the server?
 HTTP_RETRY_ON_TIMEOUT = True
 
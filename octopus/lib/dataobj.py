@@ -1,6 +1,6 @@
-from octopus.lib import dates, coerce as coerce_lib
+from octopus.lib import dates, plugin, coerce as coerce_lib
 from copy import deepcopy
-import locale, json, urlparse
+import locale, json, urlparse, multiprocessing, cPickle, re, keyword
 from datetime import date, datetime
 
 #########################################################
@@ -168,6 +168,144 @@ def to_bool(val):
 class DataSchemaException(Exception):
     pass
 
+# returned by the value checks when the value should not be set at all
+_SKIP = object()
+
+def _default_json_encoder():
+    # ujson is several times faster than the standard library's encoder, so use it if it is installed
+    fn = plugin.load_function_raw("ujson.dumps")
+    return fn if fn is not None else json.dumps
+
+_json_encoder = _default_json_encoder()
+
+def set_json_encoder(fn=None):
+    """
+    Set the function which DataObj.json() uses to serialise the data.  It must take the data and return a
+    string, as json.dumps does.  None goes back to the default: ujson if it is installed, otherwise json.dumps
+    """
+    global _json_encoder
+    _json_encoder = fn if fn is not None else _default_json_encoder()
+
+def _lost_keys(before, after):
+    # whether anything in the dict before is missing from after, which a partial update can't express
+    if not isinstance(before, dict):
+        return False
+    if not isinstance(after, dict):
+        return True
+    for k, v in before.iteritems():
+        if k not in after or _lost_keys(v, after[k]):
+            return True
+    return False
+
+# stands in for the copy of a dict or list handed out by an object which doesn't track changes (see TRACK_CHANGES)
+_UNTRACKED = object()
+
+class _TrustedData(dict):
+    """
+    Raw data which has already been constructed against the struct (e.g. by a construct_many worker, or
+    by the object being cloned), so that the DataObj it is given to need not construct it again.  The
+    trust goes with the data itself, so no other DataObj created along the way is affected
+    """
+    pass
+
+def _construct_one(cls, raw, kwargs, trusted=False):
+    try:
+        return cls(raw=_TrustedData(raw) if trusted else raw, **kwargs), None
+    except Exception as e:
+        return None, e
+
+def _construct_data(args):
+    # runs in a worker process, so only hand back things which are safe to pickle
+    cls, raw, kwargs = args
+    obj, error = _construct_one(cls, raw, kwargs)
+    if error is not None:
+        try:
+            cPickle.loads(cPickle.dumps(error))
+        except Exception:
+            error = DataStructureException(u"{t}: {m}".format(t=error.__class__.__name__, m=error))
+        return None, error
+    return obj.data, None
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def _get_path(context, path, default):
+    parts = path.split(".")
+
+    for i in range(len(parts)):
+        p = parts[i]
+        d = {} if i < len(parts) - 1 else default
+        context = context.get(p, d)
+    return context
+
+def _set_path(context, path, val):
+    parts = path.split(".")
+
+    for i in range(len(parts)):
+        p = parts[i]
+
+        if p not in context and i < len(parts) - 1:
+            context[p] = {}
+            context = context[p]
+        elif p in context and i < len(parts) - 1:
+            context = context[p]
+        else:
+            context[p] = val
+
+def _coerce(val, cast, accept_failure=False):
+    if cast is None:
+        return val
+    try:
+        return cast(val)
+    except (ValueError, TypeError):
+        if accept_failure:
+            return val
+        raise DataSchemaException(u"Cast with {x} failed on {y}".format(x=cast, y=val))
+
+def _check_single(path, val, coerce=None, allow_coerce_failure=False, allowed_values=None, allowed_range=None,
+                  allow_none=True, ignore_none=False):
+    if val is None and ignore_none:
+        return _SKIP
+
+    if val is None and not allow_none:
+        raise DataSchemaException(u"NoneType is not allowed at {x}".format(x=path))
+
+    # first see if we need to coerce the value (and don't coerce None)
+    if coerce is not None and val is not None:
+        val = _coerce(val, coerce, accept_failure=allow_coerce_failure)
+
+    if allowed_values is not None and val not in allowed_values:
+        raise DataSchemaException(u"Value {x} is not permitted at {y}".format(x=val, y=path))
+
+    if allowed_range is not None:
+        lower, upper = allowed_range
+        if (lower is not None and val < lower) or (upper is not None and val > upper):
+            raise DataSchemaException("Value {x} is outside the allowed range: {l} - {u}".format(x=val, l=lower, u=upper))
+
+    return val
+
+def _check_list_entry(path, val, coerce=None, allow_coerce_failure=False, allow_none=False, ignore_none=True, unique=False):
+    # unique is accepted so that the same kwargs can be passed as to _add_to_list, but
+    # it is up to the caller to enforce it
+    if val is None and ignore_none:
+        return _SKIP
+
+    if val is None and not allow_none:
+        raise DataSchemaException(u"NoneType is not allowed in list at {x}".format(x=path))
+
+    # first coerce the value
+    if coerce is not None:
+        val = _coerce(val, coerce, accept_failure=allow_coerce_failure)
+
+    return val
+
 class DataObj(object):
     """
     Class which provides services to other classes which store their internal data
@@ -176,6 +314,13 @@ class DataObj(object):
 
     SCHEMA = None
 
+    # whether to construct the objects and lists in the struct only when they are first accessed (see __init__)
+    CONSTRUCT_LAZY = False
+
+    # whether to copy the lists and objects handed out by reference, so that dirty_paths() can tell whether they have
+    # really been changed.  Without it they count as changed from when they are handed out (see dirty_paths)
+    TRACK_CHANGES = False
+
     DEFAULT_COERCE = {
         "unicode": to_unicode(),
         "utcdatetime": date_str(),
@@ -189,10 +334,21 @@ class DataObj(object):
         "currency_code" : coerce_lib.to_currency_code
     }
 
-    def __init__(self, raw=None, struct=None, construct_raw=True, expose_data=False, properties=None, coerce_map=None, construct_silent_prune=False, *args, **kwargs):
+    def __init__(self, raw=None, struct=None, construct_raw=True, expose_data=False, properties=None, coerce_map=None, construct_silent_prune=False, construct_lazy=None, *args, **kwargs):
+        """
+        If construct_lazy is True (or CONSTRUCT_LAZY is set on the class), only the top level of the raw data is
+        checked and coerced against the struct when the object is created.  Each of the objects and lists is
+        constructed the first time it is accessed through the object's properties or getters and setters, and
+        validate_all() constructs them all.  Until then, reading self.data directly gives the raw values for them.
+        """
         # make a shortcut to the object.__getattribute__ function
         og = object.__getattribute__
 
+        # if the raw data has already been constructed elsewhere (e.g. by a construct_many worker) don't do it again
+        if isinstance(raw, _TrustedData):
+            raw = dict(raw)
+            construct_raw = False
+
         # if no subclass has set the coerce, then set it from default
         try:
             og(self, "_coerce_map")
@@ -231,7 +387,15 @@ class DataObj(object):
 
         # restructure the object based on the struct if requried
         if self._struct is not None and raw is not None and construct_raw:
-            self.data = construct(self.data, self._struct, self._coerce_map, silent_prune=construct_silent_prune)
+            constructor = self._accessor_plan().constructor
+            if construct_lazy is None:
+                construct_lazy = self.CONSTRUCT_LAZY
+            if construct_lazy:
+                self.data, pending = constructor.construct_lazy(self.data, silent_prune=construct_silent_prune)
+                if len(pending) > 0:
+                    object.__setattr__(self, "_lazy_pending", (pending, construct_silent_prune))
+            else:
+                self.data = constructor.construct(self.data, silent_prune=construct_silent_prune)
 
         # run against the old validation routine
         # (now deprecated)
@@ -243,26 +407,23 @@ class DataObj(object):
         # finally, kick the request up
         super(DataObj, self).__init__(*args, **kwargs)
 
+        # anything changed from here on is a change to the data as it was loaded
+        object.__setattr__(self, "_dirty", set())
+
     def __getattr__(self, name):
         if hasattr(self.__class__, name):
             return object.__getattribute__(self, name)
 
-        props, data_attrs = self._list_dynamic_properties()
+        # find the precompiled accessor for the name, if there is one
+        accessor = self._dynamic_accessor(name)
 
         # if the name is not in the dynamic properties, raise an attribute error
-        if name not in props and name not in data_attrs:
+        if accessor is None:
             raise AttributeError('{name} is not set'.format(name=name))
 
-        # otherwise, extract the path from the properties list or the internal data
-        if name in props:
-            path, wrapper = self._properties.get(name)
-        else:
-            path = name
-            wrapper = DataObj
-
         # request the internal property directly (which will in-turn raise the AttributeError if necessary)
         try:
-            return self._get_internal_property(path, wrapper)
+            return accessor.get(self)
         except AttributeError:
             # re-wrap the attribute error with the name, rather than the path
             raise AttributeError('{name} is not set'.format(name=name))
@@ -277,30 +438,38 @@ class DataObj(object):
             pass
 
         # this could be an internal attribute from the constructor, so we need to make
-        # a special case
+        # a special case.  Changing any of these (other than the data) means the compiled
+        # accessors no longer apply
         if key in ["_coerce_map", "_struct", "data", "_properties", "_expose_data"]:
+            if key != "data":
+                self.__dict__.pop("_compiled_accessors", None)
+            else:
+                # anything waiting to be constructed, or shared with a clone, belonged to the old data, and
+                # none of the new data can be assumed to be in the index
+                self.__dict__.pop("_lazy_pending", None)
+                self.__dict__.pop("_cow_owned", None)
+                self.__dict__.pop("_handouts", None)
+                self._mark_dirty(None)
             return object.__setattr__(self, key, value)
 
-        props, data_attrs = self._list_dynamic_properties()
-
-        # extract the path from the properties list or the internal data
-        path = None
-        wrapper = None
-        if key in props:
-            path, wrapper = self._properties.get(key)
-        elif key in data_attrs:
-            path = key
-            wrapper = DataObj
-
-        # try to set the property on othe internal object
-        if path is not None:
-            wasset = self._set_internal_property(path, value, wrapper)
+        # try to set the property on the internal object
+        accessor = self._dynamic_accessor(key)
+        if accessor is not None:
+            wasset = accessor.set(self, value)
             if wasset:
                 return
 
         # fall back to the default approach of allowing any attribute to be set on the object
         return object.__setattr__(self, key, value)
 
+    def validate_all(self):
+        """
+        Construct anything in the data which has not been constructed against the struct yet (see construct_lazy),
+        raising DataStructureException if it is not valid.  Call this before writing the data anywhere
+        """
+        self._construct_pending()
+        return True
+
     def validate(self):
         if self.SCHEMA is not None:
             validate(self.data, self.SCHEMA)
@@ -314,140 +483,198 @@ class DataObj(object):
             setattr(self, k, v)
 
     def clone(self):
-        return self.__class__(deepcopy(self.data))
-
-    def json(self):
-        return json.dumps(self.data)
-
-    def _get_internal_property(self, path, wrapper=None):
-        # pull the object from the structure, to find out what kind of retrieve it needs
-        # (if there is a struct)
-        type, substruct, instructions = None, None, None
-        if self._struct:
-            type, substruct, instructions = construct_lookup(path, self._struct)
-
-        if type is None:
-            # if there is no struct, or no object mapping was found, try to pull the path
-            # as a single node (may be a field, list or dict, we'll find out in a mo)
-            val = self._get_single(path)
-
-            # if this is a dict or a list and a wrapper is supplied, wrap it
-            if wrapper is not None:
-                if isinstance(val, dict):
-                    return wrapper(val, expose_data=self._expose_data)
-                elif isinstance(val, list) and len(val) > 0:
-                    if isinstance(val[0], dict):    # just check the first one
-                        return [wrapper(v, expose_data=self._expose_data) for v in val]
-
-            # otherwise, return the raw value if it is not None, or raise an AttributeError
-            if val is None:
-                raise AttributeError('{name} is not set'.format(name=path))
+        """
+        Get a copy of this object which shares the nested parts of its data with this one until either of them
+        changes them.  Changes made through the object (its properties, and the getters and setters) copy just
+        the dicts and lists on the way to the change first, so they are not seen by the other.  Anything which
+        changes self.data directly must deepcopy it first (or use deepcopy(obj.data) in place of clone)
+        """
+        # each side gets its own top level, and from here on treats everything beneath it as shared
+        self._check_handouts()
+        c = self.__class__(_TrustedData(self.data))
+
+        for obj in [self, c]:
+            object.__setattr__(obj, "_cow_owned", {id(obj.data) : obj.data})
+
+        # anything already handed out by reference belongs to this object alone
+        for path in self.__dict__.get("_handouts", {}):
+            c._own_path(path)
+        lazy = self.__dict__.get("_lazy_pending")
+        if lazy is not None:
+            object.__setattr__(c, "_lazy_pending", lazy)
+        dirty = self.__dict__.get("_dirty")
+        if dirty is not None:
+            object.__setattr__(c, "_dirty", set(dirty))
+        return c
+
+    def dirty_paths(self):
+        """
+        Get the paths in the data which have been changed through the object (its properties, and the getters
+        and setters, and the lists and objects they hand out) since it was loaded or last saved, leaving out any
+        path inside another one in the list.
 
-            return val
+        Returns None if the object can only be brought up to date by writing all of it: if anything has been
+        deleted, or the data has been replaced.  Unless TRACK_CHANGES is set on the class, the lists handed out by
+        reference always count as changed, and the objects as needing all of it to be written
+        """
+        self._check_handouts()
+        dirty = self.__dict__.get("_dirty")
+        if dirty is None or None in dirty:
+            return None
+        paths = []
+        for path in sorted(dirty):
+            if len(paths) == 0 or not path.startswith(paths[-1] + "."):
+                paths.append(path)
+        return paths
+
+    def is_dirty(self):
+        self._check_handouts()
+        dirty = self.__dict__.get("_dirty")
+        return dirty is None or len(dirty) > 0
+
+    def changes(self):
+        """
+        Get a document containing just the values at dirty_paths(), for use as a partial update.  Returns None
+        if the whole of the data must be written
+        """
+        paths = self.dirty_paths()
+        if paths is None:
+            return None
+        doc = {}
+        for path in paths:
+            _set_path(doc, path, _get_path(self.data, path, None))
+        return doc
 
-        if instructions is None:
-            instructions = {}
+    def mark_clean(self):
+        """
+        Record that the data as it is now has been written, so nothing in it counts as changed
+        """
+        object.__setattr__(self, "_dirty", set())
+        self.__dict__.pop("_json_cache", None)
+        handouts = self.__dict__.get("_handouts")
+        if handouts:
+            for path, before in handouts.items():
+                if before is not _UNTRACKED:
+                    handouts[path] = deepcopy(_get_path(self.data, path, None))
+
+    def compact_class(self):
+        """
+        Get the compact __slots__ class for this object's struct (see slots_class), for holding large numbers
+        of records in memory.  Create instances with its from_raw(), and turn them back into this class with
+        MyObject(compact.to_raw())
+        """
+        if self._struct is None:
+            raise DataStructureException(u"{c} has no struct to generate a compact class from".format(c=self.__class__.__name__))
+        return self._accessor_plan().compact_class(self.__class__.__name__ + "Compact")
 
-        # if the struct contains a reference to the path, always return something, even if it is None - don't raise an AttributeError
-        kwargs = construct_kwargs(type, "get", instructions)
-        coerce_fn = self._coerce_map.get(instructions.get("coerce"))
-        if coerce_fn is not None:
-            kwargs["coerce"] = coerce_fn
+    def compact(self):
+        """
+        Get a compact copy of this object's data.  Anything in the data which is not in the struct is left out
+        """
+        return self.compact_class().from_raw(self.data, silent_prune=True)
 
-        if type == "field":
-            return self._get_single(path, **kwargs)
-        elif type == "object":
-            d = self._get_single(path, **kwargs)
-            if wrapper:
-                return wrapper(d, substruct, construct_raw=False, expose_data=self._expose_data)    # FIXME: this means all substructures are forced to use this classes expose_data policy, whatever it is
-            else:
-                return d
-        elif type == "list":
-            if instructions.get("contains") == "field":
-                return self._get_list(path, **kwargs)
-            elif instructions.get("contains") == "object":
-                l = self._get_list(path, **kwargs)
-                if wrapper:
-                    return [wrapper(o, substruct, construct_raw=False, expose_data=self._expose_data) for o in l]    # FIXME: this means all substructures are forced to use this classes expose_data policy, whatever it is
-                else:
-                    return l
+    @classmethod
+    def construct_many(cls, raws, processes=None, batch_size=1000, **kwargs):
+        """
+        Construct and validate a batch of raw records as instances of this class.
 
-        # if for whatever reason we get here, raise the AttributeError
-        raise AttributeError('{name} is not set'.format(name=path))
+        This is a generator which yields a tuple of (raw, obj, error) for each record, in the order
+        they were supplied.  Exactly one of obj and error is None, so a bad record does not stop the batch.
 
-    def _set_internal_property(self, path, value, wrapper=None):
+        If processes is greater than 1 the records are constructed in a pool of worker processes, batch_size
+        records at a time, and the results wrapped in this process without being constructed a second time.
+        For this the class must be importable by the workers, and the raw records must be picklable.
 
-        def _wrap_validate(val, wrap, substruct):
-            if wrap is None:
-                if isinstance(val, DataObj):
-                    return val.data
-                else:
-                    return val
+        :param raws: iterable of raw data dicts
+        :param processes: number of worker processes to use.  If None, everything is done in this process
+        :param batch_size: number of records to hand to the process pool at once
+        :param kwargs: any further keyword arguments to pass to the class constructor
+        :return: generator of (raw, obj, error) tuples
+        """
+        if processes is None or processes <= 1:
+            for raw in raws:
+                obj, error = _construct_one(cls, raw, kwargs)
+                yield raw, obj, error
+            return
 
-            else:
-                if isinstance(val, DataObj):
-                    if isinstance(val, wrap):
-                        return val.data
+        pool = multiprocessing.Pool(processes=processes)
+        try:
+            for batch in _batches(raws, batch_size):
+                chunksize = max(1, len(batch) // (processes * 4))
+                results = pool.map(_construct_data, [(cls, raw, kwargs) for raw in batch], chunksize)
+                for raw, (data, error) in zip(batch, results):
+                    if error is None:
+                        obj, error = _construct_one(cls, data, kwargs, trusted=True)
                     else:
-                        raise AttributeError("Attempt to set {x} failed; is not of an allowed type.".format(x=path))
-                else:
-                    try:
-                        d = wrap(val, substruct)
-                        return d.data
-                    except DataStructureException as e:
-                        raise AttributeError(e.message)
-
-        # pull the object from the structure, to find out what kind of retrieve it needs
-        # (if there is a struct)
-        type, substruct, instructions = None, None, None
-        if self._struct:
-            type, substruct, instructions = construct_lookup(path, self._struct)
-
-        # if no type is found, then this means that either the struct was undefined, or the
-        # path did not point to a valid point in the struct.  In the case that the struct was
-        # defined, this means the property is trying to set something outside the struct, which
-        # isn't allowed.  So, only set types which are None against objects which don't define
-        # the struct.
-        if type is None:
-            if self._struct is None:
-                if isinstance(value, list):
-                    value = [_wrap_validate(v, wrapper, None) for v in value]
-                    self._set_list(path, value)
-                else:
-                    value = _wrap_validate(value, wrapper, None)
-                    self._set_single(path, value)
+                        obj = None
+                    yield raw, obj, error
+        finally:
+            pool.terminate()
+            pool.join()
 
-                return True
-            else:
-                return False
-
-        if instructions is None:
-            instructions = {}
+    def json(self):
+        """
+        Serialise the data, with the encoder set by set_json_encoder.  The result is kept until the data is changed
+        through the object, or through the lists and objects it has handed out by reference, but not when it is
+        just read.  Unless TRACK_CHANGES is set on the class, it is not kept once any have been handed out.  Anything which changes self.data directly must then assign it (self.data = ...) or call
+        mark_clean() before serialising again
+        """
+        self._check_handouts()
+        cached = self.__dict__.get("_json_cache")
+        if cached is not None:
+            return cached
+        self.validate_all()
+        j = _json_encoder(self.data)
+        object.__setattr__(self, "_json_cache", j)
+        return j
+
+    def iter_json(self, chunk_size=65536):
+        """
+        Serialise the data a piece at a time, as strings of around chunk_size characters, so that a very large
+        record need not be built into a single string (e.g. for a streamed response)
+        """
+        self._check_handouts()
+        cached = self.__dict__.get("_json_cache")
+        if cached is not None:
+            for i in xrange(0, len(cached), chunk_size):
+                yield cached[i:i + chunk_size]
+            return
 
-        kwargs = construct_kwargs(type, "set", instructions)
-        coerce_fn = self._coerce_map.get(instructions.get("coerce"))
-        if coerce_fn is not None:
-            kwargs["coerce"] = coerce_fn
+        self.validate_all()
+        parts = []
+        size = 0
+        for part in json.JSONEncoder().iterencode(self.data):
+            parts.append(part)
+            size += len(part)
+            if size >= chunk_size:
+                yield "".join(parts)
+                parts = []
+                size = 0
+        if len(parts) > 0:
+            yield "".join(parts)
 
-        if type == "field":
-            self._set_single(path, value, **kwargs)
-            return True
-        elif type == "object":
-            v = _wrap_validate(value, wrapper, substruct)
-            self._set_single(path, v, **kwargs)
-            return True
-        elif type == "list":
-            if instructions.get("contains") == "field":
-                self._set_list(path, value, **kwargs)
-                return True
-            elif instructions.get("contains") == "object":
-                if not isinstance(value, list):
-                    value = [value]
-                vals = [_wrap_validate(v, wrapper, substruct) for v in value]
-                self._set_list(path, vals, **kwargs)
-                return True
+    def _get_internal_property(self, path, wrapper=None):
+        return self._accessor_plan().accessor(path, wrapper).get(self)
 
-        return False
+    def _set_internal_property(self, path, value, wrapper=None):
+        return self._accessor_plan().accessor(path, wrapper).set(self, value)
+
+    def _accessor_plan(self):
+        plan = self.__dict__.get("_compiled_accessors")
+        if plan is None:
+            plan = AccessorPlan.for_object(self)
+            self.__dict__["_compiled_accessors"] = plan
+        return plan
+
+    def _dynamic_accessor(self, name):
+        plan = self._accessor_plan()
+        accessor = plan.accessors.get(name)
+        if accessor is None and plan.expose_data and not plan.struct:
+            # with no struct, the exposed data attributes are whatever keys the data has right now
+            data = self.__dict__.get("data")
+            if data is not None and name in data:
+                accessor = plan.accessor(name, DataObj)
+        return accessor
 
     def _list_dynamic_properties(self):
         # list the dynamic properties the object could have
@@ -478,30 +705,145 @@ class DataObj(object):
         except:
             self._struct = struct
 
-    def _get_path(self, path, default):
-        parts = path.split(".")
-        context = self.data
+    def _construct_pending(self, path=None):
+        # construct the lazily held objects and lists: those which the path leads into, or all of them
+        lazy = self.__dict__.get("_lazy_pending")
+        if lazy is None:
+            return
+        pending, silent_prune = lazy
 
-        for i in range(len(parts)):
-            p = parts[i]
-            d = {} if i < len(parts) - 1 else default
-            context = context.get(p, d)
-        return context
+        if path is None:
+            names = pending
+        else:
+            names = [n for n in pending if path == n or path.startswith(n + ".") or n.startswith(path + ".")]
+            if len(names) == 0:
+                return
+
+        constructor = self._accessor_plan().constructor
+        for name in names:
+            val = constructor.construct_member(name, _get_path(self.data, name, None), silent_prune=silent_prune)
+            if "_cow_owned" in self.__dict__:
+                self._own_path(name, leaf=False)
+            if val is None:
+                self._delete(name, _internal=True)
+            else:
+                _set_path(self.data, name, val)
+
+        remaining = [n for n in pending if n not in names]
+        if len(remaining) > 0:
+            object.__setattr__(self, "_lazy_pending", (remaining, silent_prune))
+        else:
+            del self.__dict__["_lazy_pending"]
+
+    def _own_path(self, path, leaf=True):
+        # after a clone, copy the dicts (and the list or dict at the end, if leaf) on the way to the path which are
+        # still shared with the other object, so that they can be changed.  Returns the value at the path
+        owned = self.__dict__.get("_cow_owned")
+        if owned is None:
+            return _get_path(self.data, path, None)
 
-    def _set_path(self, path, val):
         parts = path.split(".")
         context = self.data
-
+        val = None
         for i in range(len(parts)):
-            p = parts[i]
+            val = context.get(parts[i])
+            last = i == len(parts) - 1
+            if not isinstance(val, (dict, list)) or (last and not leaf):
+                break
+            if id(val) not in owned:
+                val = dict(val) if isinstance(val, dict) else list(val)
+                context[parts[i]] = val
+                owned[id(val)] = val
+            if last or not isinstance(val, dict):
+                break
+            context = val
+        return val
 
-            if p not in context and i < len(parts) - 1:
-                context[p] = {}
-                context = context[p]
-            elif p in context and i < len(parts) - 1:
-                context = context[p]
-            else:
-                context[p] = val
+    def _own_entries(self, l):
+        # the objects in a list which is about to be handed out wrapped, so may be changed
+        owned = self.__dict__["_cow_owned"]
+        for i in range(len(l)):
+            if isinstance(l[i], dict) and id(l[i]) not in owned:
+                l[i] = dict(l[i])
+                owned[id(l[i])] = l[i]
+
+    def _share_owned(self, wrapped, path, whole=False):
+        # a DataObj wrapped around part of our data changes it on our behalf, so shares our record of what we own,
+        # and passes its changes back to us as changes under the path (or to the whole of it, for list entries)
+        if isinstance(wrapped, DataObj):
+            owned = self.__dict__.get("_cow_owned")
+            if owned is not None:
+                object.__setattr__(wrapped, "_cow_owned", owned)
+            object.__setattr__(wrapped, "_dirty_parent", (self, path, whole))
+        return wrapped
+
+    def _mark_dirty(self, path, deleted=False):
+        # record a change at the path, or to all of the data if the path is None
+        self.__dict__.pop("_json_cache", None)
+        parent = self.__dict__.get("_dirty_parent")
+        if parent is not None:
+            obj, prefix, whole = parent
+            if whole:
+                return obj._mark_dirty(prefix)
+            return obj._mark_dirty(prefix if path is None else prefix + "." + path, deleted=deleted or path is None)
+
+        dirty = self.__dict__.get("_dirty")
+        if dirty is not None:
+            dirty.add(None if deleted else path)
+
+    def _hand_out(self, path, val):
+        # a dict or list returned by reference may be changed by the caller, so must be ours, and is watched
+        if isinstance(val, (dict, list)):
+            if "_cow_owned" in self.__dict__:
+                val = self._own_path(path)
+            self._track_handout(path)
+        return val
+
+    def _track_handout(self, path):
+        # keep a copy of a dict or list which has been handed out by reference, to compare it with when the
+        # changes are next needed (see _check_handouts).  Reading it does not change anything by itself.  Objects
+        # which don't track changes just note the path, so that reading stays cheap
+        parent = self.__dict__.get("_dirty_parent")
+        if parent is not None:
+            obj, prefix, whole = parent
+            return obj._track_handout(prefix if whole else prefix + "." + path)
+
+        handouts = self.__dict__.get("_handouts")
+        if handouts is None:
+            handouts = {}
+            object.__setattr__(self, "_handouts", handouts)
+        if path not in handouts:
+            handouts[path] = deepcopy(_get_path(self.data, path, None)) if self.TRACK_CHANGES else _UNTRACKED
+
+    def _check_handouts(self):
+        # record a change for each dict or list handed out by reference which is no longer the same as its copy.
+        # Those without a copy may have been changed in any way, including having keys deleted from a dict
+        handouts = self.__dict__.get("_handouts")
+        if not handouts:
+            return
+        for path, before in handouts.items():
+            now = _get_path(self.data, path, None)
+            if before is _UNTRACKED:
+                self._mark_dirty(path, deleted=isinstance(now, dict))
+            elif now != before:
+                self._mark_dirty(path, deleted=_lost_keys(before, now))
+                handouts[path] = deepcopy(now)
+
+    def _get_path(self, path, default):
+        if "_lazy_pending" in self.__dict__:
+            self._construct_pending(path)
+        return _get_path(self.data, path, default)
+
+    def _set_path(self, path, val, _internal=False):
+        if "_lazy_pending" in self.__dict__:
+            self._construct_pending(path)
+        if "_cow_owned" in self.__dict__:
+            self._own_path(path, leaf=False)
+        if _internal:
+            self.__dict__.pop("_json_cache", None)
+        else:
+            self._mark_dirty(path)
+        _set_path(self.data, path, val)
 
     def _delete_from_list(self, path, val=None, matchsub=None, prune=True):
         l = self._get_list(path)
@@ -524,11 +866,20 @@ class DataObj(object):
         removes.sort(reverse=True)
         for r in removes:
             del l[r]
+        if len(removes) > 0:
+            self._mark_dirty(path)
 
         if len(l) == 0 and prune:
             self._delete(path, prune)
 
-    def _delete(self, path, prune=True):
+    def _delete(self, path, prune=True, _internal=False):
+        if not _internal:
+            if "_lazy_pending" in self.__dict__:
+                self._construct_pending(path)
+            self._mark_dirty(path, deleted=True)
+        if "_cow_owned" in self.__dict__:
+            self._own_path(path, leaf=False)
+
         parts = path.split(".")
         context = self.data
 
@@ -556,14 +907,7 @@ class DataObj(object):
                 del context[d]
 
     def _coerce(self, val, cast, accept_failure=False):
-        if cast is None:
-            return val
-        try:
-            return cast(val)
-        except (ValueError, TypeError):
-            if accept_failure:
-                return val
-            raise DataSchemaException(u"Cast with {x} failed on {y}".format(x=cast, y=val))
+        return _coerce(val, cast, accept_failure=accept_failure)
 
     def _get_single(self, path, coerce=None, default=None, allow_coerce_failure=True):
         # get the value at the point in the object
@@ -580,10 +924,16 @@ class DataObj(object):
         # get the value at the point in the object
         val = self._get_path(path, None)
 
-        # if there is no value and we want to do by reference, then create it, bind it and return it
+        # a list handed out by reference may be changed, so it can't be shared with a clone, and is watched
+        if val is not None and by_reference and "_cow_owned" in self.__dict__:
+            val = self._own_path(path)
+
+        # if there is no value and we want to do by reference, then create it, bind it and return it.  An empty
+        # list in place of nothing is not a change to the record
         if val is None and by_reference:
             mylist = []
-            self._set_single(path, mylist)
+            self._set_path(path, mylist, _internal=True)
+            self._track_handout(path)
             return mylist
 
         # otherwise, default is an empty list
@@ -598,10 +948,16 @@ class DataObj(object):
         if coerce is not None:
             coerced = [self._coerce(v, coerce, accept_failure=allow_coerce_failure) for v in val]
             if by_reference:
-                self._set_single(path, coerced)
+                # only write the coerced values back if coercing them changed anything
+                if len(coerced) != len(val) or any(type(c) is not type(v) or c != v for c, v in zip(coerced, val)):
+                    self._set_single(path, coerced)
+                else:
+                    coerced = val
+                self._track_handout(path)
             return coerced
         else:
             if by_reference:
+                self._track_handout(path)
                 return val
             else:
                 return deepcopy(val)
@@ -609,24 +965,12 @@ class DataObj(object):
     def _set_single(self, path, val, coerce=None, allow_coerce_failure=False, allowed_values=None, allowed_range=None,
                     allow_none=True, ignore_none=False):
 
-        if val is None and ignore_none:
+        val = _check_single(path, val, coerce=coerce, allow_coerce_failure=allow_coerce_failure,
+                            allowed_values=allowed_values, allowed_range=allowed_range,
+                            allow_none=allow_none, ignore_none=ignore_none)
+        if val is _SKIP:
             return
 
-        if val is None and not allow_none:
-            raise DataSchemaException(u"NoneType is not allowed at {x}".format(x=path))
-
-        # first see if we need to coerce the value (and don't coerce None)
-        if coerce is not None and val is not None:
-            val = self._coerce(val, coerce, accept_failure=allow_coerce_failure)
-
-        if allowed_values is not None and val not in allowed_values:
-            raise DataSchemaException(u"Value {x} is not permitted at {y}".format(x=val, y=path))
-
-        if allowed_range is not None:
-            lower, upper = allowed_range
-            if (lower is not None and val < lower) or (upper is not None and val > upper):
-                raise DataSchemaException("Value {x} is outside the allowed range: {l} - {u}".format(x=val, l=lower, u=upper))
-
         # now set it at the path point in the object
         self._set_path(path, val)
 
@@ -660,15 +1004,11 @@ class DataObj(object):
         self._set_path(path, val)
 
     def _add_to_list(self, path, val, coerce=None, allow_coerce_failure=False, allow_none=False, ignore_none=True, unique=False):
-        if val is None and ignore_none:
+        val = _check_list_entry(path, val, coerce=coerce, allow_coerce_failure=allow_coerce_failure,
+                                allow_none=allow_none, ignore_none=ignore_none)
+        if val is _SKIP:
             return
 
-        if val is None and not allow_none:
-            raise DataSchemaException(u"NoneType is not allowed in list at {x}".format(x=path))
-
-        # first coerce the value
-        if coerce is not None:
-            val = self._coerce(val, coerce, accept_failure=allow_coerce_failure)
         current = self._get_list(path, by_reference=True)
 
         # if we require the list to be unique, check for the value first
@@ -678,32 +1018,31 @@ class DataObj(object):
 
         # otherwise, append
         current.append(val)
+        self._mark_dirty(path)
 
     def _set_with_struct(self, path, val):
-        type, struct, instructions = construct_lookup(path, self._struct)
+        lookup = self._accessor_plan().lookup(path)
+        type, struct = lookup.type, lookup.substruct
         if type == "field":
-            kwargs = construct_kwargs(type, "set", instructions)
-            self._set_single(path, val, **kwargs)
+            self._set_single(path, val, **lookup.set_kwargs)
         elif type == "list":
             if not isinstance(val, list):
                 val = [val]
             if struct is not None:
                 val = [construct(x, struct, self._coerce_map) for x in val]
-            kwargs = construct_kwargs(type, "set", instructions)
-            self._set_list(path, val, **kwargs)
+            self._set_list(path, val, **lookup.set_kwargs)
         elif type == "object":
             if struct is not None:
                 val = construct(val, struct, self._coerce_map)
             self._set_single(path, val)
 
     def _add_to_list_with_struct(self, path, val):
-        type, struct, instructions = construct_lookup(path, self._struct)
-        if type != "list":
+        lookup = self._accessor_plan().lookup(path)
+        if lookup.type != "list":
             raise DataStructureException(u"Attempt to add to list {x} failed - it is not a list element".format(x=path))
-        if struct is not None:
-            val = construct(val, struct, self._coerce_map)
-        kwargs = construct_kwargs(type, "set", instructions)
-        self._add_to_list(path, val, **kwargs)
+        if lookup.substruct is not None:
+            val = construct(val, lookup.substruct, self._coerce_map)
+        self._add_to_list(path, val, **lookup.set_kwargs)
 
 
     def _utf8_unicode(self):
@@ -732,6 +1071,265 @@ class DataObj(object):
 
 
 
+############################################################
+## Compiled accessors for the dynamic properties of a DataObj
+
+class PathLookup(object):
+    """
+    The result of looking up a path in a struct, with the getter/setter keyword arguments
+    (including any coerce function) already worked out
+    """
+    def __init__(self, path, struct, coerce_map):
+        self.type, self.substruct, self.instructions = None, None, None
+        if struct:
+            self.type, self.substruct, self.instructions = construct_lookup(path, struct)
+
+        instructions = self.instructions if self.instructions is not None else {}
+        self.set_kwargs = construct_kwargs(self.type, "set", instructions)
+        self.get_kwargs = construct_kwargs(self.type, "get", instructions)
+        self.contains = instructions.get("contains")
+
+        self.coerce = coerce_map.get(instructions.get("coerce"))
+        self.coerced_set_kwargs = dict(self.set_kwargs)
+        if self.coerce is not None:
+            self.get_kwargs["coerce"] = self.coerce
+            self.coerced_set_kwargs["coerce"] = self.coerce
+
+def _wrap_validate(path, val, wrap, substruct):
+    if wrap is None:
+        if isinstance(val, DataObj):
+            return val.data
+        else:
+            return val
+
+    else:
+        if isinstance(val, DataObj):
+            if isinstance(val, wrap):
+                return val.data
+            else:
+                raise AttributeError("Attempt to set {x} failed; is not of an allowed type.".format(x=path))
+        else:
+            try:
+                d = wrap(val, substruct)
+                return d.data
+            except DataStructureException as e:
+                raise AttributeError(e.message)
+
+class Accessor(object):
+    """
+    Getter and setter for a single path (and optional wrapper class) on a DataObj, bound to the
+    struct information for that path
+    """
+    def __init__(self, path, wrapper, lookup, has_struct):
+        self.get = self._compile_getter(path, wrapper, lookup)
+        self.set = self._compile_setter(path, wrapper, lookup, has_struct)
+
+    def _compile_getter(self, path, wrapper, lookup):
+        type, substruct, kwargs = lookup.type, lookup.substruct, lookup.get_kwargs
+
+        if type is None:
+            # if there is no struct, or no object mapping was found, try to pull the path
+            # as a single node (may be a field, list or dict, we'll find out in a mo)
+            def getter(obj):
+                val = obj._get_single(path)
+
+                # if this is a dict or a list and a wrapper is supplied, wrap it
+                if wrapper is not None:
+                    if isinstance(val, dict):
+                        if "_cow_owned" in obj.__dict__:
+                            val = obj._own_path(path)
+                        return obj._share_owned(wrapper(val, expose_data=obj._expose_data), path)
+                    elif isinstance(val, list) and len(val) > 0:
+                        if isinstance(val[0], dict):    # just check the first one
+                            if "_cow_owned" in obj.__dict__:
+                                val = obj._own_path(path)
+                                obj._own_entries(val)
+                            return [obj._share_owned(wrapper(v, expose_data=obj._expose_data), path, whole=True) for v in val]
+
+                # otherwise, return the raw value if it is not None, or raise an AttributeError
+                if val is None:
+                    raise AttributeError('{name} is not set'.format(name=path))
+
+                return obj._hand_out(path, val)
+            return getter
+
+        # if the struct contains a reference to the path, always return something, even if it is None - don't raise an AttributeError
+        if type == "field":
+            def getter(obj):
+                return obj._get_single(path, **kwargs)
+            return getter
+
+        if type == "object" and not wrapper:
+            def getter(obj):
+                return obj._hand_out(path, obj._get_single(path, **kwargs))
+            return getter
+
+        if type == "object":
+            def getter(obj):
+                d = obj._get_single(path, **kwargs)
+                if d is not None and "_cow_owned" in obj.__dict__:
+                    d = obj._own_path(path)
+                return obj._share_owned(wrapper(d, substruct, construct_raw=False, expose_data=obj._expose_data), path)    # FIXME: this means all substructures are forced to use this classes expose_data policy, whatever it is
+            return getter
+
+        if type == "list" and (lookup.contains == "field" or (lookup.contains == "object" and not wrapper)):
+            def getter(obj):
+                return obj._get_list(path, **kwargs)
+            return getter
+
+        if type == "list" and lookup.contains == "object":
+            def getter(obj):
+                l = obj._get_list(path, **kwargs)
+                if "_cow_owned" in obj.__dict__:
+                    obj._own_entries(l)
+                return [obj._share_owned(wrapper(o, substruct, construct_raw=False, expose_data=obj._expose_data), path, whole=True) for o in l]    # FIXME: this means all substructures are forced to use this classes expose_data policy, whatever it is
+            return getter
+
+        # if for whatever reason we get here, raise the AttributeError
+        def getter(obj):
+            raise AttributeError('{name} is not set'.format(name=path))
+        return getter
+
+    def _compile_setter(self, path, wrapper, lookup, has_struct):
+        type, substruct, kwargs = lookup.type, lookup.substruct, lookup.coerced_set_kwargs
+
+        # if no type is found, then this means that either the struct was undefined, or the
+        # path did not point to a valid point in the struct.  In the case that the struct was
+        # defined, this means the property is trying to set something outside the struct, which
+        # isn't allowed.  So, only set types which are None against objects which don't define
+        # the struct.
+        if type is None:
+            if has_struct:
+                return lambda obj, value: False
+
+            def setter(obj, value):
+                if isinstance(value, list):
+                    value = [_wrap_validate(path, v, wrapper, None) for v in value]
+                    obj._set_list(path, value)
+                else:
+                    value = _wrap_validate(path, value, wrapper, None)
+                    obj._set_single(path, value)
+                return True
+            return setter
+
+        if type == "field":
+            def setter(obj, value):
+                obj._set_single(path, value, **kwargs)
+                return True
+            return setter
+
+        if type == "object":
+            def setter(obj, value):
+                v = _wrap_validate(path, value, wrapper, substruct)
+                obj._set_single(path, v, **kwargs)
+                return True
+            return setter
+
+        if type == "list" and lookup.contains == "field":
+            def setter(obj, value):
+                obj._set_list(path, value, **kwargs)
+                return True
+            return setter
+
+        if type == "list" and lookup.contains == "object":
+            def setter(obj, value):
+                if not isinstance(value, list):
+                    value = [value]
+                vals = [_wrap_validate(path, v, wrapper, substruct) for v in value]
+                obj._set_list(path, vals, **kwargs)
+                return True
+            return setter
+
+        return lambda obj, value: False
+
+class AccessorPlan(object):
+    """
+    A DataObj's struct, properties and coerce map resolved once into a dictionary of precompiled
+    accessors, so that dynamic attribute access does not have to search the struct each time.
+
+    Plans are cached per class, and shared by all the instances of that class which have an
+    equivalent struct, properties and coerce map.  Each object holds on to its plan until one of
+    those is replaced (e.g. by _add_struct).
+    """
+    MAX_PER_CLASS = 10
+
+    _plans = {}
+
+    def __init__(self, struct, properties, expose_data, coerce_map):
+        self.struct = deepcopy(struct)
+        self.properties = dict(properties)
+        self.expose_data = expose_data
+        self.coerce_map = dict(coerce_map)
+
+        self._lookups = {}
+        self._accessors = {}
+        self._constructor = None
+        self._compact_classes = {}
+
+        # the named dynamic properties take precedence over the data attributes
+        self.accessors = {}
+        if expose_data and self.struct:
+            for key in construct_data_keys(self.struct):
+                self.accessors[key] = self.accessor(key, DataObj)
+        for name, (path, wrapper) in self.properties.iteritems():
+            self.accessors[name] = self.accessor(path, wrapper)
+
+    @classmethod
+    def for_object(cls, obj):
+        def attr(name, default):
+            try:
+                val = object.__getattribute__(obj, name)
+            except AttributeError:
+                return default
+            return val if val is not None else default
+
+        struct = attr("_struct", None)
+        properties = attr("_properties", {})
+        expose_data = attr("_expose_data", False)
+        coerce_map = attr("_coerce_map", {})
+
+        plans = cls._plans.setdefault(obj.__class__, [])
+        for plan in plans:
+            if plan.matches(struct, properties, expose_data, coerce_map):
+                return plan
+
+        plan = cls(struct, properties, expose_data, coerce_map)
+        plans.insert(0, plan)
+        del plans[cls.MAX_PER_CLASS:]
+        return plan
+
+    def matches(self, struct, properties, expose_data, coerce_map):
+        return self.expose_data == expose_data and self.properties == properties and \
+               self.coerce_map == coerce_map and self.struct == struct
+
+    @property
+    def constructor(self):
+        if self._constructor is None:
+            self._constructor = CompiledStruct(self.struct, self.coerce_map)
+        return self._constructor
+
+    def compact_class(self, name):
+        klazz = self._compact_classes.get(name)
+        if klazz is None:
+            klazz = _make_slots_class(self.constructor, name)
+            self._compact_classes[name] = klazz
+        return klazz
+
+    def lookup(self, path):
+        lookup = self._lookups.get(path)
+        if lookup is None:
+            lookup = PathLookup(path, self.struct, self.coerce_map)
+            self._lookups[path] = lookup
+        return lookup
+
+    def accessor(self, path, wrapper=None):
+        key = (path, wrapper)
+        accessor = self._accessors.get(key)
+        if accessor is None:
+            accessor = Accessor(path, wrapper, self.lookup(path), bool(self.struct))
+            self._accessors[key] = accessor
+        return accessor
+
 ############################################################
 ## Primitive object schema validation
 
@@ -1041,6 +1639,212 @@ def construct(obj, struct, coerce, context="", silent_prune=False):
     return constructed.data
 
 
+class CompiledStruct(object):
+    """
+    A struct and coerce map compiled for repeated use by construct: the allowed keys, the
+    coerce functions and the setter arguments are all worked out once, and sub-structs are
+    compiled recursively.  The result is the same as calling construct() with the struct.
+
+    Use compile_struct() to get a cached instance for a long-lived struct.
+    """
+    def __init__(self, struct, coerce):
+        self.required = list(struct.get("required", []))
+        self.allowed = frozenset(construct_data_keys(struct))
+        substructs = struct.get("structs", {})
+
+        self.fields = []
+        for field_name, instructions in struct.get("fields", {}).iteritems():
+            coerce_name = instructions.get("coerce", "unicode")
+            kwargs = construct_kwargs("field", "set", instructions)
+            self.fields.append((field_name, coerce_name, coerce.get(coerce_name), kwargs))
+
+        self.objects = []
+        for field_name in struct.get("objects", []):
+            instructions = substructs.get(field_name)
+            sub = CompiledStruct(instructions, coerce) if instructions is not None else None
+            self.objects.append((field_name, sub))
+
+        self.lists = []
+        for field_name, instructions in struct.get("lists", {}).iteritems():
+            coerce_name = instructions.get("coerce", "unicode")
+            kwargs = construct_kwargs("list", "set", instructions)
+            subinst = substructs.get(field_name)
+            sub = CompiledStruct(subinst, coerce) if subinst is not None else None
+            self.lists.append((field_name, instructions.get("contains"), coerce_name, coerce.get(coerce_name), kwargs, sub))
+
+        # the objects and lists, which can be constructed one at a time with construct_member
+        self.members = {}
+        for field_name, sub in self.objects:
+            self.members[field_name] = ("object", sub)
+        for entry in self.lists:
+            self.members[entry[0]] = ("list", entry)
+
+    def construct(self, obj, context="", silent_prune=False):
+        if obj is None:
+            return None
+
+        constructed = self._construct_fields(obj, context, silent_prune)
+
+        for field_name, sub in self.objects:
+            val = self._construct_object(field_name, sub, obj.get(field_name), context, silent_prune)
+            if val is not None:
+                _set_path(constructed, field_name, val)
+
+        for entry in self.lists:
+            val = self._construct_list(entry, obj.get(entry[0]), context, silent_prune)
+            if val is not None:
+                _set_path(constructed, entry[0], val)
+
+        return constructed
+
+    def construct_lazy(self, obj, context="", silent_prune=False):
+        """
+        Check the top level of the object and construct its fields, but leave the objects and lists as they are,
+        to be constructed with construct_member when they are needed.
+
+        :return: (constructed object, list of the names of the objects and lists which have not been constructed)
+        """
+        if obj is None:
+            return None, []
+
+        constructed = self._construct_fields(obj, context, silent_prune)
+
+        pending = []
+        for field_name in self.members:
+            val = obj.get(field_name)
+            if val is not None:
+                _set_path(constructed, field_name, val)
+                pending.append(field_name)
+
+        return constructed, pending
+
+    def construct_member(self, field_name, val, context="", silent_prune=False):
+        """
+        Construct the value of one of the objects or lists, as construct would.  Returns None if it should not be set
+        """
+        kind, entry = self.members[field_name]
+        if kind == "object":
+            return self._construct_object(field_name, entry, val, context, silent_prune)
+        return self._construct_list(entry, val, context, silent_prune)
+
+    def _construct_fields(self, obj, context, silent_prune):
+        # check that all the required fields are there
+        try:
+            keys = obj.keys()
+        except:
+            c = context if context != "" else "root"
+            raise DataStructureException(u"Expected an object at {c} but found something else instead".format(c=c))
+
+        for r in self.required:
+            if r not in keys:
+                c = context if context != "" else "root"
+                raise DataStructureException("Field '{r}' is required but not present at '{c}'".format(r=r, c=c))
+
+        # check that there are no fields that are not allowed
+        if not silent_prune:
+            for k in keys:
+                if k not in self.allowed:
+                    c = context if context != "" else "root"
+                    raise DataStructureException("Field '{k}' is not permitted at '{c}'".format(k=k, c=c))
+
+        constructed = {}
+
+        for field_name, coerce_name, coerce_fn, kwargs in self.fields:
+            val = obj.get(field_name)
+            if val is None:
+                continue
+            if coerce_fn is None:
+                raise DataStructureException("No coersion function defined for type '{x}' at '{c}'".format(x=coerce_name, c=context + field_name))
+            try:
+                val = _check_single(field_name, val, coerce=coerce_fn, **kwargs)
+            except DataSchemaException as e:
+                raise DataStructureException(e.message)
+            if val is not _SKIP:
+                _set_path(constructed, field_name, val)
+
+        return constructed
+
+    def _construct_object(self, field_name, sub, val, context, silent_prune):
+        if val is None:
+            return None
+        if type(val) != dict:
+            raise DataStructureException("Found '{x}' = '{y}' but expected object/dict".format(x=context + field_name, y=val))
+
+        if sub is None:
+            # no further instructions, so accept the data structure as-is (without its references)
+            return deepcopy(val)
+        return sub.construct(val, context=context + field_name + ".", silent_prune=silent_prune)
+
+    def _construct_list(self, entry, vals, context, silent_prune):
+        field_name, contains, coerce_name, coerce_fn, kwargs, sub = entry
+        if vals is None:
+            return None
+        if not isinstance(vals, list):
+            raise DataStructureException(u"Expecting list at {x} but found something else".format(x=context + field_name))
+
+        # the list is only created once there is something to put in it
+        current = None
+
+        if contains == "field":
+            if coerce_fn is None:
+                raise DataStructureException("No coersion function defined for type '{x}' at '{c}'".format(x=coerce_name, c=context + field_name))
+            unique = kwargs.get("unique", False)
+            for val in vals:
+                try:
+                    val = _check_list_entry(field_name, val, coerce=coerce_fn, **kwargs)
+                except DataSchemaException as e:
+                    raise DataStructureException(e.message)
+                if val is _SKIP:
+                    continue
+                if current is None:
+                    current = []
+                if unique and val in current:
+                    continue
+                current.append(val)
+
+        elif contains == "object":
+            for i in xrange(len(vals)):
+                val = vals[i]
+                if type(val) != dict:
+                    raise DataStructureException("Found '{x}[{p}]' = '{y}' but expected object/dict".format(x=context + field_name, y=val, p=i))
+
+                if sub is None:
+                    val = deepcopy(val)
+                else:
+                    val = sub.construct(val, context=context + field_name + "[" + str(i) + "].", silent_prune=silent_prune)
+
+                if current is None:
+                    current = []
+                current.append(val)
+
+        else:
+            raise DataStructureException("Cannot understand structure where list '{x}' elements contain '{y}'".format(x=context + field_name, y=contains))
+
+        return current
+
+_compiled_structs = {}
+
+def compile_struct(struct, coerce):
+    """
+    Get the CompiledStruct for a struct and coerce map, compiling it on first use.
+
+    Compiled structs are cached against the identity of the struct and coerce map, so this is
+    intended for long-lived (e.g. module-level) structs, which must not be modified in place
+    once they have been compiled
+    """
+    key = (id(struct), id(coerce))
+    entry = _compiled_structs.get(key)
+    if entry is not None:
+        return entry[2]
+
+    compiled = CompiledStruct(struct, coerce)
+    if len(_compiled_structs) >= 100:
+        _compiled_structs.clear()
+
+    # keep references to the struct and coerce map, so their ids can't be re-used while cached
+    _compiled_structs[key] = (struct, coerce, compiled)
+    return compiled
+
 def construct_merge(target, source):
     merged = deepcopy(target)
 
@@ -1147,6 +1951,199 @@ def construct_kwargs(type, dir, instructions):
 def construct_data_keys(struct):
     return struct.get("fields", {}).keys() + struct.get("objects", []) + struct.get("lists", {}).keys()
 
+############################################################
+## Compact __slots__ classes generated from structs
+
+class CompactObj(object):
+    """
+    Base class for the compact classes generated by slots_class().
+
+    Each field, object and list in the struct is held in a slot, rather than in a nested dict, so
+    instances take a fraction of the memory of the equivalent DataObj.  Objects and lists of objects
+    with their own struct are held as instances of generated classes too.  Values are coerced and
+    checked as they are set, in the same way as construct() would.
+    """
+    __slots__ = ()
+
+    # filled in for each generated class: the compiled struct, a list of (attribute, key, kind, compact class)
+    # for each slot, and a map of attribute to the function which checks values set on it
+    _compiled = None
+    _layout = ()
+    _setters = {}
+
+    @classmethod
+    def from_raw(cls, raw, silent_prune=False):
+        """
+        Validate and coerce the raw data against the struct, as construct() would, and create an instance from it
+        """
+        if raw is None:
+            return None
+        return cls._from_constructed(cls._compiled.construct(raw, silent_prune=silent_prune))
+
+    @classmethod
+    def _from_constructed(cls, data):
+        obj = cls.__new__(cls)
+        setter = object.__setattr__
+        for attr, key, kind, sub in cls._layout:
+            val = _get_path(data, key, None)
+            if val is not None and sub is not None:
+                if kind == "object":
+                    val = sub._from_constructed(val)
+                else:
+                    val = [sub._from_constructed(v) for v in val]
+            setter(obj, attr, val)
+        return obj
+
+    def to_raw(self):
+        """
+        Get the data as the dict that DataObj would hold for it
+        """
+        raw = {}
+        for attr, key, kind, sub in self._layout:
+            val = getattr(self, attr)
+            if val is None:
+                continue
+            if sub is not None:
+                val = val.to_raw() if kind == "object" else [v.to_raw() for v in val]
+            elif kind == "object":
+                val = deepcopy(val)
+            elif kind == "list":
+                val = deepcopy(val)
+            _set_path(raw, key, val)
+        return raw
+
+    def __setattr__(self, key, value):
+        check = self._setters.get(key)
+        if check is None:
+            raise AttributeError(u"{c} has no field {k}".format(c=self.__class__.__name__, k=key))
+        object.__setattr__(self, key, check(value))
+
+    def __eq__(self, other):
+        return isinstance(other, CompactObj) and self.to_raw() == other.to_raw()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return u"{c}({r})".format(c=self.__class__.__name__, r=self.to_raw())
+
+def _slot_name(key):
+    name = re.sub(r"\W", "_", key)
+    if name == "" or name[0].isdigit() or keyword.iskeyword(name):
+        name = "_" + name
+    return name
+
+def _field_setter(key, coerce_name, coerce_fn, kwargs):
+    def check(val):
+        if coerce_fn is None:
+            raise DataStructureException("No coersion function defined for type '{x}' at '{c}'".format(x=coerce_name, c=key))
+        try:
+            val = _check_single(key, val, coerce=coerce_fn, **kwargs)
+        except DataSchemaException as e:
+            raise DataStructureException(e.message)
+        return None if val is _SKIP else val
+    return check
+
+def _object_setter(key, sub):
+    def check(val):
+        if val is None or (sub is not None and isinstance(val, sub)):
+            return val
+        if type(val) != dict:
+            raise DataStructureException("Found '{x}' = '{y}' but expected object/dict".format(x=key, y=val))
+        return deepcopy(val) if sub is None else sub.from_raw(val)
+    return check
+
+def _list_setter(key, contains, coerce_name, coerce_fn, kwargs, sub):
+    def check(vals):
+        if vals is None:
+            return None
+        if not isinstance(vals, list):
+            raise DataStructureException(u"Expecting list at {x} but found something else".format(x=key))
+
+        out = []
+        if contains == "field":
+            if coerce_fn is None:
+                raise DataStructureException("No coersion function defined for type '{x}' at '{c}'".format(x=coerce_name, c=key))
+            unique = kwargs.get("unique", False)
+            for val in vals:
+                try:
+                    val = _check_list_entry(key, val, coerce=coerce_fn, **kwargs)
+                except DataSchemaException as e:
+                    raise DataStructureException(e.message)
+                if val is _SKIP or (unique and val in out):
+                    continue
+                out.append(val)
+        else:
+            for i in xrange(len(vals)):
+                val = vals[i]
+                if sub is not None and isinstance(val, sub):
+                    out.append(val)
+                    continue
+                if type(val) != dict:
+                    raise DataStructureException("Found '{x}[{p}]' = '{y}' but expected object/dict".format(x=key, y=val, p=i))
+                out.append(deepcopy(val) if sub is None else sub.from_raw(val))
+
+        # as with construct, an empty list is not kept
+        return out if len(out) > 0 else None
+    return check
+
+def _make_slots_class(compiled, name):
+    layout = []
+    setters = {}
+
+    for field_name, coerce_name, coerce_fn, kwargs in compiled.fields:
+        attr = _slot_name(field_name)
+        layout.append((attr, field_name, "field", None))
+        setters[attr] = _field_setter(field_name, coerce_name, coerce_fn, kwargs)
+
+    for field_name, substruct in compiled.objects:
+        attr = _slot_name(field_name)
+        sub = _make_slots_class(substruct, name + "_" + attr) if substruct is not None else None
+        layout.append((attr, field_name, "object", sub))
+        setters[attr] = _object_setter(field_name, sub)
+
+    for field_name, contains, coerce_name, coerce_fn, kwargs, substruct in compiled.lists:
+        attr = _slot_name(field_name)
+        sub = _make_slots_class(substruct, name + "_" + attr) if substruct is not None and contains == "object" else None
+        layout.append((attr, field_name, "list", sub))
+        setters[attr] = _list_setter(field_name, contains, coerce_name, coerce_fn, kwargs, sub)
+
+    attrs = [l[0] for l in layout]
+    if len(set(attrs)) != len(attrs):
+        raise DataStructureException(u"Struct for {n} has fields which map to the same attribute name".format(n=name))
+
+    return type(name, (CompactObj,), {
+        "__slots__" : tuple(attrs),
+        "_compiled" : compiled,
+        "_layout" : tuple(layout),
+        "_setters" : setters
+    })
+
+_slots_classes = {}
+
+def slots_class(struct, coerce=None, name="CompactObj"):
+    """
+    Get a compact, __slots__ based class (a subclass of CompactObj) for the struct, generating it on first use.
+
+    Use from_raw() to create instances from raw data, and to_raw() to get the data back out (e.g. to
+    create the full DataObj with).  As with compile_struct, classes are cached against the identity of
+    the struct and coerce map
+    """
+    if coerce is None:
+        coerce = DataObj.DEFAULT_COERCE
+    key = (id(struct), id(coerce), name)
+    entry = _slots_classes.get(key)
+    if entry is not None:
+        return entry[2]
+
+    klazz = _make_slots_class(compile_struct(struct, coerce), name)
+    if len(_slots_classes) >= 100:
+        _slots_classes.clear()
+
+    # keep references to the struct and coerce map, so their ids can't be re-used while cached
+    _slots_classes[key] = (struct, coerce, klazz)
+    return klazz
+
 ############################################################
 ## Unit test support
 
@@ -1,10 +1,139 @@
 from octopus.core import app
-import requests, time, urllib, json
+import requests, time, urllib, urlparse, json, os, threading
+from cookielib import DefaultCookiePolicy
+from multiprocessing.pool import ThreadPool
 from StringIO import StringIO
 
 class SizeExceededException(Exception):
     pass
 
+######################################################
+# Pooled, keep-alive sessions, one per host
+
+_sessions = {}
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+
+def _host_key(url):
+    parsed = urlparse.urlparse(url)
+    return parsed.scheme.lower(), parsed.netloc.lower()
+
+def _new_session():
+    pool_size = app.config.get("HTTP_POOL_SIZE", 10)
+    pool_block = app.config.get("HTTP_POOL_BLOCK", False)
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=pool_block)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    # the module-level requests functions never carried cookies from one call to the next, so
+    # make sure the shared session doesn't start doing so either
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+def get_session(url):
+    """
+    Get the shared requests.Session for the host of the given url, creating it if necessary.
+
+    Sessions are keyed on scheme and host, and are discarded (without being closed, as the
+    sockets belong to the parent) the first time they are requested in a forked child process
+    """
+    global _sessions, _sessions_pid
+
+    key = _host_key(url)
+    with _sessions_lock:
+        pid = os.getpid()
+        if _sessions_pid != pid:
+            _sessions = {}
+            _sessions_pid = pid
+
+        session = _sessions.get(key)
+        if session is None:
+            session = _new_session()
+            _sessions[key] = session
+
+    return session
+
+def reset_sessions():
+    """
+    Close all the pooled connections held by this process
+    """
+    global _sessions
+    with _sessions_lock:
+        if _sessions_pid == os.getpid():
+            for session in _sessions.values():
+                session.close()
+        _sessions = {}
+
+######################################################
+# Per-host rate limiting
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+class _RateLimiter(object):
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        # reserve the next free slot under the lock, then sleep outside it so that other
+        # threads can queue up behind us
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+def _throttle(url):
+    host = _host_key(url)[1]
+    rate = app.config.get("HTTP_RATE_LIMITS", {}).get(host)
+    if not rate:
+        return
+
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(host)
+        if limiter is None or limiter.interval != 1.0 / rate:
+            limiter = _RateLimiter(rate)
+            _rate_limiters[host] = limiter
+    limiter.wait()
+
+######################################################
+# Bounded concurrent requests
+
+def map_concurrent(fn, items, concurrency=None):
+    """
+    Call fn(item) for every item, with at most `concurrency` calls in flight at once.
+
+    Results are yielded in the same order as the items, as (item, result, error) tuples, where
+    error is the exception raised by fn (and result is None), or None if the call succeeded.
+
+    fn will normally be a lookup method on one of the service clients, which makes its requests
+    through this module, so retries, back-off and rate limits apply to each call as usual
+    """
+    if concurrency is None:
+        concurrency = app.config.get("HTTP_MAX_CONCURRENCY", 10)
+
+    def _call(item):
+        try:
+            return item, fn(item), None
+        except Exception as e:
+            return item, None, e
+
+    pool = ThreadPool(processes=concurrency)
+    try:
+        for res in pool.imap(_call, items):
+            yield res
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+######################################################
+
 def quote(s, **kwargs):
     try:
         return urllib.quote_plus(s, **kwargs)
@@ -49,19 +178,26 @@ def _make_request(method, url,
     if response_encoding is None:
         response_encoding = app.config.get("HTTP_RESPONSE_ENCODING")
 
+    # either use the pooled session for this host, or the module-level requests functions
+    # which open a new connection each time
+    requester = requests
+    if app.config.get("HTTP_POOL_CONNECTIONS", True):
+        requester = get_session(url)
+
     attempt = 0
     r = None
 
     while attempt <= retries:
+        _throttle(url)
         try:
             if method == "GET":
-                r = requests.get(url, timeout=timeout, **kwargs)
+                r = requester.get(url, timeout=timeout, **kwargs)
             elif method == "POST":
-                r = requests.post(url, timeout=timeout, **kwargs)
+                r = requester.post(url, timeout=timeout, **kwargs)
             elif method == "PUT":
-                r = requests.put(url, timeout=timeout, **kwargs)
+                r = requester.put(url, timeout=timeout, **kwargs)
             elif method == "DELETE":
-                r = requests.delete(url, timeout=timeout, **kwargs)
+                r = requester.delete(url, timeout=timeout, **kwargs)
             else:
                 # FIXME: is this right?  Maybe raising an exception would be better
                 app.logger.debug("Method {method} not allowed".format(method=method))
@@ -138,22 +274,11 @@ def get(url, retries=None, back_off_factor=None, max_back_off=None, timeout=None
                          retry_codes=retry_codes,
                          **kwargs)
 
-def get_stream(url, retries=None, back_off_factor=None, max_back_off=None, timeout=None, response_encoding=None,
-        retry_on_timeout=None, retry_codes=None, size_limit=None, chunk_size=None, cut_off=None, read_stream=True, **kwargs):
-
-    # set the defaults where necessary from configuration
-
-    if size_limit is None:
-        size_limit = app.config.get("HTTP_STREAM_MAX_SIZE", 0)  # size of 0 means no limit
-
-    if cut_off is None:
-        cut_off = app.config.get("HTTP_STREAM_CUT_OFF", 0)  # size of 0 means no limit
-
-    if chunk_size is None:
-        chunk_size = app.config.get("HTTP_STREAM_CHUNK_SIZE", 262144)   # 250Kb
+def _open_stream(url, retries=None, back_off_factor=None, max_back_off=None, timeout=None, response_encoding=None,
+        retry_on_timeout=None, retry_codes=None, size_limit=0, method="GET", **kwargs):
 
     # actually make the request (note that we pass stream=True)
-    resp = _make_request("GET", url,
+    resp = _make_request(method, url,
              retries=retries, back_off_factor=back_off_factor,
              max_back_off=max_back_off,
              timeout=timeout,
@@ -164,7 +289,7 @@ def get_stream(url, retries=None, back_off_factor=None, max_back_off=None, timeo
              **kwargs)
 
     if resp is None:
-        return None, "", 0
+        return None
 
     # check that content length header for an early view on whether the resource
     # is too large
@@ -176,33 +301,111 @@ def get_stream(url, retries=None, back_off_factor=None, max_back_off=None, timeo
             header_reported_size = 0
 
         if header_reported_size > size_limit:
-            resp.connection.close()
+            resp.close()
             raise SizeExceededException("Size as announced by Content-Type header is larger than maximum allowed size")
 
-    downloaded_bytes = 0
-    content = ''
-    chunk_no = 0
+    return resp
 
-    if read_stream:
+def _iter_chunks(resp, size_limit, chunk_size, cut_off):
+    downloaded_bytes = 0
+    try:
         for chunk in resp.iter_content(chunk_size=chunk_size):
-            chunk_no += 1
-            downloaded_bytes += len(bytes(chunk))
+            downloaded_bytes += len(chunk)
 
             # check the size limit again
             if size_limit > 0 and downloaded_bytes > size_limit:
-                resp.connection.close()
                 raise SizeExceededException("Size limit exceeded during download")
             if chunk:  # filter out keep-alive new chunks
-                content += chunk
+                yield chunk
 
             # now check to see if we have exceeded the cut off point
             if cut_off > 0 and downloaded_bytes >= cut_off:
                 break
+    finally:
+        resp.close()
+
+def _stream_defaults(size_limit, chunk_size, cut_off):
+    if size_limit is None:
+        size_limit = app.config.get("HTTP_STREAM_MAX_SIZE", 0)  # size of 0 means no limit
 
-        resp.connection.close()
+    if cut_off is None:
+        cut_off = app.config.get("HTTP_STREAM_CUT_OFF", 0)  # size of 0 means no limit
+
+    if chunk_size is None:
+        chunk_size = app.config.get("HTTP_STREAM_CHUNK_SIZE", 262144)   # 250Kb
+
+    return size_limit, chunk_size, cut_off
+
+def get_stream(url, retries=None, back_off_factor=None, max_back_off=None, timeout=None, response_encoding=None,
+        retry_on_timeout=None, retry_codes=None, size_limit=None, chunk_size=None, cut_off=None, read_stream=True,
+        write_to=None, **kwargs):
+    """
+    Download the content at the url, subject to the size limit and cut off.
+
+    If write_to is a file-like object, each chunk is written to it as it arrives, and the
+    returned content is empty.  Otherwise the whole content is returned as a string.
+
+    :return: (response, content, downloaded_bytes)
+    """
+    size_limit, chunk_size, cut_off = _stream_defaults(size_limit, chunk_size, cut_off)
+
+    resp = _open_stream(url,
+             retries=retries, back_off_factor=back_off_factor,
+             max_back_off=max_back_off,
+             timeout=timeout,
+             response_encoding=response_encoding,
+             retry_on_timeout=retry_on_timeout,
+             retry_codes=retry_codes,
+             size_limit=size_limit,
+             **kwargs)
+
+    if resp is None:
+        return None, "", 0
+
+    downloaded_bytes = 0
+    content = ''
+
+    if read_stream:
+        parts = []
+        for chunk in _iter_chunks(resp, size_limit, chunk_size, cut_off):
+            downloaded_bytes += len(chunk)
+            if write_to is not None:
+                write_to.write(chunk)
+            else:
+                parts.append(chunk)
+        content = "".join(parts)
 
     return resp, content, downloaded_bytes
 
+def iter_stream(url, retries=None, back_off_factor=None, max_back_off=None, timeout=None, response_encoding=None,
+        retry_on_timeout=None, retry_codes=None, size_limit=None, chunk_size=None, cut_off=None, method="GET", **kwargs):
+    """
+    Stream the content at the url without holding it in memory, subject to the size limit and cut off.
+
+    The request is a GET unless another method is given (e.g. method="POST", with the body as data).  The
+    connection is released when the chunk iterator is exhausted or closed.  SizeExceededException is raised
+    from the iterator if the size limit is exceeded part way through the download.
+
+    :return: (response, chunk iterator)
+    """
+    size_limit, chunk_size, cut_off = _stream_defaults(size_limit, chunk_size, cut_off)
+
+    resp = _open_stream(url,
+             retries=retries, back_off_factor=back_off_factor,
+             max_back_off=max_back_off,
+             timeout=timeout,
+             response_encoding=response_encoding,
+             retry_on_timeout=retry_on_timeout,
+             retry_codes=retry_codes,
+             size_limit=size_limit,
+             method=method,
+             **kwargs)
+
+    if resp is None:
+        return None, iter([])
+
+    return resp, _iter_chunks(resp, size_limit, chunk_size, cut_off)
+
 ######################################################
 # Mock requests Response object - useful for testing
 
@@ -213,6 +416,9 @@ class MockResponse(object):
         self._headers = headers
         self._stream = StringIO(body)
 
+    def close(self):
+        pass
+
     def json(self):
         return json.loads(self._body)
 
@@ -228,9 +434,9 @@ class MockResponse(object):
     def headers(self):
         return self._headers if self._headers is not None else {}
 
-    def iter_content(self, num_bytes):
+    def iter_content(self, chunk_size=1):
         while True:
-            b = self._stream.read(num_bytes)
+            b = self._stream.read(chunk_size)
             if b == "":
                 # we have reached the end of the file
                 break
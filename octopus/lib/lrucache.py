@@ -0,0 +1,64 @@
+import threading, time
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    In-process, thread-safe LRU cache, holding up to size entries, each of which expires ttl seconds after
+    it was added.  Counts hits, misses and evictions so that the effectiveness of the cache can be monitored.
+
+    get() returns None on a miss, so None itself cannot usefully be cached.
+    """
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or (entry[0] is not None and entry[0] < time.time()):
+                self.misses += 1
+                return None
+            # re-insert, so that this is now the most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def generation(self):
+        return self._generation
+
+    def put(self, key, value, generation=None):
+        with self._lock:
+            # if there has been an invalidation since the value was read, it may be stale
+            if generation is not None and generation != self._generation:
+                return
+            expires = time.time() + self.ttl if self.ttl is not None else None
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size" : len(self._data),
+                "max_size" : self.size,
+                "ttl" : self.ttl,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions
+            }
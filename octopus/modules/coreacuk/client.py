@@ -25,6 +25,14 @@ class Core(object):
     def by_doi(self, doi, page_size=10, page=1):
         return self.search('doi:"' + doi + '"', page_size=page_size, page=page)
 
+    def by_dois(self, dois, page_size=10, concurrency=None):
+        """
+        :return: generator of (doi, search_result, exception) in the order given
+        """
+        def _by_doi(doi):
+            return self.by_doi(doi, page_size=page_size)
+        return http.map_concurrent(_by_doi, dois, concurrency=concurrency)
+
     def search(self, search_string, page_size=10, page=1):
         # sort out the page size, which must be 10 or more
         if page_size < 10:
@@ -78,6 +78,16 @@ class DOAJv1API(object):
         qb.add_string_field(field, value, quote)
         return self.built_search(type, qb, page=page, page_size=page_size, sort_by=sort_by, sort_dir=sort_dir)
 
+    def field_search_many(self, type, field, values, quote=True, page_size=10, concurrency=None):
+        """
+        Run the same field search for each of the values concurrently (e.g. look up a list of ISSNs)
+
+        :return: generator of (value, results, exception) in the order given
+        """
+        def _search(value):
+            return self.field_search(type, field, value, quote=quote, page_size=page_size)
+        return http.map_concurrent(_search, values, concurrency=concurrency)
+
     def built_search(self, type, query_builder, page=1, page_size=10, sort_by=None, sort_dir=None):
         return self.string_search(type, query_builder.make_query(), page=page, page_size=page_size, sort_by=sort_by, sort_dir=sort_dir)
 
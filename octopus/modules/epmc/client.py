@@ -70,6 +70,27 @@ class EuropePMC(object):
     def get_by_doi(cls, doi, cursor=""):
         return cls.field_search("DOI", doi, cursor=cursor)
 
+    @classmethod
+    def get_by_pmcid_many(cls, pmcids, concurrency=None):
+        """
+        :return: generator of (pmcid, (results, next_cursor), exception) in the order given
+        """
+        return http.map_concurrent(cls.get_by_pmcid, pmcids, concurrency=concurrency)
+
+    @classmethod
+    def get_by_pmid_many(cls, pmids, concurrency=None):
+        """
+        :return: generator of (pmid, (results, next_cursor), exception) in the order given
+        """
+        return http.map_concurrent(cls.get_by_pmid, pmids, concurrency=concurrency)
+
+    @classmethod
+    def get_by_doi_many(cls, dois, concurrency=None):
+        """
+        :return: generator of (doi, (results, next_cursor), exception) in the order given
+        """
+        return http.map_concurrent(cls.get_by_doi, dois, concurrency=concurrency)
+
     @classmethod
     def title_exact(cls, title, cursor=""):
         return cls.field_search("TITLE", title, cursor=cursor)
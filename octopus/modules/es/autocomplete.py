@@ -1,14 +1,177 @@
 from octopus.core import app
 
 import esprit
-import json
+import json, bisect, heapq, threading, time, os
 
 from flask import Blueprint, request, abort, make_response
 
 from octopus.lib import webapp, plugin
+from octopus.modules.es.dao import _project
 
 blueprint = Blueprint('autocomplete', __name__)
 
+###############################################
+## In-memory prefix indices
+
+class PrefixIndex(object):
+    """
+    Immutable sorted array of (key, payload) pairs, which can be searched for keys which start with,
+    end with, contain or equal a query string.
+    """
+    def __init__(self, entries):
+        entries = sorted(entries, key=lambda e: e[0])
+        self._keys = [e[0] for e in entries]
+        self._payloads = [e[1] for e in entries]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def matches(self, q, start_wildcard=False, end_wildcard=True):
+        """
+        List the (key, payload) pairs matching q in the same way as an ES wildcard query with the
+        same leading/trailing wildcards, in key order
+        """
+        q = q.strip("*")
+        if start_wildcard:
+            if end_wildcard:
+                test = lambda k: q in k
+            else:
+                test = lambda k: k.endswith(q)
+            return [(k, p) for k, p in zip(self._keys, self._payloads) if test(k)]
+
+        # otherwise the key must start with q, so we only need to look at that part of the array
+        results = []
+        i = bisect.bisect_left(self._keys, q)
+        while i < len(self._keys) and self._keys[i].startswith(q):
+            if end_wildcard or self._keys[i] == q:
+                results.append((self._keys[i], self._payloads[i]))
+            i += 1
+        return results
+
+class BackgroundIndex(object):
+    """
+    Holds the result of calling build(), which is re-run in a background thread every refresh seconds.
+    Until the first build has finished the index is cold, and get() returns None.
+    """
+    def __init__(self, name, build, refresh):
+        self.name = name
+        self.refresh = refresh
+        self._build = build
+        self._value = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        self._ensure_running()
+        return self._value
+
+    def rebuild(self):
+        start = time.time()
+        value = self._build()
+        if value is not None:
+            self._value = value
+        app.logger.debug(u"Rebuilt autocomplete index {x} in {y}s".format(x=self.name, y=round(time.time() - start, 3)))
+
+    def _ensure_running(self):
+        # threads don't survive a fork, so each process needs its own
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="autocomplete-" + self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.rebuild()
+            except Exception:
+                app.logger.exception(u"Unable to build autocomplete index {x}".format(x=self.name))
+            time.sleep(self.refresh)
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+def _get_index(kind, config_name, cfg, build):
+    icfg = cfg.get("prefix_index")
+    if icfg is None:
+        return None
+
+    key = (kind, config_name)
+    index = _indices.get(key)
+    if index is None:
+        with _indices_lock:
+            index = _indices.get(key)
+            if index is None:
+                index = BackgroundIndex(kind + "/" + config_name, lambda: build(cfg), icfg.get("refresh", 3600))
+                _indices[key] = index
+    return index.get()
+
+def _build_term_index(cfg):
+    # every term in the facet, with its count as the payload
+    facet = cfg.get("facet")
+    dao_klass = plugin.load_class(cfg.get("dao"))
+    size = cfg.get("prefix_index", {}).get("max_terms", 100000)
+    query = {"query" : {"match_all" : {}}, "size" : 0, "facets" : {facet : {"terms" : {"field" : facet, "size" : size}}}}
+    res = dao_klass.query(q=query)
+    terms = esprit.raw.get_facet_terms(res, facet)
+
+    # if we might not have every term, the index would silently miss the rarer ones
+    other = res.get("facets", {}).get(facet, {}).get("other", 0)
+    if other > 0 or len(terms) >= size:
+        app.logger.warn(u"More than {x} terms for autocomplete on {y}; not using an in-memory index".format(x=size, y=facet))
+        return None
+    return PrefixIndex([(t.get("term"), t.get("count", 0)) for t in terms])
+
+def _source_path(field):
+    if field.endswith(".exact"):
+        return field[:-len(".exact")]
+    return field
+
+def _build_compound_index(cfg):
+    # the records (limited to the configured fields), and an index for each filter field of its
+    # values, with the position of the record they came from as the payload
+    dao_klass = plugin.load_class(cfg.get("dao"))
+    max_records = cfg.get("prefix_index", {}).get("max_records", 50000)
+    fields = cfg.get("fields", [])
+    filters = cfg.get("filters", {})
+    paths = list(set(fields + [_source_path(f) for f in filters.keys()]))
+
+    records = []
+    entries = dict([(f, []) for f in filters.keys()])
+    for raw in dao_klass.stream(q={"query" : {"match_all" : {}}}, source=paths, wrap=False):
+        if len(records) >= max_records:
+            app.logger.warn(u"More than {x} records for compound autocomplete; not using an in-memory index".format(x=max_records))
+            return None
+        for f in filters.keys():
+            val = raw
+            for p in _source_path(f).split("."):
+                val = val.get(p) if isinstance(val, dict) else None
+            vals = val if isinstance(val, list) else [val]
+            for v in vals:
+                if isinstance(v, basestring):
+                    entries[f].append((v, len(records)))
+        records.append(_project(raw, fields))
+
+    return records, dict([(f, PrefixIndex(e)) for f, e in entries.iteritems()])
+
+def _compound_from_index(index, q, filters, size):
+    records, field_indices = index
+
+    # score each record as the total boost of the fields it matches on, as the should query would
+    scores = {}
+    for field, params in filters.iteritems():
+        matched = set([p for k, p in field_indices[field].matches(q, params.get("start_wildcard", True), params.get("end_wildcard", True))])
+        for i in matched:
+            scores[i] = scores.get(i, 0) + params.get("boost", 1.0)
+
+    best = heapq.nsmallest(size, scores.keys(), key=lambda i: (-scores[i], i))
+    return [records[i] for i in best]
+
 @blueprint.route("/term/<config_name>")
 @webapp.jsonp
 def term(config_name):
@@ -61,6 +224,15 @@ def term(config_name):
         abort(500)
     query["facets"] = {facet : {"terms" : {"field" : facet, "size" : size}}}
 
+    # if there is a warm in-memory index of the facet terms, answer from that
+    index = _get_index("term", config_name, cfg, _build_term_index)
+    if index is not None:
+        matches = index.matches(q, params.get("start_wildcard", True), params.get("end_wildcard", True))
+        records = [k for k, count in heapq.nlargest(size, matches, key=lambda m: m[1])]
+        resp = make_response(json.dumps(records))
+        resp.mimetype = "application/json"
+        return resp
+
     # get the name of the model that will handle this query, and then look up
     # the class that will handle it
     dao_name = cfg.get("dao")
@@ -136,16 +308,24 @@ def compound(config_name):
         abort(500)
     query[fields_key] = fields
 
-    # get the name of the model that will handle this query, and then look up
-    # the class that will handle it
-    dao_name = cfg.get("dao")
-    dao_klass = plugin.load_class(dao_name)
-    if dao_klass is None:
-        abort(500)
+    # if there is a warm in-memory index of the records, answer from that
+    index = _get_index("compound", config_name, cfg, _build_compound_index)
+    if index is not None:
+        records = _compound_from_index(index, q, filters, size)
+    else:
+        records = None
 
-    # issue the query
-    res = dao_klass.query(q=query)
-    records = esprit.raw.unpack_json_result(res)
+    if records is None:
+        # get the name of the model that will handle this query, and then look up
+        # the class that will handle it
+        dao_name = cfg.get("dao")
+        dao_klass = plugin.load_class(dao_name)
+        if dao_klass is None:
+            abort(500)
+
+        # issue the query
+        res = dao_klass.query(q=query)
+        records = esprit.raw.unpack_json_result(res)
 
     # rewrite the field names if necessary
     field_name_map = cfg.get("field_name_map")
@@ -4,10 +4,549 @@ from octopus.core import app
 import json as jsonlib
 from datetime import datetime
 import dateutil.relativedelta as relativedelta
-import os, threading
-from octopus.lib import plugin
+import os, threading, uuid, urllib, Queue, time, itertools, multiprocessing, re
+from copy import deepcopy
+from octopus.lib import plugin, http, dates, dataobj
+from octopus.lib.lrucache import LRUCache
 from octopus.modules.es.initialise import put_mappings, put_example
 
+class ESDAOException(Exception):
+    pass
+
+def _es_url(conn, path, params=None, index=True):
+    url = str(conn.host) + ":" + str(conn.port) + "/"
+    if index:
+        url += conn.index + "/"
+    url += path
+    if params:
+        url += "?" + urllib.urlencode(params)
+    return url
+
+def _es_version_tuple(version):
+    parts = []
+    for p in str(version if version is not None else "0.90.13").split(".")[:2]:
+        try:
+            parts.append(int(p))
+        except ValueError:
+            parts.append(0)
+    return tuple(parts)
+
+def _json_result(resp, action):
+    if resp is None:
+        raise ESDAOException(u"No response from index during {x}".format(x=action))
+    if resp.status_code != 200:
+        raise ESDAOException(u"{x} failed with status {y}: {z}".format(x=action, y=resp.status_code, z=resp.text))
+    return resp.json()
+
+def _project(doc, fields):
+    # pick just the (dot-notated) fields out of the document, for indices too old to do it themselves
+    out = {}
+    for field in fields:
+        parts = field.split(".")
+        val = doc
+        for p in parts:
+            if not isinstance(val, dict) or p not in val:
+                val = None
+                break
+            val = val[p]
+        if val is None:
+            continue
+        context = out
+        for p in parts[:-1]:
+            context = context.setdefault(p, {})
+        context[parts[-1]] = val
+    return out
+
+def _scroll_docs(conn, types, q, page_size, keepalive, source, slc, esv, hits_only=False):
+    query = deepcopy(q) if q is not None else {"query" : {"match_all" : {}}}
+    query["size"] = page_size
+    params = {"scroll" : keepalive}
+
+    # before ES 2.x, scan is the efficient way to scroll (and it returns no hits on the first request), but
+    # it can't be sorted; after that, sorting by _doc does the same job
+    scan = esv < (2, 0) and "sort" not in query
+    if scan:
+        params["search_type"] = "scan"
+    elif "sort" not in query:
+        query["sort"] = ["_doc"]
+
+    # before ES 1.x there is no source filtering, so we do it ourselves
+    project = source is not None and esv < (1, 0)
+    if source is not None and not project:
+        query["_source"] = source
+    if slc is not None:
+        query["slice"] = slc
+
+    resp = http.post(_es_url(conn, ",".join(types) + "/_search", params), data=jsonlib.dumps(query))
+    result = _json_result(resp, "scroll")
+    scroll_id = result.get("_scroll_id")
+
+    try:
+        first = True
+        while True:
+            hits = result.get("hits", {}).get("hits", [])
+            if len(hits) == 0 and not (first and scan):
+                break
+            first = False
+
+            for hit in hits:
+                if hits_only:
+                    yield hit
+                    continue
+                doc = hit.get("_source", {})
+                yield _project(doc, source) if project else doc
+
+            result = _json_result(_scroll_next(conn, scroll_id, keepalive, esv), "scroll")
+            scroll_id = result.get("_scroll_id", scroll_id)
+    finally:
+        # release the scroll context on the server rather than waiting for it to time out
+        _scroll_clear(conn, scroll_id, esv)
+
+def _scroll_next(conn, scroll_id, keepalive, esv):
+    if esv < (2, 0):
+        return http.post(_es_url(conn, "_search/scroll", {"scroll" : keepalive}, index=False), data=scroll_id)
+    return http.post(_es_url(conn, "_search/scroll", index=False), data=jsonlib.dumps({"scroll" : keepalive, "scroll_id" : scroll_id}))
+
+def _scroll_clear(conn, scroll_id, esv):
+    try:
+        if esv < (2, 0):
+            http.delete(_es_url(conn, "_search/scroll/" + scroll_id, index=False))
+        else:
+            http.delete(_es_url(conn, "_search/scroll", index=False), data=jsonlib.dumps({"scroll_id" : [scroll_id]}))
+    except Exception:
+        pass
+
+def _parallel_scroll(conn, types, q, page_size, keepalive, source, slices, esv):
+    # hold at most a page of documents in memory, whatever the number of slices
+    queue = Queue.Queue(maxsize=page_size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def worker(i):
+        error = None
+        docs = _scroll_docs(conn, types, q, page_size, keepalive, source, {"id" : i, "max" : slices}, esv)
+        try:
+            for doc in docs:
+                if not put((doc, None)):
+                    break
+        except Exception as e:
+            error = e
+        finally:
+            docs.close()
+            put((done, error))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(slices)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    try:
+        finished = 0
+        while finished < slices:
+            doc, error = queue.get()
+            if doc is done:
+                finished += 1
+                if error is not None:
+                    raise error
+                continue
+            yield doc
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+class BulkWriter(object):
+    """
+    Buffers DAO objects and writes them to the index with the _bulk API, in chunks limited by
+    both the number of records and the size of the serialised request body.
+
+    Use as a context manager, so that anything left in the buffer is written on exit:
+
+        with MyDAO.bulk_writer() as writer:
+            for obj in objects:
+                writer.add(obj)
+        failed = writer.failures
+
+    failures is a list of (object, error) tuples for the records which could not be written,
+    after any retries.
+    """
+    def __init__(self, klazz, chunk_size=None, chunk_bytes=None, refresh=False, retries=None,
+                 conn=None, type=None, makeid=True, created=True, updated=True):
+        self.klazz = klazz
+        self.chunk_size = chunk_size if chunk_size is not None else app.config.get("ESDAO_BULK_CHUNK_SIZE", 500)
+        self.chunk_bytes = chunk_bytes if chunk_bytes is not None else app.config.get("ESDAO_BULK_CHUNK_BYTES", 5 * 1024 * 1024)
+        self.refresh = refresh
+        self.retries = retries if retries is not None else app.config.get("ESDAO_BULK_RETRIES", 2)
+        self.retry_statuses = app.config.get("ESDAO_BULK_RETRY_STATUSES", [429, 503])
+        self.conn = conn if conn is not None else klazz.__conn__
+        self.type = type if type is not None else klazz.get_write_type()
+        self.makeid = makeid
+        self.created = created
+        self.updated = updated
+
+        self.failures = []
+        self.written = 0
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def add(self, obj):
+        """
+        Prepare the object for saving, and add it to the buffer.  The buffer is written if this
+        takes it over either of the chunk limits.
+        """
+        if isinstance(obj, dataobj.DataObj):
+            obj.validate_all()
+        obj.prep()
+        now = dates.now()
+        if self.makeid and obj.data.get("id") is None:
+            obj.data["id"] = uuid.uuid4().hex
+        if self.created and "created_date" not in obj.data:
+            obj.data["created_date"] = now
+        if self.updated:
+            obj.data["last_updated"] = now
+
+        self.klazz.invalidate_pull_cache(obj.data["id"])
+        self._append(_BulkEntry(obj))
+        if isinstance(obj, dataobj.DataObj):
+            obj.mark_clean()
+
+    def add_changes(self, obj):
+        """
+        Add an update for just the fields of the object which have changed since it was loaded (see
+        ESDAO.save_changes) to the buffer.  Objects which must be written in full are passed to add(),
+        and objects with no changes are skipped.
+        """
+        changes = obj.changes() if isinstance(obj, dataobj.DataObj) else None
+        if changes is None or obj.data.get("id") is None:
+            return self.add(obj)
+        if len(changes) == 0:
+            return
+
+        obj.prep()
+        changes = obj.changes()
+        if changes is None:
+            return self.add(obj)
+        if self.updated:
+            obj.data["last_updated"] = changes["last_updated"] = dates.now()
+
+        self.klazz.invalidate_pull_cache(obj.data["id"])
+        self._append(_BulkEntry(obj, changes))
+        obj.mark_clean()
+
+    def _append(self, entry):
+        self._buffer.append(entry)
+        self._buffer_bytes += entry.size
+        if len(self._buffer) >= self.chunk_size or self._buffer_bytes >= self.chunk_bytes:
+            self.flush()
+
+    def flush(self, refresh=False):
+        """
+        Write everything in the buffer to the index, retrying only the records which failed
+        with a retryable status
+        """
+        entries = self._buffer
+        self._buffer = []
+        self._buffer_bytes = 0
+
+        attempt = 0
+        while len(entries) > 0:
+            # give an overloaded index time to recover before sending the rejected records again
+            if attempt > 0:
+                time.sleep(http._backoff(attempt, app.config.get("HTTP_BACK_OFF_FACTOR", 1), app.config.get("HTTP_MAX_BACK_OFF", 30)))
+            retry = []
+            for entry, error, retryable in self._send(entries, refresh=refresh):
+                if error is None:
+                    self.written += 1
+                elif retryable and attempt < self.retries:
+                    retry.append(entry)
+                else:
+                    self.failures.append((entry.obj, error))
+            entries = retry
+            attempt += 1
+
+    def close(self):
+        self.flush(refresh=self.refresh)
+
+    def _send(self, entries, refresh=False):
+        body = "".join([e.line for e in entries])
+        params = {"refresh" : "true"} if refresh else None
+        url = _es_url(self.conn, self.type + "/_bulk", params)
+        with _Timer(self.klazz, "bulk", size=len(body)):
+            resp = http.post(url, data=body, headers={"Content-Type" : "application/x-ndjson"})
+
+        # if the request as a whole failed, then so did every record in it
+        if resp is None:
+            return [(e, "no response from index", True) for e in entries]
+        if resp.status_code >= 400:
+            error = "bulk request failed with status {x}".format(x=resp.status_code)
+            return [(e, error, resp.status_code in self.retry_statuses) for e in entries]
+
+        items = resp.json().get("items", [])
+        results = []
+        for entry, item in zip(entries, items):
+            result = item.values()[0] if len(item) > 0 else {}
+            error = result.get("error")
+            if error is None and result.get("status", 200) >= 400:
+                error = "status {x}".format(x=result.get("status"))
+            status = result.get("status")
+            retryable = status in self.retry_statuses or (error is not None and "EsRejectedExecution" in unicode(error))
+            results.append((entry, error, retryable))
+
+        # anything the index didn't report on we have to assume was not written
+        for entry in entries[len(items):]:
+            results.append((entry, "no result reported by index", True))
+        return results
+
+_DATE_MATH = re.compile(r"^now((?:[+-]\d+[yMwdhHms])*)$")
+_DATE_MATH_OP = re.compile(r"([+-])(\d+)([yMwdhHms])")
+_DATE_MATH_UNITS = {"y" : "years", "M" : "months", "w" : "weeks", "d" : "days", "h" : "hours", "H" : "hours", "m" : "minutes", "s" : "seconds"}
+
+def _parse_range_date(val):
+    # returns None if we can't be sure what date ES would take this to mean
+    if isinstance(val, (int, long, float)):
+        return datetime.utcfromtimestamp(val / 1000.0)
+    if not isinstance(val, basestring):
+        return None
+    m = _DATE_MATH.match(val.strip())
+    if m is not None:
+        d = datetime.utcnow()
+        for sign, n, unit in _DATE_MATH_OP.findall(m.group(1)):
+            delta = relativedelta.relativedelta(**{_DATE_MATH_UNITS[unit] : int(n)})
+            d = d + delta if sign == "+" else d - delta
+        return d
+    for fmt in app.config.get("DATE_FORMATS", []):
+        try:
+            return datetime.strptime(val, fmt)
+        except ValueError:
+            continue
+    return None
+
+def _required_ranges(q, fields):
+    # yields the range clauses on the fields which every matching record must satisfy.  Only clauses
+    # which are required (query, must, filter, and) are followed, not should, must_not, not or or
+    if isinstance(q, list):
+        for sub in q:
+            for r in _required_ranges(sub, fields):
+                yield r
+        return
+    if not isinstance(q, dict):
+        return
+    for key, val in q.iteritems():
+        if key == "range":
+            for f in fields:
+                if f in val:
+                    yield val[f]
+        elif key == "bool":
+            for k in ["must", "filter"]:
+                for r in _required_ranges(val.get(k), fields):
+                    yield r
+        elif key in ["query", "filter", "filtered", "constant_score", "and", "filters"]:
+            for r in _required_ranges(val, fields):
+                yield r
+
+def _query_date_from(q, field):
+    """
+    Find the earliest date on the field which the query allows in its results.  Upper bounds are not looked at,
+    since they can't be used to prune time boxes (see TimeBoxedTypeESDAO.read_types_since).
+
+    Only the main query is considered (not, for example, a 0.90 top-level filter, which doesn't apply to the facets).
+
+    :return: datetime, or None if unbounded
+    """
+    fro = None
+    if not isinstance(q, dict):
+        return fro
+    for clause in _required_ranges(q.get("query"), [field, field + ".exact"]):
+        # we can't be sure how the index will read dates in another zone or format, so don't use them
+        if "time_zone" in clause or "format" in clause:
+            continue
+        for k in ["gte", "gt", "from"]:
+            d = _parse_range_date(clause.get(k))
+            if d is not None and (fro is None or d > fro):
+                fro = d
+    return fro
+
+# the pull caches for each DAO class which has one, created on first use
+_pull_caches = {}
+_pull_caches_lock = threading.Lock()
+
+class _BulkEntry(object):
+    def __init__(self, obj, changes=None):
+        self.obj = obj
+        if changes is None:
+            action = jsonlib.dumps({"index" : {"_id" : obj.data.get("id")}})
+            self.line = action + "\n" + jsonlib.dumps(obj.data) + "\n"
+        else:
+            action = jsonlib.dumps({"update" : {"_id" : obj.data.get("id")}})
+            self.line = action + "\n" + jsonlib.dumps({"doc" : changes}) + "\n"
+        self.size = len(self.line)
+
+######################################################
+# Timing instrumentation
+
+_timings = {}
+_timings_lock = threading.Lock()
+
+class _OpStats(object):
+    """
+    Running totals for one operation on one DAO class: a latency histogram (counts of calls taking up to
+    each of the bucket boundaries, in milliseconds), the request payload sizes and the numbers of hits.
+    Payloads which esprit serialises (query, count, scroll, stream and save) are not measured, so their
+    payload_bytes is None
+    """
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.histogram = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.payload_bytes = None
+        self.hits = 0
+        self.slow = 0
+
+    def record(self, elapsed, size=None, hits=None, slow=False):
+        ms = elapsed * 1000
+        i = 0
+        while i < len(self.buckets) and ms > self.buckets[i]:
+            i += 1
+        self.histogram[i] += 1
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+        if size is not None:
+            self.payload_bytes = (self.payload_bytes or 0) + size
+        if hits is not None:
+            self.hits += hits
+        if slow:
+            self.slow += 1
+
+    def as_dict(self):
+        labels = ["<=" + str(b) for b in self.buckets] + [">" + str(self.buckets[-1]) if len(self.buckets) > 0 else "all"]
+        return {
+            "count" : self.count,
+            "total_ms" : self.total,
+            "mean_ms" : self.total / self.count if self.count > 0 else None,
+            "min_ms" : self.min,
+            "max_ms" : self.max,
+            "histogram_ms" : dict(zip(labels, self.histogram)),
+            "payload_bytes" : self.payload_bytes,
+            "hits" : self.hits,
+            "slow" : self.slow
+        }
+
+def _record_timing(klazz, op, elapsed, body=None, size=None, hits=None, log_body=True):
+    if not app.config.get("ESDAO_TIMING", True):
+        return
+
+    threshold = app.config.get("ESDAO_SLOW_QUERY_THRESHOLD")
+    slow = threshold is not None and elapsed >= threshold
+
+    # bodies which esprit serialises for itself are not counted in the stats, as only those of the slow
+    # operations could be, and are only serialised again here to be logged
+    if size is None and isinstance(body, basestring):
+        size = len(body)
+
+    if slow:
+        logged, logged_size = body, size
+        if logged_size is None and body is not None:
+            try:
+                logged = jsonlib.dumps(body)
+                logged_size = len(logged)
+            except (TypeError, ValueError):
+                pass
+        if log_body:
+            app.logger.warn(u"Slow ES operation: {c}.{o} took {t:.3f}s; body: {b}".format(c=klazz.__name__, o=op, t=elapsed, b=logged))
+        else:
+            app.logger.warn(u"Slow ES operation: {c}.{o} took {t:.3f}s; body of {s} bytes".format(c=klazz.__name__, o=op, t=elapsed, s=logged_size))
+
+    key = (klazz.__name__, op)
+    with _timings_lock:
+        stats = _timings.get(key)
+        if stats is None:
+            stats = _OpStats(app.config.get("ESDAO_TIMING_BUCKETS", [10, 50, 100, 250, 500, 1000, 2500, 5000, 10000]))
+            _timings[key] = stats
+        stats.record(elapsed, size, hits, slow)
+
+class _Timer(object):
+    """
+    Times the block it wraps, and records it against the class and operation.  Set hits or size
+    on it inside the block to record those too.  If not log_body, a slow operation is logged without
+    its body (e.g. for whole documents)
+    """
+    def __init__(self, klazz, op, body=None, size=None, log_body=True):
+        self.klazz = klazz
+        self.op = op
+        self.body = body
+        self.hits = None
+        self.size = size
+        self.log_body = log_body
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _record_timing(self.klazz, self.op, time.time() - self.start, self.body, self.size, self.hits, self.log_body)
+        return False
+
+def _timed_iter(klazz, op, it, body=None):
+    # only the time spent getting the next record counts, not the time the caller spends on each one
+    elapsed = 0.0
+    count = 0
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = next(it)
+            except StopIteration:
+                elapsed += time.time() - start
+                break
+            elapsed += time.time() - start
+            count += 1
+            yield item
+    finally:
+        if hasattr(it, "close"):
+            it.close()
+        _record_timing(klazz, op, elapsed, body, hits=count)
+
+def _hit_count(result):
+    try:
+        return len(result.get("hits", {}).get("hits", []))
+    except AttributeError:
+        return None
+
+def timing_stats():
+    """
+    Get the timings recorded so far in this process, as {"<DAO class>" : {"<operation>" : {...}}}
+    """
+    with _timings_lock:
+        out = {}
+        for (klazz, op), stats in _timings.iteritems():
+            out.setdefault(klazz, {})[op] = stats.as_dict()
+        return out
+
+def reset_timings():
+    with _timings_lock:
+        _timings.clear()
+
 class ESInstanceDAO(esprit.dao.DAO):
     def __init__(self, type=None, raw=None, *args, **kwargs):
         self._conn = esprit.raw.Connection(app.config.get('ELASTIC_SEARCH_HOST'), app.config.get('ELASTIC_SEARCH_INDEX'))
@@ -49,6 +588,11 @@ class ESDAO(esprit.dao.DomainObject):
     __conn__ = esprit.raw.Connection(app.config.get('ELASTIC_SEARCH_HOST'), app.config.get('ELASTIC_SEARCH_INDEX'))
     __es_version__ = app.config.get("ELASTIC_SEARCH_VERSION")
 
+    # maximum number of records to hold in this class's pull cache (None or 0 for no cache), and
+    # how many seconds they may be held for.  If not set, these are read from ESDAO_PULL_CACHE
+    __pull_cache_size__ = None
+    __pull_cache_ttl__ = None
+
     def __init__(self, *args, **kwargs):
         super(ESDAO, self).__init__(*args, **kwargs)
 
@@ -56,19 +600,491 @@ class ESDAO(esprit.dao.DomainObject):
     ## overrides on Domain Object
 
     @classmethod
-    def delete_by_query(cls, query, conn=None, es_version="0.90.13", type=None):
+    def delete_by_query(cls, query, conn=None, es_version="0.90.13", type=None, throttled=None, **kwargs):
+        """
+        Delete everything that matches the query.
+
+        If throttled (or ESDAO_THROTTLED_DELETE is set), this uses throttled_delete_by_query, to which
+        any further keyword arguments are passed, and returns its result
+        """
+        if throttled is None:
+            throttled = app.config.get("ESDAO_THROTTLED_DELETE", False)
+        if throttled:
+            return cls.throttled_delete_by_query(query, conn=conn, type=type, **kwargs)
+
         esv = cls.__es_version__
         if esv is None:
             esv = es_version
         super(ESDAO, cls).delete_by_query(query, conn=conn, es_version=esv, type=type)
+        cls.invalidate_pull_cache()
+
+    @classmethod
+    def query(cls, q='', *args, **kwargs):
+        with _Timer(cls, "query", q) as t:
+            res = super(ESDAO, cls).query(q, *args, **kwargs)
+            t.hits = _hit_count(res)
+        return res
+
+    @classmethod
+    def count(cls, q, *args, **kwargs):
+        with _Timer(cls, "count", q):
+            return super(ESDAO, cls).count(q, *args, **kwargs)
+
+    @classmethod
+    def scroll(cls, q=None, *args, **kwargs):
+        return _timed_iter(cls, "scroll", super(ESDAO, cls).scroll(q, *args, **kwargs), q)
+
+    @classmethod
+    def get_read_types(cls, *args, **kwargs):
+        with _Timer(cls, "read_types"):
+            return super(ESDAO, cls).get_read_types(*args, **kwargs)
+
+    @classmethod
+    def get_write_type(cls, *args, **kwargs):
+        with _Timer(cls, "write_type"):
+            return super(ESDAO, cls).get_write_type(*args, **kwargs)
+
+    @classmethod
+    def pull(cls, id_, conn=None, wrap=True, types=None):
+        with _Timer(cls, "pull") as t:
+            obj = cls._pull(id_, conn=conn, wrap=wrap, types=types)
+            t.hits = 1 if obj is not None else 0
+        return obj
+
+    @classmethod
+    def _pull(cls, id_, conn=None, wrap=True, types=None):
+        # only pulls from the default connection and types are cached
+        cache = cls.pull_cache()
+        if cache is None or conn is not None or types is not None or id_ is None:
+            return super(ESDAO, cls).pull(id_, conn=conn, wrap=wrap, types=types)
+
+        raw = cache.get(id_)
+        if raw is None:
+            generation = cache.generation()
+            raw = super(ESDAO, cls).pull(id_, wrap=False)
+            if raw is None:
+                return None
+            cache.put(id_, raw, generation)
+
+        # hand out copies, so that changes to the object do not change the cache
+        raw = deepcopy(raw)
+        return cls(raw) if wrap else raw
 
     def save(self, **kwargs):
+        # anything in a lazily constructed DataObj must be checked before it is written
+        if isinstance(self, dataobj.DataObj):
+            self.validate_all()
+        self.prep()
+        with _Timer(self.__class__, "save", self.data, log_body=False):
+            super(ESDAO, self).save(**kwargs)
+        self.invalidate_pull_cache(self.data.get("id"))
+        if isinstance(self, dataobj.DataObj):
+            self.mark_clean()
+
+    def save_changes(self, conn=None, type=None, updated=True, refresh=False):
+        """
+        Write just the fields which have changed since the object was loaded (or last saved) to the index, with a
+        partial _update, rather than re-sending the whole document.  Only changes made through the DataObj
+        properties, getters and setters are known about - anything which changes self.data directly (including
+        prep()) must use save().
+
+        The whole object is saved instead if it is not a DataObj, has no id, has had anything deleted from it
+        or its data replaced, or is not in the index.  If nothing has changed, nothing is written.
+
+        :param conn: connection to use, if not the class's
+        :param type: type to write to, if not the write type
+        :param updated: whether to set last_updated
+        :param refresh: whether to refresh the index after the update
+        """
+        changes = self.changes() if isinstance(self, dataobj.DataObj) else None
+        if changes is None or self.data.get("id") is None:
+            return self.save(conn=conn, type=type, updated=updated, blocking=refresh)
+        if len(changes) == 0:
+            return
+
         self.prep()
-        super(ESDAO, self).save(**kwargs)
+        changes = self.changes()
+        if changes is None:
+            return self.save(conn=conn, type=type, updated=updated, blocking=refresh)
+        if updated:
+            self.data["last_updated"] = changes["last_updated"] = dates.now()
+
+        conn = conn if conn is not None else self.__conn__
+        type = type if type is not None else self.get_write_type()
+        params = {"refresh" : "true"} if refresh else None
+        url = _es_url(conn, type + "/" + urllib.quote(unicode(self.data["id"]).encode("utf-8"), "") + "/_update", params)
+        body = jsonlib.dumps({"doc" : changes})
+        with _Timer(self.__class__, "update", body, log_body=False):
+            resp = http.post(url, data=body)
+
+        # the record has never been written (or has been removed since), so there is nothing to update
+        if resp is not None and resp.status_code == 404:
+            return self.save(conn=conn, type=type, updated=updated, blocking=refresh)
+        _json_result(resp, "update")
+
+        self.invalidate_pull_cache(self.data["id"])
+        self.mark_clean()
+
+    def delete(self, *args, **kwargs):
+        with _Timer(self.__class__, "delete"):
+            super(ESDAO, self).delete(*args, **kwargs)
+        self.invalidate_pull_cache(self.data.get("id"))
 
     ######################################################
     ## Octopus specific functions
 
+    @classmethod
+    def bulk_save(cls, objects, chunk_size=None, chunk_bytes=None, refresh=False, retries=None, **kwargs):
+        """
+        Save an iterable of objects of this class using the _bulk API.  prep() is called on each object,
+        and id, created_date and last_updated are set as they would be by save().
+
+        :param objects: iterable of objects to save
+        :param chunk_size: maximum number of records per bulk request
+        :param chunk_bytes: maximum size in bytes of each bulk request body (a single record larger than this is sent on its own)
+        :param refresh: whether to refresh the index after the final request
+        :param retries: number of times to retry the records which failed with a retryable status
+        :param kwargs: conn, type, makeid, created, updated as for save()
+        :return: list of (object, error) tuples for the records which could not be saved
+        """
+        with cls.bulk_writer(chunk_size=chunk_size, chunk_bytes=chunk_bytes, refresh=refresh, retries=retries, **kwargs) as writer:
+            for obj in objects:
+                writer.add(obj)
+        return writer.failures
+
+    @classmethod
+    def bulk_writer(cls, **kwargs):
+        return BulkWriter(cls, **kwargs)
+
+    @classmethod
+    def throttled_delete_by_query(cls, query, batch_size=None, rate=None, progress=None, refresh=False, retries=None, conn=None, type=None):
+        """
+        Delete everything that matches the query, by scrolling through the ids of the matching records and
+        deleting them with the _bulk API a batch at a time.  Unlike the index's own delete by query, this
+        only puts a batch's worth of work on the index at once, and can be paced with rate.
+
+        :param query: query whose results are to be deleted
+        :param batch_size: number of records to delete with each bulk request
+        :param rate: maximum number of bulk requests to make per second (None for no limit)
+        :param progress: function called after each batch with a dict of the number of records deleted and failed so far
+        :param refresh: whether to refresh the index at the end
+        :param retries: how many times to retry a batch which fails with one of ESDAO_BULK_RETRY_STATUSES
+        :param conn: connection to use, if not the class's default
+        :param type: type to delete from, if not the write type
+        :return: dict of the number of records deleted and failed
+        """
+        if conn is None:
+            conn = cls.__conn__
+        if type is None:
+            type = cls.get_write_type()
+        if batch_size is None:
+            batch_size = app.config.get("ESDAO_THROTTLED_DELETE_BATCH_SIZE", 1000)
+        if rate is None:
+            rate = app.config.get("ESDAO_THROTTLED_DELETE_RATE")
+        if retries is None:
+            retries = app.config.get("ESDAO_BULK_RETRIES", 2)
+        retry_statuses = app.config.get("ESDAO_BULK_RETRY_STATUSES", [429, 503])
+        keepalive = app.config.get("ESDAO_SCROLL_KEEPALIVE", "1m")
+
+        # we only need the ids, so strip everything else out of the query and the hits
+        esv = cls._es_version_tuple()
+        q = {"query" : query.get("query", {"match_all" : {}}) if query is not None else {"match_all" : {}}}
+        if esv < (1, 0):
+            q["fields"] = []
+        else:
+            q["_source"] = False
+
+        limiter = http._RateLimiter(rate) if rate else None
+        status = {"deleted" : 0, "failed" : 0}
+
+        def send(hits):
+            body = "".join([jsonlib.dumps({"delete" : {"_type" : h.get("_type", type), "_id" : h["_id"]}}) + "\n" for h in hits])
+            attempt = 0
+            while True:
+                if limiter is not None:
+                    limiter.wait()
+                resp = http.post(_es_url(conn, "_bulk"), data=body, headers={"Content-Type" : "application/x-ndjson"})
+                if resp is not None and resp.status_code < 400:
+                    break
+                if attempt >= retries or (resp is not None and resp.status_code not in retry_statuses):
+                    status["failed"] += len(hits)
+                    return
+                attempt += 1
+                time.sleep(http._backoff(attempt, app.config.get("HTTP_BACK_OFF_FACTOR", 1), app.config.get("HTTP_MAX_BACK_OFF", 30)))
+
+            # records which were already gone (404) don't count either way
+            for item in resp.json().get("items", []):
+                result = item.values()[0] if len(item) > 0 else {}
+                code = result.get("status", 200)
+                if code < 300:
+                    status["deleted"] += 1
+                elif code != 404:
+                    status["failed"] += 1
+
+        # the scroll works from a snapshot of the results, so it is unaffected by the deletes
+        hits = _scroll_docs(conn, [type], q, batch_size, keepalive, None, None, esv, hits_only=True)
+        try:
+            batch = []
+            for hit in hits:
+                batch.append(hit)
+                if len(batch) >= batch_size:
+                    send(batch)
+                    batch = []
+                    if progress is not None:
+                        progress(dict(status))
+            if len(batch) > 0:
+                send(batch)
+                if progress is not None:
+                    progress(dict(status))
+        finally:
+            hits.close()
+            cls.invalidate_pull_cache()
+
+        if refresh:
+            http.post(_es_url(conn, "_refresh"))
+        return status
+
+    @classmethod
+    def pull_many(cls, ids, chunk_size=None, types=None, wrap=True, conn=None):
+        """
+        Retrieve a list of records by id using _mget, chunk_size ids at a time.
+
+        The result is in the same order as the ids, with None for any id which could not be found.
+        Where there is more than one read type (e.g. for a TimeBoxedTypeESDAO), each id is looked for
+        in every type, and the first type in the read order to contain it wins.
+
+        :param ids: list of ids to retrieve
+        :param chunk_size: maximum number of ids to ask for in each request
+        :param types: types to read from, if not the default read types
+        :param wrap: whether to wrap each record in an instance of this class
+        :param conn: connection to use, if not the class's default
+        :return: list of records or None, one for each id
+        """
+        if conn is None:
+            conn = cls.__conn__
+        types = cls._read_type_list(types)
+        if chunk_size is None:
+            chunk_size = app.config.get("ESDAO_MGET_CHUNK_SIZE", 100)
+
+        # only ask for each id once, however many times it appears
+        unique = []
+        seen = set()
+        for id in ids:
+            if id is not None and id not in seen:
+                seen.add(id)
+                unique.append(id)
+
+        found = {}
+        for i in range(0, len(unique), chunk_size):
+            chunk = unique[i:i + chunk_size]
+            if len(types) == 1:
+                path = types[0] + "/_mget"
+                body = {"ids" : chunk}
+            else:
+                path = "_mget"
+                body = {"docs" : [{"_id" : id, "_type" : t} for id in chunk for t in types]}
+
+            body = jsonlib.dumps(body)
+            with _Timer(cls, "pull_many", body) as t:
+                resp = http.post(_es_url(conn, path), data=body)
+                result = _json_result(resp, "mget")
+                t.hits = len([d for d in result.get("docs", []) if d.get("found") or d.get("exists")])
+
+            # the docs come back in the order requested, so the first found for each id is in the preferred type
+            for doc in result.get("docs", []):
+                if (doc.get("found") or doc.get("exists")) and doc.get("_id") not in found:
+                    found[doc.get("_id")] = doc.get("_source")
+
+        records = []
+        for id in ids:
+            source = found.get(id)
+            if source is not None and wrap:
+                source = cls(source)
+            records.append(source)
+        return records
+
+    @classmethod
+    def scroll_page(cls, q=None, scroll_id=None, keepalive=None, types=None, conn=None):
+        """
+        Get a single page of a scroll through the results of a query, for when the pages are not all
+        retrieved by the same process (e.g. one per API request).
+
+        Call with q to start the scroll, then with the _scroll_id from each result to get the next page.
+
+        :return: the raw ES result
+        """
+        if conn is None:
+            conn = cls.__conn__
+        if keepalive is None:
+            keepalive = app.config.get("ESDAO_SCROLL_KEEPALIVE", "1m")
+
+        if scroll_id is not None:
+            resp = _scroll_next(conn, scroll_id, keepalive, cls._es_version_tuple())
+        else:
+            types = cls._read_type_list(types, q)
+            resp = http.post(_es_url(conn, ",".join(types) + "/_search", {"scroll" : keepalive}), data=jsonlib.dumps(q))
+        return _json_result(resp, "scroll")
+
+    @classmethod
+    def _scroll_clear(cls, scroll_id, conn=None):
+        # release a scroll context started by scroll_page which is not going to be read to the end
+        _scroll_clear(conn if conn is not None else cls.__conn__, scroll_id, cls._es_version_tuple())
+
+    @classmethod
+    def query_stream(cls, q=None, timeout=None, size_limit=None, chunk_size=None, types=None, conn=None):
+        """
+        Run a search, but hand back the raw response body as an iterator of chunks rather than reading
+        it all into memory, for passing the results of large queries straight on to a client.
+
+        The connection is taken from the shared pool, and is released when the iterator is exhausted or closed.
+
+        :param q: query to run (defaults to match_all)
+        :param timeout: seconds that ES may spend on the query before returning what it has.  The connection
+            itself is allowed twice this long, so that ES has the chance to send its partial results
+        :param size_limit: maximum size of the response body in bytes (0 or None for no limit).  If the
+            response announces a larger size SizeExceededException is raised straight away, otherwise it is
+            raised from the iterator when the limit is crossed
+        :param chunk_size: size of the chunks to read the response in
+        :param types: types to read from, if not the default read types
+        :param conn: connection to use, if not the class's default
+        :return: (status code, chunk iterator)
+        """
+        if conn is None:
+            conn = cls.__conn__
+        query = deepcopy(q) if q is not None else {"query" : {"match_all" : {}}}
+        types = cls._read_type_list(types, query)
+
+        http_timeout = None
+        if timeout is not None:
+            query["timeout"] = str(int(timeout * 1000)) + "ms"
+            http_timeout = timeout * 2
+
+        # a search which has timed out is not retried, as it would most likely just time out again.  Only the
+        # time until the response starts arriving is recorded
+        body = jsonlib.dumps(query)
+        with _Timer(cls, "query_stream", body):
+            resp, chunks = http.iter_stream(_es_url(conn, ",".join(types) + "/_search"),
+                                            method="POST", data=body,
+                                            timeout=http_timeout, retry_on_timeout=False,
+                                            size_limit=size_limit if size_limit is not None else 0,
+                                            chunk_size=chunk_size, cut_off=0)
+        if resp is None:
+            raise ESDAOException(u"No response from index during query")
+        return resp.status_code, chunks
+
+    @classmethod
+    def stream(cls, q=None, page_size=None, limit=None, keepalive=None, source=None, slices=None, slice_id=None, types=None, wrap=True, conn=None):
+        """
+        Generator which scrolls through every record matching the query, holding no more than a page of
+        results in memory at a time.
+
+        From ES 5.x the scroll can be sliced.  With slices > 1 and no slice_id, each slice is scrolled in its
+        own thread and the results are interleaved (so are not in any particular order).  To spread the work
+        over several processes instead, call this in each process with the same slices and a different slice_id.
+        On earlier versions of ES the slice arguments are ignored and the whole result set is scrolled.
+
+        :param q: query to scroll over (defaults to match_all)
+        :param page_size: number of records to retrieve with each request
+        :param limit: maximum number of records to return
+        :param keepalive: how long ES should keep the scroll context alive between requests
+        :param source: list of fields to return from each record's _source
+        :param slices: number of slices to split the scroll into
+        :param slice_id: the single slice to scroll over
+        :param types: types to read from, if not the default read types
+        :param wrap: whether to wrap each record in an instance of this class
+        :param conn: connection to use, if not the class's default
+        """
+        if conn is None:
+            conn = cls.__conn__
+        types = cls._read_type_list(types, q)
+        if page_size is None:
+            page_size = app.config.get("ESDAO_SCROLL_PAGE_SIZE", 1000)
+        if keepalive is None:
+            keepalive = app.config.get("ESDAO_SCROLL_KEEPALIVE", "1m")
+        if isinstance(source, basestring):
+            source = [source]
+
+        esv = cls._es_version_tuple()
+        if esv < (5, 0) or slices is None or slices <= 1:
+            slices = None
+            slice_id = None
+
+        if slices is not None and slice_id is None:
+            docs = _parallel_scroll(conn, types, q, page_size, keepalive, source, slices, esv)
+        else:
+            slc = {"id" : slice_id, "max" : slices} if slices is not None else None
+            docs = _scroll_docs(conn, types, q, page_size, keepalive, source, slc, esv)
+        docs = _timed_iter(cls, "stream", docs, q)
+
+        try:
+            count = 0
+            for doc in docs:
+                if limit is not None and count >= limit:
+                    break
+                count += 1
+                yield cls(doc) if wrap else doc
+        finally:
+            docs.close()
+
+    @classmethod
+    def pull_cache(cls):
+        """
+        Get the pull cache for this class, or None if it does not have one.
+
+        Classes opt in to caching by setting __pull_cache_size__ (and optionally __pull_cache_ttl__), or through
+        the ESDAO_PULL_CACHE configuration for their type.  The cache only knows about saves and deletes made
+        by this process, so the ttl bounds how out of date a record changed elsewhere can be.
+        """
+        cache = _pull_caches.get(cls)
+        if cache is not None:
+            return cache
+
+        size = cls.__pull_cache_size__
+        ttl = cls.__pull_cache_ttl__
+        if size is None:
+            cfg = app.config.get("ESDAO_PULL_CACHE", {}).get(cls.__type__, {})
+            size = cfg.get("size")
+            ttl = cfg.get("ttl", ttl)
+        if not size:
+            return None
+        if ttl is None:
+            ttl = app.config.get("ESDAO_PULL_CACHE_DEFAULT_TTL", 60)
+
+        with _pull_caches_lock:
+            if cls not in _pull_caches:
+                _pull_caches[cls] = LRUCache(size, ttl)
+            return _pull_caches[cls]
+
+    @classmethod
+    def invalidate_pull_cache(cls, id_=None):
+        # the same record may be cached by any class which shares the type
+        for klazz, cache in _pull_caches.items():
+            if klazz.__type__ == cls.__type__:
+                cache.invalidate(id_)
+
+    @classmethod
+    def pull_cache_stats(cls):
+        cache = cls.pull_cache()
+        if cache is None:
+            return None
+        return cache.stats()
+
+    @classmethod
+    def _read_type_list(cls, types=None, q=None):
+        # q is the query the types are for, so that subclasses can narrow down the types to read
+        if types is None:
+            types = cls.get_read_types()
+        if not isinstance(types, list):
+            types = [types]
+        return types
+
+    @classmethod
+    def _es_version_tuple(cls):
+        esv = cls.__es_version__
+        if esv is None:
+            esv = app.config.get("ELASTIC_SEARCH_VERSION")
+        return _es_version_tuple(esv)
+
     @classmethod
     def mappings(cls):
         return {
@@ -204,7 +1220,8 @@ class RollingTypeESDAO(ESDAO):
         s = {
             "prev" : {"cfg" : pc, "file" : pf},
             "curr" : {"cfg" : cc, "file" : cf},
-            "next" : {"cfg" : nc, "file" : nf}
+            "next" : {"cfg" : nc, "file" : nf},
+            "rebuild" : cls.rebuild_status()
         }
         return s
 
@@ -227,9 +1244,112 @@ class RollingTypeESDAO(ESDAO):
 
             # drop the file, the config and the index type in that order
             cls._drop_file("next")
+            cls._drop_file("rebuild")
             cls._set_cfg("next", None)
             esprit.raw.delete(conn, n)
 
+    @classmethod
+    def rebuild_status(cls):
+        """
+        Get the checkpoint of the most recent rebuild into the next type, or None if there is not one
+        """
+        raw = cls._get_file("rebuild")
+        if raw is None:
+            return None
+        return jsonlib.loads(raw)
+
+    @classmethod
+    def rebuild(cls, source=None, transform=None, processes=None, chunk_size=None, progress=None, resume=True, q=None):
+        """
+        Fill the next type with records, ready for it to be published.
+
+        Records are read from the source (by default a scroll through the current type, sorted as
+        ESDAO_REBUILD_SORT), passed through the transform, and bulk written to the next type.  After each chunk
+        is written a checkpoint is recorded, so if the rebuild is interrupted calling this again carries on where
+        it left off.  This requires the source to produce the records in the same order each time.
+        publish() will not go ahead while a rebuild is incomplete or had failures.
+
+        :param source: iterable of raw records to write.  If None, the records in the current type are used
+        :param transform: function which takes a raw record and returns the raw record to write, or None to
+            leave it out.  To use more than one process, this must be importable by the workers
+        :param processes: number of worker processes to run the transform in.  If None, it is run in this process
+        :param chunk_size: number of records to write and checkpoint at a time
+        :param progress: function called after each chunk with the rebuild status
+        :param resume: whether to resume a previous incomplete rebuild into the same next type
+        :param q: query to select the records from the current type, if the source is not given
+        :return: the final rebuild status
+        """
+        if chunk_size is None:
+            chunk_size = app.config.get("ESDAO_REBUILD_CHUNK_SIZE", 1000)
+
+        target = cls.dynamic_write_type()
+        status = cls.rebuild_status()
+        if not resume or status is None or status.get("type") != target or status.get("complete"):
+            status = {"type" : target, "done" : 0, "written" : 0, "skipped" : 0, "failed" : 0, "complete" : False, "started" : dates.now()}
+            cls._set_file("rebuild", jsonlib.dumps(status))
+
+        if source is None:
+            curr = cls._get_file("curr")
+            query = deepcopy(q) if q is not None else {"query" : {"match_all" : {}}}
+            query["sort"] = app.config.get("ESDAO_REBUILD_SORT", [{"id.exact" : {"order" : "asc"}}])
+            source = cls.stream(q=query, types=curr if curr is not None else cls.__type__, wrap=False)
+
+        # skip over anything that has already been written
+        source = itertools.islice(source, status["done"], None)
+
+        pool = None
+        if processes is not None and processes > 1 and transform is not None:
+            pool = multiprocessing.Pool(processes=processes)
+
+        start = time.time()
+        session = 0
+        try:
+            # the records are not changing, they are being moved, so leave last_updated alone
+            writer = cls.bulk_writer(chunk_size=chunk_size, type=target, updated=False)
+            while True:
+                chunk = list(itertools.islice(source, chunk_size))
+                if len(chunk) == 0:
+                    break
+
+                if transform is None:
+                    records = chunk
+                elif pool is not None:
+                    records = pool.map(transform, chunk, max(1, len(chunk) // (processes * 4)))
+                else:
+                    records = [transform(r) for r in chunk]
+
+                failed = len(writer.failures)
+                skipped = 0
+                for record in records:
+                    if record is None:
+                        skipped += 1
+                    else:
+                        writer.add(cls(record))
+                writer.flush()
+
+                # record the checkpoint only once the chunk is safely written
+                session += len(chunk)
+                status["done"] += len(chunk)
+                status["skipped"] += skipped
+                status["failed"] += len(writer.failures) - failed
+                status["written"] = status["done"] - status["failed"] - status["skipped"]
+                status["rate"] = round(session / max(time.time() - start, 0.001), 1)
+                cls._set_file("rebuild", jsonlib.dumps(status))
+
+                app.logger.info(u"Rebuild of {x}: {y} records done, {z} failed, {r} records/s".format(x=target, y=status["done"], z=status["failed"], r=status["rate"]))
+                if progress is not None:
+                    progress(status)
+
+            status["complete"] = True
+            status["finished"] = dates.now()
+            cls._set_file("rebuild", jsonlib.dumps(status))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        return status
+
     @classmethod
     def self_init(cls, *args, **kwargs):
         # determine if we've been given a connection or to use the default
@@ -316,12 +1436,20 @@ class RollingTypeESDAO(ESDAO):
         """
 
     @classmethod
-    def publish(cls, conn=None):
+    def publish(cls, conn=None, force=False):
         # synchronise access
         with cls._lock:
             if conn is None:
                 conn = cls.__conn__
 
+            # don't publish a half-built type
+            rebuild = cls.rebuild_status()
+            if rebuild is not None and not force:
+                if not rebuild.get("complete"):
+                    raise ESDAOException(u"Rebuild of {x} is not complete; not publishing".format(x=rebuild.get("type")))
+                if rebuild.get("failed", 0) > 0:
+                    raise ESDAOException(u"Rebuild of {x} had {y} failed records; not publishing".format(x=rebuild.get("type"), y=rebuild.get("failed")))
+
             prev = cls._get_file("prev")
             curr = cls._get_file("curr")
             next = cls._get_file("next")
@@ -335,11 +1463,13 @@ class RollingTypeESDAO(ESDAO):
             # write next to current
             cls._set_file("curr", next)
 
-            # get rid of the next file
+            # get rid of the next file, and the record of how it was built
             cls._drop_file("next")
+            cls._drop_file("rebuild")
 
             # refresh the configuration
             cls.rolling_refresh()
+            cls.invalidate_pull_cache()
 
             # drop the previous index, if it existed
             if prev is not None:
@@ -371,6 +1501,7 @@ class RollingTypeESDAO(ESDAO):
 
             # refresh the configuration
             cls.rolling_refresh()
+            cls.invalidate_pull_cache()
 
             # delete the old next index type
             if next is not None:
@@ -444,16 +1575,43 @@ class TimeBoxedTypeESDAO(ESDAO):
         "second" : "%Y%m%d%H%M%S"
     }
 
+    # the date field whose value decides which time box a record is in.  Records are written to the
+    # time box of the moment they are saved, so this is last_updated
+    __time_box_field__ = "last_updated"
+
+    # memoised time boxes, keyed on the class, granularity, current boundary and lookback
+    _time_box_cache = {}
+
     #####################################################
     ## overrides on Domain Object
 
     @classmethod
     def dynamic_read_types(cls):
-        gran = cls._get_time_granularity()
-        ts = cls._boundary_timestamp(gran)
-        lookback = cls._get_lookback()
-        tss = cls._lookback_timestamps(lookback, gran, ts)
-        return [cls._format_type(gran, ts) for ts in tss]
+        return [box[0] for box in cls._time_boxes()]
+
+    @classmethod
+    def query(cls, q='', *args, **kwargs):
+        if kwargs.get("types") is None:
+            kwargs["types"] = cls.read_types_for_query(q)
+        return super(TimeBoxedTypeESDAO, cls).query(q, *args, **kwargs)
+
+    @classmethod
+    def object_query(cls, q='', *args, **kwargs):
+        if kwargs.get("types") is None:
+            kwargs["types"] = cls.read_types_for_query(q)
+        return super(TimeBoxedTypeESDAO, cls).object_query(q, *args, **kwargs)
+
+    @classmethod
+    def count(cls, q, *args, **kwargs):
+        if kwargs.get("types") is None:
+            kwargs["types"] = cls.read_types_for_query(q)
+        return super(TimeBoxedTypeESDAO, cls).count(q, *args, **kwargs)
+
+    @classmethod
+    def _read_type_list(cls, types=None, q=None):
+        if types is None and q is not None:
+            types = cls.read_types_for_query(q)
+        return super(TimeBoxedTypeESDAO, cls)._read_type_list(types)
 
     @classmethod
     def dynamic_write_type(cls):
@@ -472,9 +1630,60 @@ class TimeBoxedTypeESDAO(ESDAO):
 
         return wt
 
+    ######################################################
+    ## Time range pruning
+
+    @classmethod
+    def read_types_since(cls, fro=None):
+        """
+        Get the read types which could hold records with a __time_box_field__ of fro or later: those whose time
+        boxes end after it.  Records are written to the box for when they are saved, but their field may be older
+        than that (e.g. if saved with updated=False, in bulk, or by a rebuild), so later boxes are never left out.
+
+        If no box ends after fro, the most recent type is returned, so that the query still goes somewhere
+        (and the date range in the query itself will then exclude everything).
+        """
+        boxes = cls._time_boxes()
+        types = [t for t, start, end in boxes if fro is None or end > fro]
+        if len(types) == 0:
+            types = [boxes[0][0]]
+        return types
+
+    @classmethod
+    def read_types_for_query(cls, q):
+        """
+        Get the read types which could contain results for the query, based on the earliest date it allows
+        on the __time_box_field__.
+        """
+        with _Timer(cls, "read_types"):
+            fro = _query_date_from(q, cls.__time_box_field__)
+            if fro is None:
+                return cls.dynamic_read_types()
+            return cls.read_types_since(fro)
+
     ######################################################
     ## Private methods for handling time boxing
 
+    @classmethod
+    def _time_boxes(cls):
+        # list of (type name, start, end) for each time box in the lookback, most recent first
+        gran = cls._get_time_granularity()
+        ts = cls._boundary_timestamp(gran)
+        lookback = cls._get_lookback()
+
+        key = (cls, gran, ts, lookback)
+        boxes = TimeBoxedTypeESDAO._time_box_cache.get(key)
+        if boxes is None:
+            box = relativedelta.relativedelta(**{gran + "s" : 1})
+            tss = cls._lookback_timestamps(lookback, gran, ts)
+            boxes = [(cls._format_type(gran, t), t, t + box) for t in tss]
+
+            # entries for previous boundaries will never be used again
+            if len(TimeBoxedTypeESDAO._time_box_cache) > 100:
+                TimeBoxedTypeESDAO._time_box_cache.clear()
+            TimeBoxedTypeESDAO._time_box_cache[key] = boxes
+        return boxes
+
     @classmethod
     def _get_time_granularity(cls):
         cfarg = "ESDAO_TIME_BOX_" + cls.__type__.upper()
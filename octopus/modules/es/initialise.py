@@ -1,5 +1,5 @@
-import esprit
-from octopus.lib import plugin
+import esprit, json, hashlib, os
+from octopus.lib import plugin, http
 from octopus.core import app
 
 def _default_mapping():
@@ -15,35 +15,135 @@ def _default_mapping():
 
     return {"mappings" : {"_default_" : default_mapping}}
 
-def put_mappings(mappings):
+def _connection():
+    return esprit.raw.Connection(app.config['ELASTIC_SEARCH_HOST'], app.config['ELASTIC_SEARCH_INDEX'])
+
+def existing_types(conn=None):
+    """
+    Get the names of all the types which have mappings in the index, with a single request.
+
+    :return: a set of type names, or None if the mappings could not be retrieved (in which case
+        the caller should fall back to checking each type individually)
+    """
+    if conn is None:
+        conn = _connection()
+
+    url = str(conn.host) + ":" + str(conn.port) + "/" + conn.index + "/_mapping"
+    try:
+        resp = http.get(url)
+    except Exception:
+        return None
+    if resp is None or resp.status_code != 200:
+        return None
+
+    # the response is keyed on the index name (which may differ from conn.index if that is an alias),
+    # and from ES 1.x the types are inside a "mappings" object
+    types = set()
+    for index_mapping in resp.json().values():
+        if "mappings" in index_mapping:
+            index_mapping = index_mapping["mappings"]
+        types.update(index_mapping.keys())
+    return types
+
+def put_mappings(mappings, existing=None):
+    """
+    Create the types and mappings which are not already in the index.
+
+    :param mappings: dict of type names to mappings
+    :param existing: the set of types already in the index, from existing_types().  If not supplied,
+        each type is checked individually
+    :return: True if all the missing mappings were created, False otherwise
+    """
     # make a connection to the index
-    conn = esprit.raw.Connection(app.config['ELASTIC_SEARCH_HOST'], app.config['ELASTIC_SEARCH_INDEX'])
+    conn = _connection()
 
     # get the ES version that we're working with
     es_version = app.config.get("ELASTIC_SEARCH_VERSION", "0.90.13")
 
     # for each mapping (a class may supply multiple), create them in the index
-    for key, mapping in mappings.iteritems():
-        if not esprit.raw.type_exists(conn, key, es_version=es_version):
-            r = esprit.raw.put_mapping(conn, key, mapping, es_version=es_version)
-            print "Creating ES Type+Mapping for", key, "; status:", r.status_code
+    missing = []
+    for key in mappings.keys():
+        if existing is not None:
+            exists = key in existing
         else:
-            print "ES Type+Mapping already exists for", key
+            exists = esprit.raw.type_exists(conn, key, es_version=es_version)
 
-def put_example(type, example):
+        if exists:
+            print "ES Type+Mapping already exists for", key
+        else:
+            missing.append(key)
+
+    # the mappings are independent of each other, so they can all be sent at once
+    def put(key):
+        return esprit.raw.put_mapping(conn, key, mappings[key], es_version=es_version)
+
+    ok = True
+    for key, r, err in http.map_concurrent(put, missing):
+        if err is not None:
+            print "Unable to create ES Type+Mapping for", key, ";", err
+            ok = False
+            continue
+        print "Creating ES Type+Mapping for", key, "; status:", r.status_code
+        if r.status_code != 200:
+            ok = False
+        elif existing is not None:
+            existing.add(key)
+    return ok
+
+def put_example(type, example, existing=None):
     # make a connection to the index
-    conn = esprit.raw.Connection(app.config['ELASTIC_SEARCH_HOST'], app.config['ELASTIC_SEARCH_INDEX'])
+    conn = _connection()
 
     # get the ES version that we're working with
     es_version = app.config.get("ELASTIC_SEARCH_VERSION", "0.90.13")
 
-    if not esprit.raw.type_exists(conn, type, es_version=es_version):
+    if existing is not None:
+        exists = type in existing
+    else:
+        exists = esprit.raw.type_exists(conn, type, es_version=es_version)
+
+    if not exists:
         example.save()
         example.delete()
         print "Initialising ES Type+Mapping from document for", type
+        if existing is not None:
+            existing.add(type)
     else:
         print "Not Initialising from document - ES Type+Mapping already exists for", type
 
+def _fingerprint(es_version, mappings, example_types):
+    # everything that the index initialisation depends on, so that if any of it changes the index is checked again
+    state = {
+        "host" : app.config.get("ELASTIC_SEARCH_HOST"),
+        "index" : app.config.get("ELASTIC_SEARCH_INDEX"),
+        "version" : es_version,
+        "default" : app.config.get("ELASTIC_SEARCH_DEFAULT_MAPPING"),
+        "mappings" : mappings,
+        "examples" : example_types
+    }
+    return hashlib.sha1(json.dumps(state, sort_keys=True)).hexdigest()
+
+def _read_fingerprint(path):
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+def _write_fingerprint(path, fingerprint):
+    if path is None:
+        return
+    try:
+        # write and rename, so that a half-written file is never read
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(fingerprint)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        print "Unable to record ES initialisation fingerprint;", e
+
 def initialise():
     # if we are not to initialise the index, stop here
     if not app.config.get("INITIALISE_INDEX", False):
@@ -51,8 +151,40 @@ def initialise():
 
     es_version = app.config.get("ELASTIC_SEARCH_VERSION", "0.90.13")
 
+    # load each class which carries type-specific mappings, and execute the "mappings"
+    # function to get the mappings that need to be imported
+    mappings = {}
+    for cname in app.config.get("ELASTIC_SEARCH_MAPPINGS", []):
+        klazz = plugin.load_class_raw(cname)
+        for key, mapping in klazz.mappings().iteritems():
+            # where two classes supply a mapping for the same type, the first one is used
+            mappings.setdefault(key, mapping)
+
+    # get the list of classes which will give us example docs to load
+    examples = []
+    for cname in app.config.get("ELASTIC_SEARCH_EXAMPLE_DOCS", []):
+        klazz = plugin.load_class_raw(cname)
+        examples.append((klazz.get_write_type(), klazz))
+
+    # if nothing has changed since the index was last found to be complete, there is nothing to check
+    fingerprint_file = app.config.get("INITIALISE_INDEX_FINGERPRINT_FILE")
+    fingerprint = _fingerprint(es_version, mappings, [t for t, k in examples])
+    if fingerprint_file is not None and _read_fingerprint(fingerprint_file) == fingerprint:
+        print "ES Index initialisation unchanged since last startup; not checking index"
+    else:
+        complete = _initialise_index(es_version, mappings, examples)
+        if complete:
+            _write_fingerprint(fingerprint_file, fingerprint)
+
+    self_inits = app.config.get("ELASTIC_SEARCH_SELF_INIT", [])
+
+    for cname in self_inits:
+        klazz = plugin.load_class_raw(cname)
+        klazz.self_init()
+
+def _initialise_index(es_version, mappings, examples):
     # create the index itself if it needs creating
-    conn = esprit.raw.Connection(app.config['ELASTIC_SEARCH_HOST'], app.config['ELASTIC_SEARCH_INDEX'])
+    conn = _connection()
     if not esprit.raw.index_exists(conn):
         print "Creating ES Index; host:" + str(conn.host) + " port:" + str(conn.port) + " db:" + str(conn.index)
         default_mapping = _default_mapping()
@@ -62,27 +194,12 @@ def initialise():
     else:
         print "ES Index Already Exists; host:" + str(conn.host) + " port:" + str(conn.port) + " db:" + str(conn.index)
 
-    # get the list of classes which carry the type-specific mappings to be loaded
-    mapping_daos = app.config.get("ELASTIC_SEARCH_MAPPINGS", [])
+    # find out which types already exist with one request, rather than one per type
+    existing = existing_types(conn)
 
-    # load each class and execute the "mappings" function to get the mappings
-    # that need to be imported
-    for cname in mapping_daos:
-        klazz = plugin.load_class_raw(cname)
-        mappings = klazz.mappings()
-        put_mappings(mappings)
+    complete = put_mappings(mappings, existing=existing)
 
-    # get the list of classes which will give us example docs to load
-    example_daos = app.config.get("ELASTIC_SEARCH_EXAMPLE_DOCS", [])
-
-    for cname in example_daos:
-        klazz = plugin.load_class_raw(cname)
-        example = klazz.example()
-        type = klazz.get_write_type()
-        put_example(type, example)
+    for type, klazz in examples:
+        put_example(type, klazz.example(), existing=existing)
 
-    self_inits = app.config.get("ELASTIC_SEARCH_SELF_INIT", [])
-
-    for cname in self_inits:
-        klazz = plugin.load_class_raw(cname)
-        klazz.self_init()
\ No newline at end of file
+    return complete and existing is not None
@@ -1,11 +1,12 @@
 import json, urllib2
 from esprit.models import Query
 
-from flask import Blueprint, request, abort, make_response
+from flask import Blueprint, request, abort, make_response, Response
 from flask.ext.login import current_user
 
 from octopus.core import app
-from octopus.lib import webapp, plugin
+from octopus.lib import webapp, plugin, http
+from octopus.modules.es.dao import ESDAOException
 
 blueprint = Blueprint('query', __name__)
 
@@ -114,11 +115,44 @@ def query(path=None):
             except:
                 abort(500)
 
-        # finally send the query and return the response
-        res = dao_klass.query(q=q.as_dict())
-        resp = make_response(json.dumps(res))
+        # finally send the query and return the response.  Streaming needs an ESDAO, and JSONP responses are
+        # re-wrapped in full by webapp.jsonp, so are never streamed
+        stream = cfg.get("stream", app.config.get("QUERY_STREAM", False))
+        if stream and hasattr(dao_klass, "query_stream") and not request.values.get("callback"):
+            resp = _stream_query(dao_klass, q.as_dict(), cfg)
+        else:
+            res = dao_klass.query(q=q.as_dict())
+            resp = make_response(json.dumps(res))
     else:
         abort(400)
 
     resp.mimetype = "application/json"
     return resp
+
+def _stream_query(dao_klass, q, cfg):
+    size_limit = cfg.get("max_response_size", app.config.get("QUERY_MAX_RESPONSE_SIZE", 0))
+    timeout = cfg.get("timeout", app.config.get("QUERY_TIMEOUT"))
+    chunk_size = app.config.get("QUERY_STREAM_CHUNK_SIZE", 65536)
+
+    try:
+        status, chunks = dao_klass.query_stream(q=q, timeout=timeout, size_limit=size_limit, chunk_size=chunk_size)
+    except http.SizeExceededException:
+        app.logger.info(u"Query response from index is larger than the {x} bytes allowed".format(x=size_limit))
+        abort(502)
+    except ESDAOException:
+        abort(504)
+
+    return Response(_proxy_chunks(chunks, size_limit), status=status)
+
+def _proxy_chunks(chunks, size_limit):
+    # by the time the body is being sent the status has gone, so all we can do if the index stops
+    # responding or the size limit is crossed is log it and cut the response short
+    try:
+        for chunk in chunks:
+            yield chunk
+    except http.SizeExceededException:
+        app.logger.info(u"Query response from index exceeded the {x} bytes allowed, and was truncated".format(x=size_limit))
+    except Exception as e:
+        app.logger.info(u"Query response from index was interrupted: {x}".format(x=e))
+    finally:
+        chunks.close()
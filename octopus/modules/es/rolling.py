@@ -1,6 +1,7 @@
-from flask import Blueprint, request, make_response
+from flask import Blueprint, request, make_response, abort
 from octopus.core import app
 from octopus.lib import webapp, plugin
+from octopus.modules.es.dao import ESDAOException
 import json
 
 blueprint = Blueprint('rolling', __name__)
@@ -12,7 +13,11 @@ def publish():
     map = app.config.get("ESDAO_ROLLING_PLUGINS", {})
     for t in types:
         klazz = plugin.load_class(map.get(t))
-        klazz.publish()
+        try:
+            klazz.publish()
+        except ESDAOException:
+            # the next type is still being rebuilt, or the rebuild failed
+            abort(409)
     return ""
 
 @blueprint.route('/rollback', methods=['POST'])
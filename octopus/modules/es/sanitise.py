@@ -1,4 +1,8 @@
+from octopus.core import app
 from octopus.lib import dataobj
+from octopus.lib.lrucache import LRUCache
+from copy import deepcopy
+import json, hashlib, threading
 
 EDGES_STRUCT = {
     "fields" : {
@@ -35,6 +39,9 @@ def sanitise(raw_query, struct, coerce_map=None, source_includes=None, aggs_type
         }
     }
 
+    The configuration is compiled into a Sanitiser on first use (see get_sanitiser), and the
+    results for recently seen queries are remembered
+
     :param raw_query:
     :param struct:
     :param coerce_map:
@@ -42,66 +49,155 @@ def sanitise(raw_query, struct, coerce_map=None, source_includes=None, aggs_type
     :param aggs_type_field_map:
     :return:
     """
-    if coerce_map is None:
-        coerce_map = dataobj.DataObj.DEFAULT_COERCE
-    try:
-        clean_query = dataobj.construct(raw_query, struct, coerce_map, silent_prune=True)
-    except dataobj.DataStructureException as e:
-        raise QuerySanitisationException(e)
-
-    topqkey = clean_query["query"].keys()[0]
-    if topqkey not in ["filtered", "match_all"]:
-        raise QuerySanitisationException("must be a filtered or match_all query")
-
-    if source_includes is not None:
-        clean_query["_source"] = {}
-        clean_query["_source"]["includes"] = source_includes
-
-    aggs = None
-    if "aggs" in clean_query:
-        aggs = clean_query["aggs"]
-    elif "aggregations" in clean_query:
-        aggs = clean_query["aggregations"]
-
-    if aggs_type_field_map is not None and aggs is not None:
-        removes = []
-        for name, definition in aggs.iteritems():
-            sane = _sanitise_aggregation(definition, aggs_type_field_map)
-            if not sane:
-                removes.append(name)
-
-        for r in removes:
-            del aggs[r]
-
-        if len(aggs) == 0:
-            if "aggs" in clean_query:
-                del clean_query["aggs"]
-            if "aggregations" in clean_query:
-                del clean_query["aggregations"]
-
-
-    if sortable is not None:
-        if "sort" in clean_query:
-            rmidx = []
-            for i in range(len(clean_query["sort"])):
-                so = clean_query["sort"][i]
-                field = so.keys()[0]
-                if field not in sortable:
-                    rmidx.append(i)
-            rmidx.sort(reverse=True)
-            for idx in rmidx:
-                del clean_query["sort"][idx]
-    else:
-        if "sort" in clean_query:
-            del clean_query["sort"]
-
-    return clean_query
+    return get_sanitiser(struct, coerce_map, source_includes, aggs_type_field_map, sortable).sanitise(raw_query)
+
+_sanitisers = {}
+_sanitisers_lock = threading.Lock()
+
+def get_sanitiser(struct, coerce_map=None, source_includes=None, aggs_type_field_map=None, sortable=None):
+    """
+    Get the Sanitiser for a configuration, compiling it on first use.
+
+    As with dataobj.compile_struct, sanitisers are cached against the identity of the configuration
+    objects, so this is intended for long-lived configuration which is not modified in place
+    """
+    config = (struct, coerce_map, source_includes, aggs_type_field_map, sortable)
+    key = tuple([id(c) for c in config])
+    with _sanitisers_lock:
+        entry = _sanitisers.get(key)
+        if entry is not None:
+            return entry[1]
+
+        sanitiser = Sanitiser(struct, coerce_map, source_includes, aggs_type_field_map, sortable)
+        if len(_sanitisers) >= 100:
+            _sanitisers.clear()
+
+        # keep references to the configuration, so the ids can't be re-used while cached
+        _sanitisers[key] = (config, sanitiser)
+        return sanitiser
+
+class Sanitiser(object):
+    """
+    Sanitises queries against one configuration (see sanitise() for the arguments), which is compiled
+    when the Sanitiser is created.
 
+    The outcome for each of the last cache_size distinct queries is remembered against a hash of the
+    query, so repeats of the same query (e.g. the facet requests made by a search UI) are not validated
+    again.  Set cache_size to 0 to turn this off.
+    """
+    def __init__(self, struct=None, coerce_map=None, source_includes=None, aggs_type_field_map=None, sortable=None, cache_size=None):
+        if struct is None:
+            struct = EDGES_STRUCT
+        if coerce_map is None:
+            coerce_map = dataobj.DataObj.DEFAULT_COERCE
+        if cache_size is None:
+            cache_size = app.config.get("QUERY_SANITISER_CACHE_SIZE", 1000)
+
+        self._struct = dataobj.CompiledStruct(struct, coerce_map)
+        self._source_includes = deepcopy(source_includes)
+        self._aggs = _compile_aggs(aggs_type_field_map) if aggs_type_field_map is not None else None
+        self._sortable = frozenset(sortable) if sortable is not None else None
+        self._cache = LRUCache(cache_size) if cache_size else None
+
+    def sanitise(self, raw_query):
+        key = None
+        if self._cache is not None:
+            key = _query_hash(raw_query)
+            if key is not None:
+                outcome = self._cache.get(key)
+                if outcome is not None:
+                    return _replay(outcome)
+
+        try:
+            outcome = (True, self._sanitise(raw_query))
+        except QuerySanitisationException as e:
+            outcome = (False, e.args)
+
+        if key is not None:
+            # the query is copied first, as the caller is free to change the one we give them
+            self._cache.put(key, (outcome[0], deepcopy(outcome[1])))
+        return _replay(outcome)
+
+    def cache_stats(self):
+        if self._cache is None:
+            return None
+        return self._cache.stats()
+
+    def _sanitise(self, raw_query):
+        try:
+            clean_query = self._struct.construct(raw_query, silent_prune=True)
+        except dataobj.DataStructureException as e:
+            raise QuerySanitisationException(e)
+
+        topqkey = clean_query["query"].keys()[0]
+        if topqkey not in ["filtered", "match_all"]:
+            raise QuerySanitisationException("must be a filtered or match_all query")
+
+        if self._source_includes is not None:
+            clean_query["_source"] = {}
+            clean_query["_source"]["includes"] = deepcopy(self._source_includes)
+
+        aggs = None
+        if "aggs" in clean_query:
+            aggs = clean_query["aggs"]
+        elif "aggregations" in clean_query:
+            aggs = clean_query["aggregations"]
+
+        if self._aggs is not None and aggs is not None:
+            removes = []
+            for name, definition in aggs.iteritems():
+                sane = _sanitise_aggregation(definition, self._aggs)
+                if not sane:
+                    removes.append(name)
+
+            for r in removes:
+                del aggs[r]
+
+            if len(aggs) == 0:
+                if "aggs" in clean_query:
+                    del clean_query["aggs"]
+                if "aggregations" in clean_query:
+                    del clean_query["aggregations"]
+
+        if self._sortable is not None:
+            if "sort" in clean_query:
+                clean_query["sort"] = [so for so in clean_query["sort"] if so.keys()[0] in self._sortable]
+        else:
+            if "sort" in clean_query:
+                del clean_query["sort"]
+
+        return clean_query
+
+def _query_hash(raw_query):
+    # the canonical form of a query is its json with the keys sorted
+    try:
+        canonical = json.dumps(raw_query, sort_keys=True, separators=(",", ":"))
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha1(canonical).hexdigest()
+
+def _replay(outcome):
+    ok, result = outcome
+    if not ok:
+        raise QuerySanitisationException(*result)
+    return deepcopy(result)
+
+def _compile_aggs(type_field_map):
+    # {"<aggregation type>" : {"<allowed field>" : (whether sub-aggregations are allowed, compiled type_field_map)}}
+    compiled = {}
+    for type, fields in type_field_map.iteritems():
+        compiled[type] = {}
+        for field, cfg in fields.iteritems():
+            compiled[type][field] = (cfg.get("aggs", False), _compile_aggs(cfg.get("type_field_map", {})))
+    return compiled
 
 def _sanitise_aggregation(definition, type_field_map):
-    type = definition.keys()[0]
+    types = [k for k in definition.keys() if k not in ["aggs", "aggregations"]]
+    if len(types) == 0 or not isinstance(definition[types[0]], dict):
+        return False
+    type = types[0]
     field = definition[type].get("field")
-    allowed_fields = type_field_map[type].keys()
+    allowed_fields = type_field_map.get(type, {})
     if field not in allowed_fields:
         return False
 
@@ -114,15 +210,13 @@ def _sanitise_aggregation(definition, type_field_map):
     if subaggs is None:
         return True
 
-    allowed_subaggs = type_field_map[type][field].get("aggs", False)
+    allowed_subaggs, stfm = allowed_fields[field]
     if not allowed_subaggs:
         if "aggs" in definition:
             del definition["aggs"]
         if "aggregations" in definition:
             del definition["aggregations"]
 
-    stfm = type_field_map[type][field].get("type_field_map", {})
-
     removes = []
     for name, subdef in subaggs.iteritems():
         sane = _sanitise_aggregation(subdef, stfm)
@@ -137,4 +231,4 @@ def _sanitise_aggregation(definition, type_field_map):
         if "aggregations" in definition:
             del definition["aggregations"]
 
-    return True
\ No newline at end of file
+    return True
@@ -1,10 +1,13 @@
 from octopus.core import app
 from octopus.lib import webapp, plugin, dates
+from octopus.lib.lrucache import LRUCache
 from octopus.modules.account.factory import AccountFactory
 
-from flask import Blueprint, request, abort, make_response
+from octopus.modules.es.dao import ESDAOException, _es_version_tuple
 
-import esprit, json, re
+from flask import Blueprint, request, abort, make_response, Response
+
+import esprit, json, re, hashlib, threading, base64
 
 
 blueprint = Blueprint('searchapi', __name__)
@@ -199,6 +202,112 @@ def _escape(query):
 
     return query
 
+#######################################################
+## Result caching
+
+# result caches for each search configuration which has one, created on first use
+_result_caches = {}
+_result_caches_lock = threading.Lock()
+
+def _result_cache(cfg_name, cfg):
+    ccfg = cfg.get("cache")
+    if ccfg is None or not ccfg.get("size"):
+        return None
+
+    cache = _result_caches.get(cfg_name)
+    if cache is not None:
+        return cache
+
+    with _result_caches_lock:
+        if cfg_name not in _result_caches:
+            _result_caches[cfg_name] = LRUCache(ccfg.get("size"), ccfg.get("ttl", 60))
+        return _result_caches[cfg_name]
+
+def _account_key(cfg, acc):
+    # the query builder may use the account to constrain the search, so results are only shared between
+    # accounts with the same roles (or not at all, if the config says the query depends on the account itself)
+    roles = None
+    ident = None
+    if acc is not None:
+        roles = sorted(acc.role)
+        if cfg.get("cache", {}).get("per_account", False):
+            ident = acc.id
+    return [roles, ident]
+
+def _cache_key(cfg, acc, q, page, psize, sort_by, sort_dir):
+    key = json.dumps([q, page, psize, sort_by, sort_dir] + _account_key(cfg, acc))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def _etag(response):
+    # the timestamp changes every time the results are generated, so leave it out
+    stable = dict([(k, v) for k, v in response.iteritems() if k != "timestamp"])
+    return hashlib.sha1(json.dumps(stable, sort_keys=True)).hexdigest()
+
+#######################################################
+## Cursor pagination
+
+def _encode_cursor(payload):
+    return base64.urlsafe_b64encode(json.dumps(payload)).rstrip("=")
+
+def _decode_cursor(token):
+    try:
+        token = str(token)
+        payload = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise BadRequest("Cursor is not valid")
+    if not isinstance(payload, dict):
+        raise BadRequest("Cursor is not valid")
+    return payload
+
+def _cursor_key(cfg, acc, q, psize, sort_by, sort_dir):
+    # ties a cursor to the search it was issued for, and to the accounts that search may be run for, since the
+    # continuation pages are not passed through the query builder again
+    key = json.dumps([q, psize, sort_by, sort_dir] + _account_key(cfg, acc))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+def _cursor_search(cfg, klazz, query, cursor, key, psize):
+    """
+    Get the page of results after the cursor (or the first page if the cursor is "*"), using search_after
+    where the index supports it (ES 5.x and later) and a scroll context otherwise.
+
+    :return: tuple of the raw ES result and the cursor for the next page (None if this is the last page)
+    """
+    payload = None
+    if cursor != "*":
+        payload = _decode_cursor(cursor)
+        if payload.get("k") != key:
+            raise BadRequest("Cursor was not issued for this search")
+
+    esv = _es_version_tuple(getattr(klazz, "__es_version__", None) or app.config.get("ELASTIC_SEARCH_VERSION"))
+    query.pop("from", None)
+
+    if esv >= (5, 0):
+        # search_after needs a sort order with no ties
+        sort = query.get("sort", [])
+        sort.append({cfg.get("cursor_tiebreak", "id.exact") : {"order" : "asc"}})
+        query["sort"] = sort
+        if payload is not None:
+            query["search_after"] = payload.get("a")
+        res = klazz.query(q=query)
+        hits = res.get("hits", {}).get("hits", [])
+        nxt = {"k" : key, "a" : hits[-1].get("sort")} if len(hits) > 0 else None
+    else:
+        keepalive = cfg.get("cursor_keepalive", "5m")
+        if payload is None:
+            res = klazz.scroll_page(q=query, keepalive=keepalive)
+        else:
+            res = klazz.scroll_page(scroll_id=payload.get("s"), keepalive=keepalive)
+        hits = res.get("hits", {}).get("hits", [])
+        nxt = {"k" : key, "s" : res.get("_scroll_id")}
+
+        # there will be no request for the next page, so don't leave the scroll context open until it times out
+        if len(hits) < psize and res.get("_scroll_id") is not None:
+            klazz._scroll_clear(res.get("_scroll_id"))
+
+    if len(hits) < psize:
+        nxt = None
+    return res, _encode_cursor(nxt) if nxt is not None else None
+
 #######################################################
 ## Responses
 
@@ -226,6 +335,13 @@ def _unauthorised(error):
     resp.status_code = 401
     return resp
 
+def _not_modified(etag):
+    resp = make_response("")
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    resp.set_etag(etag)
+    resp.status_code = 304
+    return resp
+
 def _forbidden(error):
     app.logger.info("Sending 403 Forbidden from client: {x}".format(x=error))
     resp = make_response(json.dumps({"status" : "forbidden", "error" : error}))
@@ -277,6 +393,21 @@ def search(cfg_name):
     except BadRequest:
         return _bad_request()
 
+    # cursor requests page through the results with a token rather than a page number
+    cursor = request.values.get("cursor")
+    if cursor is not None:
+        return _cursor_response(cfg, qb, dao_path, acc, q, psize, sort_by, sort_dir, cursor)
+
+    # if we have recently done this search, send the same results
+    cache = _result_cache(cfg_name, cfg)
+    key = None
+    if cache is not None:
+        key = _cache_key(cfg, acc, q, page, psize, sort_by, sort_dir)
+        cached = cache.get(key)
+        if cached is not None:
+            body, etag = cached
+            return _search_response(body, etag)
+
     # assemble the query
     query_builder = plugin.load_class(qb)
     query = query_builder(q, fro, psize, sort_by, sort_dir, acc)
@@ -313,7 +444,107 @@ def search(cfg_name):
         "results" : obs
     }
 
+    body = json.dumps(response)
+    etag = _etag(response)
+    if cache is not None:
+        cache.put(key, (body, etag))
+
+    return _search_response(body, etag)
+
+def _search_response(body, etag):
+    # JSONP responses are re-wrapped without our headers, so conditional requests only apply to plain JSON
+    conditional = not request.args.get("callback", False)
+    if conditional and etag in request.if_none_match:
+        return _not_modified(etag)
+
+    resp = make_response(body)
+    resp.mimetype = "application/json"
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    if conditional:
+        resp.set_etag(etag)
+    return resp
+
+def _cursor_response(cfg, qb, dao_path, acc, q, psize, sort_by, sort_dir, cursor):
+    query_builder = plugin.load_class(qb)
+    query = query_builder(q, 0, psize, sort_by, sort_dir, acc).query()
+    klazz = plugin.load_class(dao_path)
+
+    try:
+        res, nxt = _cursor_search(cfg, klazz, query, cursor, _cursor_key(cfg, acc, q, psize, sort_by, sort_dir), psize)
+    except (BadRequest, ESDAOException):
+        return _bad_request()
+    if res.get("error") is not None:
+        return _bad_request()
+
+    obs = esprit.raw.unpack_json_result(res)
+    filter = cfg.get("results_filter")
+    if filter is not None:
+        fn = plugin.load_function(filter)
+        obs = [fn(o) for o in obs]
+
+    if len(obs) == 0:
+        return _not_found()
+
+    response = {
+        "total" : res.get("hits", {}).get("total", 0),
+        "pageSize" : psize,
+        "timestamp" : dates.now(),
+        "query" : q,
+        "results" : obs,
+        "cursor" : nxt
+    }
     resp = make_response(json.dumps(response))
     resp.mimetype = "application/json"
     resp.headers['Access-Control-Allow-Origin'] = '*'
-    return resp
\ No newline at end of file
+    return resp
+
+# stream the whole result set for a search as newline delimited JSON
+@blueprint.route('/<cfg_name>/export', methods=['GET'])
+def export(cfg_name):
+    cfg = app.config.get("SEARCHAPI", {}).get(cfg_name)
+    if cfg is None or not cfg.get("export", False):
+        return _not_found()
+
+    qb = cfg.get("query_builder")
+    dao_path = cfg.get("dao")
+    if qb is None or dao_path is None:
+        return _not_found()
+
+    acc = None
+    if cfg.get("auth", False):
+        try:
+            acc = _auth(cfg.get("roles", []))
+        except AuthenticationException:
+            return _unauthorised("Unauthorised")
+        except AuthorisationException:
+            return _forbidden("Forbidden")
+
+    q = request.values.get("q")
+    if q is None:
+        return _bad_request()
+    sort_by = request.values.get("sortBy")
+    sort_dir = request.values.get("sortDir")
+
+    try:
+        q, fro, page, psize, sort_by, sort_dir = _sanitise(cfg, q, 1, cfg.get("default_page_size", 10), sort_by, sort_dir)
+    except BadRequest:
+        return _bad_request()
+
+    query_builder = plugin.load_class(qb)
+    query = query_builder(q, 0, psize, sort_by, sort_dir, acc).query()
+    query.pop("from", None)
+    query.pop("size", None)
+
+    klazz = plugin.load_class(dao_path)
+    filter = cfg.get("results_filter")
+    fn = plugin.load_function(filter) if filter is not None else None
+
+    def generate():
+        for o in klazz.stream(q=query, wrap=False):
+            if fn is not None:
+                o = fn(o)
+            yield json.dumps(o) + "\n"
+
+    resp = Response(generate(), mimetype="application/x-ndjson")
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
@@ -18,6 +18,12 @@ ELASTIC_SEARCH_TEST_INDEX = "test"
 # should the initialise routing initialise the index automatically?
 INITIALISE_INDEX = True
 
+# file in which to record a fingerprint of the index configuration (host, index, mappings and example
+# types) once the index has been fully initialised.  On the next startup, if the configuration has not
+# changed, the index is not checked at all.  Delete the file to force a check (e.g. if the index has been
+# removed).  None means always check
+INITIALISE_INDEX_FINGERPRINT_FILE = None
+
 # Use this for ES < 5.x
 # mapping that will be pushed into the _default_ field of the index
 # itself, and be applied to all types that are subsequently created
@@ -120,6 +126,58 @@ ESDAO_DEFAULT_TIME_BOX_LOOKBACK = 0
 from octopus.lib import paths
 ESDAO_ROLLING_DIR = paths.rel2abs(__file__, "..", "..", "..", "..", "indexdir")
 
+# Limits for each request made by ESDAO.bulk_save and the bulk writer: the maximum number
+# of records, and the maximum size of the request body in bytes
+ESDAO_BULK_CHUNK_SIZE = 500
+ESDAO_BULK_CHUNK_BYTES = 5 * 1024 * 1024
+
+# How many times to retry the records in a bulk request which failed with one of the
+# retryable statuses (typically the index being too busy to accept them)
+ESDAO_BULK_RETRIES = 2
+ESDAO_BULK_RETRY_STATUSES = [429, 503]
+
+# Whether ESDAO.delete_by_query should scroll through the matching ids and delete them with bulk
+# requests (see ESDAO.throttled_delete_by_query), rather than using the index's own delete by query
+ESDAO_THROTTLED_DELETE = False
+
+# For throttled deletes, the number of records to delete with each bulk request, and the maximum
+# number of bulk requests to make per second (None for no limit)
+ESDAO_THROTTLED_DELETE_BATCH_SIZE = 1000
+ESDAO_THROTTLED_DELETE_RATE = None
+
+# Defaults for ESDAO.stream: the number of records to get with each scroll request, and
+# how long the index should keep the scroll context open between requests
+ESDAO_SCROLL_PAGE_SIZE = 1000
+ESDAO_SCROLL_KEEPALIVE = "1m"
+
+# The maximum number of ids to request at once in ESDAO.pull_many
+ESDAO_MGET_CHUNK_SIZE = 100
+
+# In-process caching of ESDAO.pull for frequently read types, e.g.
+# {"account" : {"size" : 1000, "ttl" : 30}}
+# holds up to 1000 accounts for at most 30 seconds each.  Classes can also set
+# __pull_cache_size__ and __pull_cache_ttl__ directly.  Saves and deletes made in the
+# same process are applied to the cache immediately; others are only seen after the ttl
+ESDAO_PULL_CACHE = {}
+ESDAO_PULL_CACHE_DEFAULT_TTL = 60
+
+# Number of records RollingTypeESDAO.rebuild writes between checkpoints, and the order
+# in which it reads the current type (which must be stable for a rebuild to be resumed)
+ESDAO_REBUILD_CHUNK_SIZE = 1000
+ESDAO_REBUILD_SORT = [{"id.exact" : {"order" : "asc"}}]
+
+# Whether to record how long each ESDAO operation takes (per DAO class), along with payload sizes
+# and hit counts.  The results are available from octopus.modules.es.dao.timing_stats, or over
+# the octopus.modules.es.timings blueprint
+ESDAO_TIMING = True
+
+# Upper bounds (in milliseconds) of the buckets in the latency histogram for each operation
+ESDAO_TIMING_BUCKETS = [10, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# Operations which take longer than this many seconds are logged, along with their query (None to not log).
+# Saved documents are not logged, only their size
+ESDAO_SLOW_QUERY_THRESHOLD = 2.0
+
 # map of type names to DAOs which will have the publish() or rollback()
 # methods called on them
 # {"mytype" : "service.dao.MyDAO"}
@@ -135,6 +193,26 @@ QUERY_ROUTE = {}
 # query filters that are used in the above QUERY_ROUTE (see below for an example)
 QUERY_FILTERS = {}
 
+# Whether search responses are streamed from the index to the client chunk by chunk, rather than
+# being read into memory first.  Can be overridden for each index with "stream" in its QUERY_ROUTE config.
+# Only DAOs with query_stream (i.e. ESDAO) stream, and any override of query() on the DAO is not used
+QUERY_STREAM = False
+
+# Maximum size in bytes of a streamed search response (0 for no limit).  Can be overridden for each index
+# with "max_response_size" in its QUERY_ROUTE config
+QUERY_MAX_RESPONSE_SIZE = 0
+
+# Seconds the index may spend on a streamed search before returning what it has (None for no limit).
+# Can be overridden for each index with "timeout" in its QUERY_ROUTE config
+QUERY_TIMEOUT = None
+
+# Size of the chunks in which a streamed search response is passed on
+QUERY_STREAM_CHUNK_SIZE = 65536
+
+# Number of recently seen queries whose outcome each query sanitiser (octopus.modules.es.sanitise)
+# remembers, so that they are not validated again (0 to turn this off)
+QUERY_SANITISER_CACHE_SIZE = 1000
+
 """
 e.g.
 QUERY_ROUTE = {
@@ -143,7 +221,10 @@ QUERY_ROUTE = {
             "auth" : False,                     # whether the route requires authentication
             "role" : None,                      # if authenticated, what role is required to access the query endpoint
             "filters" : ["default"],            # names of the standard filters to apply to the query
-            "dao" : "octopus.dao.MyDAO"       # classpath for DAO which accesses the underlying ES index
+            "dao" : "octopus.dao.MyDAO",      # classpath for DAO which accesses the underlying ES index
+            "stream" : True,                    # (optional) override QUERY_STREAM for this index
+            "max_response_size" : 10485760,     # (optional) override QUERY_MAX_RESPONSE_SIZE for this index
+            "timeout" : 10                      # (optional) override QUERY_TIMEOUT for this index
         }
     }
 }
@@ -178,7 +259,15 @@ SEARCHAPI = {
         },
         "query_builder" : "octopus.modules.es.dao.SearchAPIQuery",      # class to use to build the query.  Implementations may use this to apply specific constraints.  Should extend octopus.modules.es.dao.SearchAPIQuery
         "dao" : "octopus.modules.es.dao.ESDAO",                         # DAO through which to access the index
-        "results_filter" : None                                         # filter to apply to each result before returning it
+        "results_filter" : None,                                        # filter to apply to each result before returning it
+        "cursor_tiebreak" : "id.exact",                                 # unique field to sort on last, so that cursor pagination (?cursor=*) never skips or repeats results (ES 5.x+)
+        "cursor_keepalive" : "5m",                                      # on ES before 5.x cursors are scroll contexts, kept open this long between requests
+        "export" : False,                                               # whether to allow the whole result set to be streamed as newline delimited JSON from <path>/export
+        "cache" : {                                                     # in-memory cache of search results (leave out, or set size to 0, for no cache)
+            "size" : 0,                                                 # maximum number of distinct searches to hold
+            "ttl" : 60,                                                 # how many seconds a result may be served from the cache
+            "per_account" : False                                       # whether the query_builder's query depends on the account (not just its roles), so results can't be shared
+        }
     }
 }
 
@@ -212,7 +301,11 @@ AUTOCOMPLETE_COMPOUND = {
         "input_filter" : lambda x : x ,         # function to apply to an incoming string before being applied to the es query
         "default_size" : 10,                    # if no size param is specified, this is how big to make the response
         "max_size" : 25,                        # if a size param is specified, this is the limit above which it won't go
-        "dao" : "octopus.dao.MyDAO"             # classpath for DAO which accesses the underlying ES index
+        "dao" : "octopus.dao.MyDAO",            # classpath for DAO which accesses the underlying ES index
+        "prefix_index" : {                      # optional: answer from an in-memory copy of the fields, rather than querying the index each time
+            "refresh" : 3600,                   # how often (in seconds) to rebuild the in-memory copy
+            "max_records" : 50000               # don't hold the records in memory if there are more than this many
+        }
     }
 }
 """
@@ -241,7 +334,11 @@ AUTOCOMPLETE_TERM = {
         "input_filter" : lambda x : x,          # function to apply to an incoming string before being applied to the es query
         "default_size" : 10,                    # if no size param is specified, this is how big to make the response
         "max_size" : 25,                        # if a size param is specified, this is the limit above which it won't go
-        "dao" : "octopus.dao.MyDAO"             # classpath for DAO which accesses the underlying ES index
+        "dao" : "octopus.dao.MyDAO",            # classpath for DAO which accesses the underlying ES index
+        "prefix_index" : {                      # optional: answer from an in-memory copy of the facet terms, rather than querying the index each time.  Matching is against the terms themselves
+            "refresh" : 3600,                   # how often (in seconds) to rebuild the in-memory copy
+            "max_terms" : 100000                # don't hold the terms if there are this many or more
+        }
     }
 }
 """
@@ -0,0 +1,145 @@
+from unittest import TestCase
+from flask import Flask
+from octopus.core import app
+from octopus.modules.es import autocomplete
+import json, time, threading
+
+class MockAutocompleteDAO(object):
+    queries = []
+    terms = [("apple", 5), ("apricot", 2), ("banana", 7), ("grape", 1), ("pineapple", 3), ("applesauce", 9)]
+    records = [
+        {"id" : "1", "name" : "Apple Journal", "issn" : ["1234-5678"], "other" : "x"},
+        {"id" : "2", "name" : "Banana Review", "issn" : ["2345-6789", "1234-0000"]},
+        {"id" : "3", "name" : "Apples Today", "issn" : []}
+    ]
+
+    @classmethod
+    def query(cls, q=None):
+        cls.queries.append(q)
+        if "facets" in q:
+            facet = q["facets"].keys()[0]
+            size = q["facets"][facet]["terms"]["size"]
+            terms = [{"term" : t, "count" : c} for t, c in cls.terms[:size]]
+            other = sum([c for t, c in cls.terms[size:]])
+            return {"facets" : {facet : {"terms" : terms, "other" : other}}}
+        return {"hits" : {"hits" : [{"_source" : {"name" : "from the index"}}]}}
+
+    @classmethod
+    def stream(cls, q=None, source=None, wrap=True):
+        for r in cls.records:
+            yield r
+
+class TestAutocomplete(TestCase):
+    def setUp(self):
+        super(TestAutocomplete, self).setUp()
+        self.old_term = app.config.get("AUTOCOMPLETE_TERM")
+        self.old_compound = app.config.get("AUTOCOMPLETE_COMPOUND")
+        app.config["AUTOCOMPLETE_TERM"] = {
+            "fruit" : {
+                "filter" : {"fruit.exact" : {"start_wildcard" : False, "end_wildcard" : True}},
+                "facet" : "fruit.exact",
+                "default_size" : 10,
+                "max_size" : 25,
+                "dao" : "octopus.modules.es.tests.unit.test_autocomplete.MockAutocompleteDAO",
+                "prefix_index" : {"refresh" : 3600}
+            }
+        }
+        app.config["AUTOCOMPLETE_COMPOUND"] = {
+            "journal" : {
+                "fields" : ["name", "issn"],
+                "field_name_map" : {"name" : "title"},
+                "filters" : {
+                    "name.exact" : {"start_wildcard" : True, "end_wildcard" : True, "boost" : 2.0},
+                    "issn.exact" : {"start_wildcard" : False, "end_wildcard" : True, "boost" : 1.0}
+                },
+                "default_size" : 10,
+                "max_size" : 25,
+                "dao" : "octopus.modules.es.tests.unit.test_autocomplete.MockAutocompleteDAO",
+                "prefix_index" : {"refresh" : 3600}
+            }
+        }
+        autocomplete._indices.clear()
+        MockAutocompleteDAO.queries = []
+
+        webapp = Flask(__name__)
+        webapp.register_blueprint(autocomplete.blueprint, url_prefix="/autocomplete")
+        self.client = webapp.test_client()
+
+    def tearDown(self):
+        super(TestAutocomplete, self).tearDown()
+        app.config["AUTOCOMPLETE_TERM"] = self.old_term
+        app.config["AUTOCOMPLETE_COMPOUND"] = self.old_compound
+        autocomplete._indices.clear()
+
+    def test_01_prefix_index(self):
+        index = autocomplete.PrefixIndex([("banana", 1), ("apple", 2), ("applesauce", 3), ("pineapple", 4), ("grape", 5)])
+        assert len(index) == 5
+        assert index.matches("app") == [("apple", 2), ("applesauce", 3)]
+        assert index.matches("app*", end_wildcard=True) == [("apple", 2), ("applesauce", 3)]
+        assert index.matches("apple", end_wildcard=False) == [("apple", 2)]
+        assert index.matches("apple", start_wildcard=True, end_wildcard=True) == [("apple", 2), ("applesauce", 3), ("pineapple", 4)]
+        assert index.matches("ape", start_wildcard=True, end_wildcard=False) == [("grape", 5)]
+        assert index.matches("zzz") == []
+
+    def _wait_for(self, kind, name):
+        # wait for the background build of the index to finish
+        for i in range(100):
+            if autocomplete._indices[(kind, name)]._value is not None:
+                return
+            time.sleep(0.01)
+
+    def test_02_term(self):
+        self.client.get("/autocomplete/term/fruit?q=app")
+        self._wait_for("term", "fruit")
+        count = len(MockAutocompleteDAO.queries)
+
+        resp = self.client.get("/autocomplete/term/fruit?q=app")
+        assert json.loads(resp.data) == ["applesauce", "apple"]
+        resp = self.client.get("/autocomplete/term/fruit?q=a&size=2")
+        assert json.loads(resp.data) == ["applesauce", "apple"]
+        assert len(MockAutocompleteDAO.queries) == count
+
+    def test_03_compound(self):
+        self.client.get("/autocomplete/compound/journal?q=Apple")
+        self._wait_for("compound", "journal")
+
+        resp = self.client.get("/autocomplete/compound/journal?q=Apple")
+        assert json.loads(resp.data) == [{"title" : "Apple Journal", "issn" : ["1234-5678"]}, {"title" : "Apples Today", "issn" : []}]
+
+        # the name matches are boosted above the issn ones
+        resp = self.client.get("/autocomplete/compound/journal?q=1234")
+        assert [r["title"] for r in json.loads(resp.data)] == ["Apple Journal", "Banana Review"]
+        resp = self.client.get("/autocomplete/compound/journal?q=view")
+        assert [r["title"] for r in json.loads(resp.data)] == ["Banana Review"]
+
+    def test_04_cold_index(self):
+        go = threading.Event()
+        def build():
+            go.wait()
+            return "built"
+
+        index = autocomplete.BackgroundIndex("test", build, 3600)
+        assert index.get() is None
+        go.set()
+        for i in range(100):
+            if index.get() is not None:
+                break
+            time.sleep(0.01)
+        assert index.get() == "built"
+
+        # without an in-memory index, the endpoints query the index
+        app.config["AUTOCOMPLETE_COMPOUND"]["journal"]["prefix_index"] = None
+        resp = self.client.get("/autocomplete/compound/journal?q=Apple")
+        assert json.loads(resp.data) == [{"title" : "from the index"}]
+
+    def test_05_too_many_terms(self):
+        cfg = app.config["AUTOCOMPLETE_TERM"]["fruit"]
+        assert autocomplete._build_term_index(cfg) is not None
+
+        # if the facet can't hold every term, the index isn't used and requests go to the index
+        cfg["prefix_index"]["max_terms"] = 3
+        assert autocomplete._build_term_index(cfg) is None
+
+        # even if the index doesn't say how many it left out
+        cfg["prefix_index"]["max_terms"] = len(MockAutocompleteDAO.terms)
+        assert autocomplete._build_term_index(cfg) is None
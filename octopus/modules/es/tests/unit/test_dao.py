@@ -0,0 +1,688 @@
+from unittest import TestCase
+import json, esprit, tempfile, shutil, time
+from datetime import timedelta
+from copy import deepcopy
+from octopus.core import app
+from octopus.lib import http, dataobj
+from octopus.modules.es import dao
+
+class BulkDAO(dao.ESDAO):
+    __type__ = "bulk"
+
+    def prep(self):
+        self.data["prepped"] = True
+
+class ChangesDAO(dataobj.DataObj, dao.ESDAO):
+    __type__ = "changes"
+    TRACK_CHANGES = True
+
+    def __init__(self, raw=None):
+        struct = {
+            "fields" : {"id" : {"coerce" : "unicode"}, "status" : {"coerce" : "unicode"}, "last_updated" : {"coerce" : "utcdatetime"}},
+            "objects" : ["admin"],
+            "structs" : {"admin" : {"fields" : {"note" : {"coerce" : "unicode"}, "owner" : {"coerce" : "unicode"}}}}
+        }
+        super(ChangesDAO, self).__init__(raw, struct=struct)
+
+    def save(self, **kwargs):
+        ChangesDAO.full_saves.append(kwargs)
+        self.mark_clean()
+
+class CachedDAO(dao.ESDAO):
+    __type__ = "cached"
+    __pull_cache_size__ = 2
+    __pull_cache_ttl__ = 60
+
+class RollingDAO(dao.RollingTypeESDAO):
+    __type__ = "rolling"
+
+class BoxedDAO(dao.TimeBoxedTypeESDAO):
+    __type__ = "boxed"
+
+def rebuild_transform(raw):
+    if raw["id"] == "3":
+        return None
+    raw["transformed"] = True
+    return raw
+
+class MockBulkIndex(object):
+    """
+    Stands in for http.post, recording each _bulk request and failing the records
+    whose ids are listed in fail (with the status given), until they have been tried
+    the given number of times
+    """
+    def __init__(self, fail=None, tries=1):
+        self.fail = fail if fail is not None else {}
+        self.tries = tries
+        self.attempts = {}
+        self.requests = []
+
+    def __call__(self, url, data=None, **kwargs):
+        lines = data.strip().split("\n")
+        self.requests.append((url, lines))
+        items = []
+        for i in range(0, len(lines), 2):
+            action = json.loads(lines[i])
+            op = action.keys()[0]
+            id = action[op]["_id"]
+            self.attempts[id] = self.attempts.get(id, 0) + 1
+            if id in self.fail and self.attempts[id] <= self.tries:
+                items.append({op : {"_id" : id, "status" : self.fail[id], "error" : "failed"}})
+            else:
+                items.append({op : {"_id" : id, "status" : 201}})
+        return http.MockResponse(200, json.dumps({"errors" : False, "items" : items}))
+
+class MockScrollIndex(object):
+    """
+    Stands in for http.post and http.delete, serving the given documents through the scroll
+    API in the style of the given ES version
+    """
+    def __init__(self, docs, es_version):
+        self.docs = docs
+        self.esv = dao._es_version_tuple(es_version)
+        self.scrolls = {}
+        self.queries = []
+        self.cleared = []
+
+    def _page(self, sid, scan_start=False):
+        docs, size = self.scrolls[sid]
+        hits = [] if scan_start else [{"_id" : d.get("id"), "_source" : d} for d in docs[:size]]
+        if not scan_start:
+            self.scrolls[sid] = (docs[size:], size)
+        return http.MockResponse(200, json.dumps({"_scroll_id" : sid, "hits" : {"hits" : hits}}))
+
+    def post(self, url, data=None, **kwargs):
+        if "/_search/scroll" in url:
+            sid = data if self.esv < (2, 0) else json.loads(data)["scroll_id"]
+            return self._page(sid)
+
+        query = json.loads(data)
+        self.queries.append((url, query))
+        docs = self.docs
+        if "slice" in query:
+            docs = [d for i, d in enumerate(docs) if i % query["slice"]["max"] == query["slice"]["id"]]
+        if isinstance(query.get("_source"), list):
+            docs = [dict([(k, v) for k, v in d.iteritems() if k in query["_source"]]) for d in docs]
+        sid = "scroll" + str(len(self.scrolls))
+        self.scrolls[sid] = (docs, query["size"])
+        return self._page(sid, scan_start="search_type=scan" in url)
+
+    def delete(self, url, data=None, **kwargs):
+        self.cleared.append(data if data is not None else url)
+        return http.MockResponse(200, "{}")
+
+class TestDAO(TestCase):
+    def setUp(self):
+        super(TestDAO, self).setUp()
+        self.old_post = http.post
+        self.old_delete = http.delete
+        self.old_make_request = http._make_request
+        self.old_esv = BulkDAO.__es_version__
+
+    def tearDown(self):
+        super(TestDAO, self).tearDown()
+        http.post = self.old_post
+        http.delete = self.old_delete
+        http._make_request = self.old_make_request
+        BulkDAO.__es_version__ = self.old_esv
+
+    def test_01_bulk_save_chunks(self):
+        index = MockBulkIndex()
+        http.post = index
+
+        objs = [BulkDAO({"id" : str(i), "value" : "x" * i}) for i in range(10)]
+        failures = BulkDAO.bulk_save(objs, chunk_size=4, refresh=True)
+        assert failures == []
+
+        # chunked by count, with only the last request refreshing the index
+        assert [len(r[1]) / 2 for r in index.requests] == [4, 4, 2]
+        assert "refresh=true" not in index.requests[0][0]
+        assert index.requests[-1][0].endswith("/bulk/_bulk?refresh=true")
+
+        doc = json.loads(index.requests[0][1][1])
+        assert doc["prepped"] is True
+        assert "created_date" in doc
+        assert "last_updated" in doc
+
+        # chunked by size
+        index.requests = []
+        entry_size = len(dao._BulkEntry(objs[5]).line)
+        BulkDAO.bulk_save(objs[5:], chunk_bytes=entry_size * 2)
+        assert [len(r[1]) / 2 for r in index.requests] == [2, 2, 1]
+
+        # ids are minted where needed
+        index.requests = []
+        BulkDAO.bulk_save([BulkDAO({"value" : "new"})])
+        assert json.loads(index.requests[0][1][0])["index"]["_id"] is not None
+
+    def test_02_bulk_failures(self):
+        index = MockBulkIndex(fail={"1" : 429, "2" : 400}, tries=1)
+        http.post = index
+
+        sleeps = []
+        old_sleep = dao.time.sleep
+        dao.time.sleep = sleeps.append
+        try:
+            objs = [BulkDAO({"id" : str(i)}) for i in range(4)]
+            with BulkDAO.bulk_writer(chunk_size=10, retries=1) as writer:
+                for o in objs:
+                    writer.add(o)
+        finally:
+            dao.time.sleep = old_sleep
+
+        # the index is given time to recover before the retry
+        assert sleeps == [http._backoff(1, app.config.get("HTTP_BACK_OFF_FACTOR", 1), app.config.get("HTTP_MAX_BACK_OFF", 30))]
+
+        # the retryable failure is sent again on its own and succeeds, the other is reported
+        assert len(index.requests) == 2
+        assert len(index.requests[1][1]) == 2
+        assert writer.written == 3
+        assert len(writer.failures) == 1
+        assert writer.failures[0][0] is objs[2]
+
+        # a failure of the whole request fails every record in it
+        http.post = lambda url, **kwargs: None
+        failures = BulkDAO.bulk_save(objs, retries=0)
+        assert [f[0] for f in failures] == objs
+
+    def test_03_stream_old_versions(self):
+        docs = [{"id" : str(i), "title" : "t" + str(i), "other" : {"a" : i, "b" : i}} for i in range(25)]
+        index = MockScrollIndex(docs, "0.90.13")
+        http.post = index.post
+        http.delete = index.delete
+        BulkDAO.__es_version__ = "0.90.13"
+
+        results = list(BulkDAO.stream(page_size=10, slices=4))
+        assert [r.data for r in results] == docs
+        assert isinstance(results[0], BulkDAO)
+
+        # scan is used, slicing is ignored, and the scroll is cleared
+        url, query = index.queries[0]
+        assert "search_type=scan" in url
+        assert "slice" not in query
+        assert len(index.cleared) == 1
+
+        # source filtering is done client side
+        results = list(BulkDAO.stream(source=["id", "other.a"], wrap=False))
+        assert "_source" not in index.queries[1][1]
+        assert results[3] == {"id" : "3", "other" : {"a" : 3}}
+
+        # stopping early still clears the scroll
+        results = list(BulkDAO.stream(page_size=10, limit=12))
+        assert len(results) == 12
+        assert len(index.cleared) == 3
+
+    def test_04_stream_sliced(self):
+        docs = [{"id" : str(i), "title" : "t" + str(i)} for i in range(103)]
+        index = MockScrollIndex(docs, "5.6.0")
+        http.post = index.post
+        http.delete = index.delete
+        BulkDAO.__es_version__ = "5.6.0"
+
+        results = list(BulkDAO.stream(page_size=10, wrap=False, source="title"))
+        assert results == [{"title" : d["title"]} for d in docs]
+        assert index.queries[0][1]["sort"] == ["_doc"]
+
+        # each slice is scrolled in parallel, and everything comes back once
+        index.queries = []
+        results = list(BulkDAO.stream(page_size=10, slices=3, wrap=False))
+        assert sorted(results) == sorted(docs)
+        assert sorted([q[1]["slice"]["id"] for q in index.queries]) == [0, 1, 2]
+
+        # or a single slice can be requested on its own
+        results = list(BulkDAO.stream(page_size=10, slices=3, slice_id=1, wrap=False))
+        assert results == docs[1::3]
+
+        # stopping early shuts down all the slices
+        cleared = len(index.cleared)
+        results = list(BulkDAO.stream(page_size=5, slices=3, limit=7, wrap=False))
+        assert len(results) == 7
+        assert len(index.cleared) == cleared + 3
+
+    def test_05_pull_many(self):
+        store = {
+            "t1" : {"1" : {"id" : "1", "v" : "t1"}, "3" : {"id" : "3", "v" : "t1"}},
+            "t2" : {"1" : {"id" : "1", "v" : "t2"}, "2" : {"id" : "2", "v" : "t2"}}
+        }
+        requests = []
+        def post(url, data=None, **kwargs):
+            body = json.loads(data)
+            requests.append((url, body))
+            if "ids" in body:
+                t = url.split("/")[-2]
+                wanted = [(id, t) for id in body["ids"]]
+            else:
+                wanted = [(d["_id"], d["_type"]) for d in body["docs"]]
+            docs = []
+            for id, t in wanted:
+                if id in store[t]:
+                    docs.append({"_id" : id, "_type" : t, "found" : True, "_source" : store[t][id]})
+                else:
+                    docs.append({"_id" : id, "_type" : t, "found" : False})
+            return http.MockResponse(200, json.dumps({"docs" : docs}))
+        http.post = post
+
+        # a single type, in chunks, in the order asked for, with duplicates and misses
+        objs = BulkDAO.pull_many(["3", "4", "1", "3", "5"], chunk_size=2, types="t1")
+        assert len(requests) == 2
+        assert requests[0][0].endswith("/t1/_mget")
+        assert [o.data if o is not None else None for o in objs] == [store["t1"]["3"], None, store["t1"]["1"], store["t1"]["3"], None]
+        assert isinstance(objs[0], BulkDAO)
+
+        # several types, where the earlier types take precedence
+        requests = []
+        objs = BulkDAO.pull_many(["2", "1", "3", "4"], types=["t2", "t1"], wrap=False)
+        assert len(requests) == 1
+        assert objs == [store["t2"]["2"], store["t2"]["1"], store["t1"]["3"], None]
+
+        assert BulkDAO.pull_many([]) == []
+
+    def test_06_pull_cache(self):
+        store = {"1" : {"id" : "1"}, "2" : {"id" : "2"}, "3" : {"id" : "3"}}
+        pulls = []
+        def pull(cls, id_, conn=None, wrap=True, types=None):
+            pulls.append(id_)
+            return deepcopy(store.get(id_))
+        def save(self, **kwargs):
+            store[self.data["id"]] = deepcopy(self.data)
+        def delete(self, **kwargs):
+            del store[self.data["id"]]
+
+        old = dict([(k, esprit.dao.DomainObject.__dict__[k]) for k in ["pull", "save", "delete"]])
+        esprit.dao.DomainObject.pull = classmethod(pull)
+        esprit.dao.DomainObject.save = save
+        esprit.dao.DomainObject.delete = delete
+        try:
+            assert BulkDAO.pull_cache() is None
+            assert BulkDAO.pull_cache_stats() is None
+
+            # repeated pulls are served from the cache, and changes to the result don't leak back into it
+            obj = CachedDAO.pull("1")
+            obj.data["changed"] = True
+            obj = CachedDAO.pull("1")
+            assert "changed" not in obj.data
+            assert isinstance(obj, CachedDAO)
+            assert pulls == ["1"]
+
+            # misses are not cached
+            assert CachedDAO.pull("4") is None
+            assert CachedDAO.pull("4") is None
+            assert pulls == ["1", "4", "4"]
+
+            # least recently used records are evicted
+            CachedDAO.pull("2")
+            CachedDAO.pull("3")
+            CachedDAO.pull("1")
+            assert pulls[-3:] == ["2", "3", "1"]
+
+            # saving and deleting invalidates the record
+            obj = CachedDAO.pull("1")
+            obj.data["title"] = "new"
+            obj.save()
+            assert CachedDAO.pull("1").data["title"] == "new"
+            obj.delete()
+            assert CachedDAO.pull("1") is None
+
+            stats = CachedDAO.pull_cache_stats()
+            assert stats["size"] == 1
+            assert stats["max_size"] == 2
+            assert stats["hits"] == 2
+            assert stats["evictions"] == 2
+
+            # expired records are pulled again
+            CachedDAO.pull_cache().ttl = -1
+            CachedDAO.pull("2")
+            CachedDAO.pull("2")
+            assert pulls[-2:] == ["2", "2"]
+        finally:
+            for k, v in old.iteritems():
+                setattr(esprit.dao.DomainObject, k, v)
+            dao._pull_caches.clear()
+
+    def test_07_rebuild(self):
+        rolling_dir = app.config.get("ESDAO_ROLLING_DIR")
+        tmp = tempfile.mkdtemp()
+        app.config["ESDAO_ROLLING_DIR"] = tmp
+        index = MockBulkIndex()
+        http.post = index
+        try:
+            records = [{"id" : str(i)} for i in range(10)]
+            def flaky_source():
+                for r in records[:7]:
+                    yield deepcopy(r)
+                raise IOError("source went away")
+
+            # the rebuild fails part way through, after 2 chunks have been written
+            with self.assertRaises(IOError):
+                RollingDAO.rebuild(source=flaky_source(), chunk_size=3)
+            status = RollingDAO.rebuild_status()
+            assert status["done"] == 6
+            assert status["complete"] is False
+            assert RollingDAO.rolling_status()["rebuild"] == status
+
+            # so it can't be published yet
+            with self.assertRaises(dao.ESDAOException):
+                RollingDAO.publish()
+
+            # resuming carries on from the last checkpoint, in worker processes
+            progress = []
+            index.requests = []
+            records[8]["id"] = "3"
+            status = RollingDAO.rebuild(source=(deepcopy(r) for r in records), transform=rebuild_transform, processes=2, chunk_size=3, progress=lambda s: progress.append(s["done"]))
+            assert progress == [9, 10]
+            assert status["complete"] is True
+            assert status["written"] == 9
+            assert status["skipped"] == 1
+            assert status["type"] == RollingDAO._get_file("next")
+
+            written = [json.loads(line) for url, lines in index.requests for line in lines[1::2]]
+            assert [w["id"] for w in written] == ["6", "7", "9"]
+            assert all([w["transformed"] for w in written])
+            assert index.requests[0][0].endswith("/" + status["type"] + "/_bulk")
+
+            # now the type can be published, and the rebuild record is cleared
+            RollingDAO.publish()
+            assert RollingDAO._get_file("curr") == status["type"]
+            assert RollingDAO.rebuild_status() is None
+        finally:
+            app.config["ESDAO_ROLLING_DIR"] = rolling_dir
+            shutil.rmtree(tmp)
+
+    def test_08_time_box_pruning(self):
+        app.config["ESDAO_TIME_BOX_BOXED"] = "day"
+        app.config["ESDAO_TIME_BOX_LOOKBACK_BOXED"] = 10
+        try:
+            boxes = BoxedDAO._time_boxes()
+            assert BoxedDAO._time_boxes() is boxes
+            assert len(boxes) == 11
+            all_types = BoxedDAO.dynamic_read_types()
+            assert all_types == [b[0] for b in boxes]
+
+            today = boxes[0][1]
+            def fmt(d):
+                return d.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+            # no range, or a range on another field, reads every box
+            assert BoxedDAO.read_types_for_query({"query" : {"match_all" : {}}}) == all_types
+            q = {"query" : {"range" : {"created_date" : {"gte" : fmt(today)}}}}
+            assert BoxedDAO.read_types_for_query(q) == all_types
+
+            # recent data only needs the most recent boxes
+            q = {"query" : {"bool" : {"must" : [{"term" : {"a" : "b"}}, {"range" : {"last_updated" : {"gte" : "now-1d"}}}]}}}
+            assert BoxedDAO.read_types_for_query(q) == all_types[:2]
+
+            # a closed window in the middle of the lookback still reads every later box, since records saved
+            # there may have older dates
+            q = {"query" : {"filtered" : {
+                "query" : {"match_all" : {}},
+                "filter" : {"range" : {"last_updated" : {"gte" : fmt(boxes[5][1]), "lt" : fmt(boxes[3][1])}}}
+            }}}
+            assert BoxedDAO.read_types_for_query(q) == all_types[:6]
+
+            # so an upper bound on its own doesn't prune
+            q = {"query" : {"range" : {"last_updated" : {"lte" : "1970-01-01T00:00:00Z"}}}}
+            assert BoxedDAO.read_types_for_query(q) == all_types
+
+            # ranges which are not required of every result don't prune
+            q = {"query" : {"bool" : {"should" : [{"range" : {"last_updated" : {"gte" : "now-1d"}}}]}}}
+            assert BoxedDAO.read_types_for_query(q) == all_types
+            q = {"query" : {"range" : {"last_updated" : {"gte" : "now-1d/d"}}}}
+            assert BoxedDAO.read_types_for_query(q) == all_types
+
+            # nothing in the window still targets one type
+            q = {"query" : {"range" : {"last_updated" : {"gte" : "now+2d"}}}}
+            assert BoxedDAO.read_types_for_query(q) == all_types[:1]
+        finally:
+            del app.config["ESDAO_TIME_BOX_BOXED"]
+            del app.config["ESDAO_TIME_BOX_LOOKBACK_BOXED"]
+
+    def test_09_scroll_page(self):
+        docs = [{"id" : str(i)} for i in range(15)]
+        index = MockScrollIndex(docs, "1.7.0")
+        http.post = index.post
+        http.delete = index.delete
+        BulkDAO.__es_version__ = "1.7.0"
+
+        res = BulkDAO.scroll_page(q={"query" : {"match_all" : {}}, "size" : 10}, keepalive="5m")
+        assert [h["_source"] for h in res["hits"]["hits"]] == docs[:10]
+        assert "scroll=5m" in index.queries[0][0]
+        assert "search_type=scan" not in index.queries[0][0]
+
+        res = BulkDAO.scroll_page(scroll_id=res["_scroll_id"])
+        assert [h["_source"] for h in res["hits"]["hits"]] == docs[10:]
+
+    def test_10_query_stream(self):
+        body = json.dumps({"hits" : {"hits" : [{"_source" : {"id" : str(i)}} for i in range(100)]}})
+        requests = []
+        def make_request(method, url, **kwargs):
+            requests.append((method, url, kwargs))
+            return http.MockResponse(200, body, {"content-length" : str(len(body))})
+        http._make_request = make_request
+
+        status, chunks = BulkDAO.query_stream(q={"query" : {"match_all" : {}}}, timeout=2, chunk_size=100)
+        parts = list(chunks)
+        assert status == 200
+        assert "".join(parts) == body
+        assert max([len(p) for p in parts]) == 100
+
+        method, url, kwargs = requests[0]
+        assert method == "POST"
+        assert url.endswith("/bulk/_search")
+        assert json.loads(kwargs["data"])["timeout"] == "2000ms"
+        assert kwargs["timeout"] == 4
+        assert kwargs["stream"] is True
+        assert kwargs["retry_on_timeout"] is False
+
+        # a response which announces that it is too large is refused before it is read
+        with self.assertRaises(http.SizeExceededException):
+            BulkDAO.query_stream(size_limit=100)
+
+        # no response at all
+        http._make_request = lambda method, url, **kwargs: None
+        with self.assertRaises(dao.ESDAOException):
+            BulkDAO.query_stream()
+
+    def test_11_throttled_delete(self):
+        docs = [{"id" : str(i)} for i in range(25)]
+        index = MockScrollIndex(docs, "5.6.0")
+        bulks = []
+        def post(url, data=None, **kwargs):
+            if url.endswith("/_bulk"):
+                lines = [json.loads(l) for l in data.strip().split("\n")]
+                bulks.append(lines)
+                # the first record has already gone, and the second can't be deleted
+                items = [{"delete" : {"_id" : l["delete"]["_id"], "status" : {"0" : 404, "1" : 500}.get(l["delete"]["_id"], 200)}} for l in lines]
+                return http.MockResponse(200, json.dumps({"items" : items}))
+            return index.post(url, data, **kwargs)
+        http.post = post
+        http.delete = index.delete
+        BulkDAO.__es_version__ = "5.6.0"
+
+        progress = []
+        start = time.time()
+        status = BulkDAO.throttled_delete_by_query({"query" : {"term" : {"a" : "b"}}, "size" : 5}, batch_size=10, rate=20, progress=progress.append)
+        assert time.time() - start >= 0.09
+
+        assert status == {"deleted" : 23, "failed" : 1}
+        assert [len(b) for b in bulks] == [10, 10, 5]
+        assert bulks[0][2] == {"delete" : {"_type" : "bulk", "_id" : "2"}}
+        assert [p["deleted"] for p in progress] == [8, 18, 23]
+
+        # only the ids were asked for, and the scroll was cleared
+        url, query = index.queries[0]
+        assert query["query"] == {"term" : {"a" : "b"}}
+        assert query["_source"] is False
+        assert query["size"] == 10
+        assert len(index.cleared) == 1
+
+        # delete_by_query hands over to the throttled delete when asked
+        index.queries = []
+        bulks[:] = []
+        BulkDAO.delete_by_query({"query" : {"match_all" : {}}}, throttled=True, batch_size=100)
+        assert [len(b) for b in bulks] == [25]
+
+    def test_12_timings(self):
+        dao.reset_timings()
+        docs = [{"id" : str(i)} for i in range(5)]
+        index = MockScrollIndex(docs, "5.6.0")
+        http.post = index.post
+        http.delete = index.delete
+        BulkDAO.__es_version__ = "5.6.0"
+
+        thresh = app.config.get("ESDAO_SLOW_QUERY_THRESHOLD")
+        app.config["ESDAO_SLOW_QUERY_THRESHOLD"] = 0
+        try:
+            q = {"query" : {"match_all" : {}}}
+            for doc in BulkDAO.stream(q=q, page_size=2):
+                time.sleep(0.02)
+        finally:
+            app.config["ESDAO_SLOW_QUERY_THRESHOLD"] = thresh
+
+        stats = dao.timing_stats()["BulkDAO"]
+        stream = stats["stream"]
+        assert stream["count"] == 1
+        assert stream["hits"] == 5
+        assert stream["slow"] == 1
+        assert stream["payload_bytes"] is None
+        # the time the caller spent on each record is not counted
+        assert stream["total_ms"] < 100
+        assert sum(stream["histogram_ms"].values()) == 1
+        assert stats["read_types"]["count"] >= 1
+
+        dao.reset_timings()
+        assert dao.timing_stats() == {}
+
+        app.config["ESDAO_TIMING"] = False
+        try:
+            list(BulkDAO.stream(q=q))
+        finally:
+            app.config["ESDAO_TIMING"] = True
+        assert dao.timing_stats() == {}
+
+    def test_13_save_changes(self):
+        requests = []
+        def post(url, data=None, **kwargs):
+            requests.append((url, data))
+            if "missing" in url:
+                return http.MockResponse(404, "{}")
+            return http.MockResponse(200, "{}")
+        http.post = post
+        ChangesDAO.full_saves = []
+
+        obj = ChangesDAO({"id" : "abc", "status" : "new", "admin" : {"note" : "a note", "owner" : "someone"}})
+
+        # nothing changed, so nothing is written
+        obj.save_changes()
+        assert requests == []
+
+        # only the changed field (and last_updated) is sent
+        obj._set_single("status", "done")
+        obj.save_changes(refresh=True)
+        assert len(requests) == 1
+        assert requests[0][0].endswith("/changes/abc/_update?refresh=true")
+        body = json.loads(requests[0][1])
+        assert body["doc"]["status"] == "done"
+        assert "last_updated" in body["doc"]
+        assert "admin" not in body["doc"]
+        assert ChangesDAO.full_saves == []
+        assert not obj.is_dirty()
+
+        # changes inside an object are sent as a nested document
+        obj._set_single("admin.note", "another note")
+        obj.save_changes(updated=False)
+        assert json.loads(requests[1][1]) == {"doc" : {"admin" : {"note" : "another note"}}}
+
+        # deletes, and records which are not in the index, are saved in full
+        obj._delete("admin.note")
+        obj.save_changes()
+        assert len(requests) == 2
+        assert len(ChangesDAO.full_saves) == 1
+
+        missing = ChangesDAO({"id" : "missing", "status" : "new"})
+        missing._set_single("status", "done")
+        missing.save_changes()
+        assert len(requests) == 3
+        assert len(ChangesDAO.full_saves) == 2
+
+        # in bulk, the changes are sent as update lines
+        index = MockBulkIndex()
+        http.post = index
+        objs = [ChangesDAO({"id" : str(i), "status" : "new"}) for i in range(3)]
+        objs[0]._set_single("status", "done")
+        objs[2]._set_single("status", "done")
+        with ChangesDAO.bulk_writer(updated=False) as writer:
+            for o in objs:
+                writer.add_changes(o)
+        lines = index.requests[0][1]
+        assert len(lines) == 4
+        assert json.loads(lines[0]) == {"update" : {"_id" : "0"}}
+        assert json.loads(lines[1]) == {"doc" : {"status" : "done"}}
+        assert writer.written == 2
+
+    def test_14_time_box_date_bounds(self):
+        app.config["ESDAO_TIME_BOX_BOXED"] = "hour"
+        app.config["ESDAO_TIME_BOX_LOOKBACK_BOXED"] = 48
+        try:
+            boxes = BoxedDAO._time_boxes()
+            all_types = BoxedDAO.dynamic_read_types()
+
+            # a date-only lower bound means the start of that day, so every hour from then on is read, whatever
+            # the upper bound
+            yesterday = (boxes[0][1] - timedelta(days=1)).strftime("%Y-%m-%d")
+            q = {"query" : {"range" : {"last_updated" : {"gte" : yesterday, "lte" : yesterday}}}}
+            types = BoxedDAO.read_types_for_query(q)
+            assert [t for t, start, end in boxes if start.strftime("%Y-%m-%d") >= yesterday] == types
+            assert len(types) == 24 + boxes[0][1].hour + 1
+
+            # dates in another zone or format are not used at all
+            q = {"query" : {"range" : {"last_updated" : {"gte" : yesterday, "lte" : yesterday, "time_zone" : "+05:00"}}}}
+            assert BoxedDAO.read_types_for_query(q) == all_types
+            q = {"query" : {"range" : {"last_updated" : {"gte" : yesterday, "format" : "yyyy-MM-dd"}}}}
+            assert BoxedDAO.read_types_for_query(q) == all_types
+        finally:
+            del app.config["ESDAO_TIME_BOX_BOXED"]
+            del app.config["ESDAO_TIME_BOX_LOOKBACK_BOXED"]
+
+    def test_15_timing_payloads(self):
+        dao.reset_timings()
+        logged = []
+        old_warn = app.logger.warn
+        old_dumps = dao.jsonlib.dumps
+        dumped = []
+        def dumps(obj, *args, **kwargs):
+            dumped.append(obj)
+            return old_dumps(obj, *args, **kwargs)
+        app.logger.warn = logged.append
+        dao.jsonlib.dumps = dumps
+        try:
+            # a fast operation is not serialised again just to measure it
+            doc = {"id" : "1", "text" : "a document"}
+            with dao._Timer(BulkDAO, "save", doc, log_body=False):
+                pass
+            assert dumped == []
+            assert logged == []
+            assert dao.timing_stats()["BulkDAO"]["save"]["payload_bytes"] is None
+
+            # a slow one is measured for the log, which leaves out the document, but not counted
+            thresh = app.config.get("ESDAO_SLOW_QUERY_THRESHOLD")
+            app.config["ESDAO_SLOW_QUERY_THRESHOLD"] = 0
+            try:
+                with dao._Timer(BulkDAO, "save", doc, log_body=False):
+                    pass
+            finally:
+                app.config["ESDAO_SLOW_QUERY_THRESHOLD"] = thresh
+            assert dao.timing_stats()["BulkDAO"]["save"]["payload_bytes"] is None
+            assert len(logged) == 1
+            assert "a document" not in logged[0]
+            assert str(len(old_dumps(doc))) + " bytes" in logged[0]
+
+            # bodies which are already serialised are counted
+            with dao._Timer(BulkDAO, "update", old_dumps(doc), log_body=False):
+                pass
+            with dao._Timer(BulkDAO, "update", old_dumps(doc), log_body=False):
+                pass
+            assert dao.timing_stats()["BulkDAO"]["update"]["payload_bytes"] == 2 * len(old_dumps(doc))
+        finally:
+            app.logger.warn = old_warn
+            dao.jsonlib.dumps = old_dumps
+            dao.reset_timings()
@@ -0,0 +1,120 @@
+from unittest import TestCase
+import json, esprit, tempfile, shutil, os
+from octopus.core import app
+from octopus.lib import http
+from octopus.modules.es import initialise
+
+class MappedOne(object):
+    @classmethod
+    def mappings(cls):
+        return {"one" : {"one" : {"properties" : {}}}, "two" : {"two" : {"properties" : {}}}}
+
+class MappedTwo(object):
+    @classmethod
+    def mappings(cls):
+        return {"three" : {"three" : {"properties" : {}}}}
+
+class Example(object):
+    saved = []
+
+    def __init__(self, type):
+        self.type = type
+
+    @classmethod
+    def get_write_type(cls):
+        return "example"
+
+    @classmethod
+    def example(cls):
+        return cls("example")
+
+    def save(self):
+        Example.saved.append(self.type)
+
+    def delete(self):
+        pass
+
+class MockIndex(object):
+    def __init__(self, types):
+        self.types = types
+        self.mapping_requests = 0
+        self.type_checks = 0
+        self.puts = []
+
+    def get(self, url, **kwargs):
+        self.mapping_requests += 1
+        assert url.endswith("/_mapping")
+        return http.MockResponse(200, json.dumps({"db_v2" : {"mappings" : dict([(t, {}) for t in self.types])}}))
+
+    def put_mapping(self, conn, key, mapping, es_version=None):
+        self.puts.append(key)
+        return http.MockResponse(200, "{}")
+
+    def type_exists(self, conn, key, es_version=None):
+        self.type_checks += 1
+        return key in self.types
+
+class TestInitialise(TestCase):
+    def setUp(self):
+        super(TestInitialise, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.old_config = dict([(k, app.config.get(k)) for k in ["INITIALISE_INDEX", "ELASTIC_SEARCH_MAPPINGS",
+                                "ELASTIC_SEARCH_EXAMPLE_DOCS", "ELASTIC_SEARCH_SELF_INIT", "INITIALISE_INDEX_FINGERPRINT_FILE"]])
+        self.old_get = http.get
+        self.old_raw = dict([(k, getattr(esprit.raw, k, None)) for k in ["index_exists", "put_mapping", "type_exists"]])
+
+        app.config["INITIALISE_INDEX"] = True
+        app.config["ELASTIC_SEARCH_MAPPINGS"] = [
+            "octopus.modules.es.tests.unit.test_initialise.MappedOne",
+            "octopus.modules.es.tests.unit.test_initialise.MappedTwo"
+        ]
+        app.config["ELASTIC_SEARCH_EXAMPLE_DOCS"] = ["octopus.modules.es.tests.unit.test_initialise.Example"]
+        app.config["ELASTIC_SEARCH_SELF_INIT"] = []
+        app.config["INITIALISE_INDEX_FINGERPRINT_FILE"] = os.path.join(self.tmp, "fingerprint")
+        Example.saved = []
+
+        self.index = MockIndex(["one"])
+        http.get = self.index.get
+        esprit.raw.index_exists = lambda conn: True
+        esprit.raw.put_mapping = self.index.put_mapping
+        esprit.raw.type_exists = self.index.type_exists
+
+    def tearDown(self):
+        super(TestInitialise, self).tearDown()
+        shutil.rmtree(self.tmp)
+        app.config.update(self.old_config)
+        http.get = self.old_get
+        for k, v in self.old_raw.iteritems():
+            setattr(esprit.raw, k, v)
+
+    def test_01_single_mapping_request(self):
+        initialise.initialise()
+
+        # one request for all the mappings, and no per-type checks
+        assert self.index.mapping_requests == 1
+        assert self.index.type_checks == 0
+        assert sorted(self.index.puts) == ["three", "two"]
+        assert Example.saved == ["example"]
+        assert os.path.exists(app.config["INITIALISE_INDEX_FINGERPRINT_FILE"])
+
+        # on a warm restart with the same configuration, the index is not checked at all
+        self.index.puts = []
+        initialise.initialise()
+        assert self.index.mapping_requests == 1
+        assert self.index.puts == []
+        assert Example.saved == ["example"]
+
+        # but if the configuration changes, it is
+        app.config["ELASTIC_SEARCH_MAPPINGS"] = app.config["ELASTIC_SEARCH_MAPPINGS"][:1]
+        initialise.initialise()
+        assert self.index.mapping_requests == 2
+
+    def test_02_fallback(self):
+        # if the mappings can't be retrieved, each type is checked individually, and no fingerprint is recorded
+        http.get = lambda url, **kwargs: http.MockResponse(500, "")
+        initialise.initialise()
+
+        assert self.index.type_checks == 4
+        assert sorted(self.index.puts) == ["three", "two"]
+        assert Example.saved == ["example"]
+        assert not os.path.exists(app.config["INITIALISE_INDEX_FINGERPRINT_FILE"])
@@ -333,4 +333,45 @@ class TestModels(TestCase):
             ]
         }
 
-        assert sane == expected
\ No newline at end of file
+        assert sane == expected
+
+    def test_11_sanitiser_cache(self):
+        type_field_map = {"terms" : {"aaaa" : {"aggs" : False}}}
+        sanitiser = sanitise.Sanitiser(sanitise.EDGES_STRUCT, aggs_type_field_map=type_field_map, sortable=["one"], cache_size=10)
+
+        query = {
+            "query" : {"match_all" : {}},
+            "size" : 10,
+            "aggs" : {"first" : {"terms" : {"field" : "aaaa"}}, "second" : {"terms" : {"field" : "bbbb"}}},
+            "sort" : [{"one" : {"order" : "asc"}}, {"two" : {"order" : "asc"}}]
+        }
+        expected = {
+            "query" : {"match_all" : {}},
+            "size" : 10,
+            "aggs" : {"first" : {"terms" : {"field" : "aaaa"}}},
+            "sort" : [{"one" : {"order" : "asc"}}]
+        }
+
+        sane = sanitiser.sanitise(query)
+        assert sane == expected
+        assert sanitiser.cache_stats()["misses"] == 1
+
+        # changing the result we were given doesn't change what is remembered
+        sane["size"] = 100
+
+        # the same query, with its keys in a different order, is answered from the cache
+        reordered = {"sort" : query["sort"], "aggs" : query["aggs"], "size" : 10, "query" : {"match_all" : {}}}
+        assert sanitiser.sanitise(reordered) == expected
+        assert sanitiser.cache_stats()["hits"] == 1
+
+        # failures are remembered too
+        bad = {"query" : {"bool" : {}}}
+        for i in range(2):
+            with self.assertRaises(sanitise.QuerySanitisationException):
+                sanitiser.sanitise(bad)
+        assert sanitiser.cache_stats()["hits"] == 2
+
+        # the module-level function compiles each configuration once
+        s1 = sanitise.get_sanitiser(sanitise.EDGES_STRUCT, aggs_type_field_map=type_field_map)
+        s2 = sanitise.get_sanitiser(sanitise.EDGES_STRUCT, aggs_type_field_map=type_field_map)
+        assert s1 is s2
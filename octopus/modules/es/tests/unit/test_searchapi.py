@@ -0,0 +1,183 @@
+from unittest import TestCase
+from flask import Flask
+from octopus.core import app
+from octopus.modules.es import searchapi
+import json
+
+class MockSearchDAO(object):
+    __es_version__ = "0.90.13"
+    queries = []
+    docs = [{"id" : "1", "title" : "result"}]
+
+    @classmethod
+    def _page(cls, start, size):
+        hits = [{"_source" : d, "sort" : [start + i]} for i, d in enumerate(cls.docs[start:start + size])]
+        return {"_scroll_id" : str(start + size), "hits" : {"total" : len(cls.docs), "hits" : hits}}
+
+    @classmethod
+    def query(cls, q=None):
+        cls.queries.append(q)
+        start = q.get("from", 0)
+        if "search_after" in q:
+            start = q["search_after"][0] + 1
+        return cls._page(start, q.get("size", 10))
+
+    @classmethod
+    def scroll_page(cls, q=None, scroll_id=None, keepalive=None):
+        cls.queries.append(q if q is not None else scroll_id)
+        if scroll_id is None:
+            cls.scroll_size = q["size"]
+            return cls._page(0, q["size"])
+        return cls._page(int(scroll_id), cls.scroll_size)
+
+    @classmethod
+    def _scroll_clear(cls, scroll_id):
+        cls.cleared.append(scroll_id)
+
+    @classmethod
+    def stream(cls, q=None, wrap=True):
+        cls.queries.append(q)
+        for d in cls.docs:
+            yield d
+
+class TestSearchAPI(TestCase):
+    def setUp(self):
+        super(TestSearchAPI, self).setUp()
+        self.old_searchapi = app.config.get("SEARCHAPI")
+        app.config["SEARCHAPI"] = {
+            "search" : {
+                "auth" : False,
+                "default_page_size" : 10,
+                "max_page_size" : 100,
+                "search_no_mod" : [],
+                "search_prefix" : "record.",
+                "search_subs" : {},
+                "sort_prefix" : "record.",
+                "sort_subs" : {},
+                "query_builder" : "octopus.modules.es.dao.SearchAPIQuery",
+                "dao" : "octopus.modules.es.tests.unit.test_searchapi.MockSearchDAO",
+                "results_filter" : None,
+                "cache" : {"size" : 10, "ttl" : 60}
+            }
+        }
+        searchapi._result_caches.clear()
+        MockSearchDAO.queries = []
+        MockSearchDAO.cleared = []
+        MockSearchDAO.docs = [{"id" : "1", "title" : "result"}]
+        MockSearchDAO.__es_version__ = "0.90.13"
+
+        webapp = Flask(__name__)
+        webapp.register_blueprint(searchapi.blueprint, url_prefix="/api")
+        self.client = webapp.test_client()
+
+    def tearDown(self):
+        super(TestSearchAPI, self).tearDown()
+        app.config["SEARCHAPI"] = self.old_searchapi
+        searchapi._result_caches.clear()
+
+    def test_01_cache(self):
+        resp = self.client.get("/api/search?q=title:test")
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["results"] == [{"id" : "1", "title" : "result"}]
+        etag = resp.headers.get("ETag")
+        assert etag is not None
+
+        # the same search is served from the cache
+        resp2 = self.client.get("/api/search?q=title:test")
+        assert resp2.data == resp.data
+        assert resp2.headers.get("ETag") == etag
+        assert len(MockSearchDAO.queries) == 1
+
+        # but a different page is not
+        self.client.get("/api/search?q=title:test&page=2")
+        assert len(MockSearchDAO.queries) == 2
+
+        # with no cache, every search goes to the index, but the etag is the same
+        # for the same results
+        app.config["SEARCHAPI"]["search"]["cache"]["size"] = 0
+        searchapi._result_caches.clear()
+        resp3 = self.client.get("/api/search?q=title:test")
+        assert len(MockSearchDAO.queries) == 3
+        assert resp3.headers.get("ETag") == etag
+
+    def test_02_conditional(self):
+        resp = self.client.get("/api/search?q=title:test")
+        etag = resp.headers.get("ETag")
+
+        resp = self.client.get("/api/search?q=title:test", headers={"If-None-Match" : etag})
+        assert resp.status_code == 304
+        assert resp.data == ""
+
+        resp = self.client.get("/api/search?q=title:test", headers={"If-None-Match" : '"other"'})
+        assert resp.status_code == 200
+
+        # jsonp requests don't take part
+        resp = self.client.get("/api/search?q=title:test&callback=cb", headers={"If-None-Match" : etag})
+        assert resp.status_code == 200
+        assert resp.data.startswith("cb(")
+
+    def _page_through(self, url):
+        pages = []
+        resp = self.client.get(url + "&cursor=*")
+        while True:
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            pages.append([r["id"] for r in body["results"]])
+            if body["cursor"] is None:
+                return pages
+            resp = self.client.get(url + "&cursor=" + body["cursor"])
+
+    def test_03_cursor(self):
+        MockSearchDAO.docs = [{"id" : str(i)} for i in range(25)]
+        expected = [[str(i) for i in range(j, min(j + 10, 25))] for j in range(0, 25, 10)]
+
+        # scroll contexts before ES 5.x
+        assert self._page_through("/api/search?q=test") == expected
+        assert isinstance(MockSearchDAO.queries[0], dict)
+        assert "from" not in MockSearchDAO.queries[0]
+        assert MockSearchDAO.queries[1:] == ["10", "20"]
+        # and the context is cleared once the last page has been served
+        assert MockSearchDAO.cleared == ["30"]
+
+        # search_after from ES 5.x, with a tie breaker on the sort
+        MockSearchDAO.__es_version__ = "5.1.1"
+        MockSearchDAO.queries = []
+        assert self._page_through("/api/search?q=test&sortBy=title") == expected
+        assert MockSearchDAO.queries[0]["sort"][-1] == {"id.exact" : {"order" : "asc"}}
+        assert MockSearchDAO.queries[0]["sort"][0].keys() == ["record.title"]
+        assert MockSearchDAO.queries[1]["search_after"] == [9]
+
+        # a cursor is only good for the search it came from
+        resp = self.client.get("/api/search?q=test&cursor=*")
+        cursor = json.loads(resp.data)["cursor"]
+        resp = self.client.get("/api/search?q=other&cursor=" + cursor)
+        assert resp.status_code == 400
+        resp = self.client.get("/api/search?q=test&cursor=notacursor")
+        assert resp.status_code == 400
+
+        # nor for accounts which the query builder may constrain differently
+        class Acc(object):
+            def __init__(self, id, role):
+                self.id = id
+                self.role = role
+        cfg = app.config["SEARCHAPI"]["search"]
+        key = searchapi._cursor_key(cfg, Acc("a", ["user"]), "test", 10, None, None)
+        assert key == searchapi._cursor_key(cfg, Acc("b", ["user"]), "test", 10, None, None)
+        assert key != searchapi._cursor_key(cfg, Acc("c", ["admin"]), "test", 10, None, None)
+        assert key != searchapi._cursor_key(cfg, None, "test", 10, None, None)
+        cfg["cache"]["per_account"] = True
+        assert searchapi._cursor_key(cfg, Acc("a", ["user"]), "test", 10, None, None) != searchapi._cursor_key(cfg, Acc("b", ["user"]), "test", 10, None, None)
+
+    def test_04_export(self):
+        MockSearchDAO.docs = [{"id" : str(i)} for i in range(5)]
+
+        resp = self.client.get("/api/search/export?q=test")
+        assert resp.status_code == 404
+
+        app.config["SEARCHAPI"]["search"]["export"] = True
+        resp = self.client.get("/api/search/export?q=test")
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/x-ndjson"
+        assert [json.loads(l) for l in resp.data.strip().split("\n")] == MockSearchDAO.docs
+        assert "from" not in MockSearchDAO.queries[0]
+        assert "size" not in MockSearchDAO.queries[0]
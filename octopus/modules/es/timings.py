@@ -0,0 +1,18 @@
+from flask import Blueprint, make_response
+from octopus.lib import webapp
+from octopus.modules.es.dao import timing_stats, reset_timings
+import json
+
+blueprint = Blueprint('timings', __name__)
+
+@blueprint.route("/", methods=["GET"])
+@webapp.jsonp
+def timings():
+    r = make_response(json.dumps(timing_stats()))
+    r.mimetype = "application/json"
+    return r
+
+@blueprint.route("/reset", methods=["POST"])
+def reset():
+    reset_timings()
+    return ""
@@ -149,6 +149,11 @@ class InfoSysModel(dataobj.DataObj, dao.ESInstanceDAO):
             return self._make_instance(obj)
         return None
 
+    def pull_many(self, ids, chunk_size=None, conn=None):
+        type = self._get_read_types(True)
+        objs = dao.ESDAO.pull_many(ids, chunk_size=chunk_size, conn=conn, wrap=False, types=type)
+        return [self._make_instance(obj) if obj is not None else None for obj in objs]
+
     def query(self, q='', terms=None, should_terms=None, facets=None, conn=None, **kwargs):
         type = self._get_read_types(True)
         return dao.ESDAO.query(q=q, terms=terms, should_terms=should_terms, facets=facets, conn=conn, types=type, **kwargs)
@@ -158,9 +163,14 @@ class InfoSysModel(dataobj.DataObj, dao.ESInstanceDAO):
         for o in dao.ESDAO.scroll(q=q, page_size=page_size, limit=limit, keepalive=keepalive, conn=conn, raise_on_scroll_error=raise_on_scroll_error, types=type, wrap=False):
             yield self._make_instance(o)
 
-    def delete_by_query(self, query, conn=None, es_version="0.90.13"):
+    def stream(self, q=None, page_size=None, limit=None, keepalive=None, source=None, slices=None, slice_id=None, conn=None):
+        type = self._get_read_types(True)
+        for o in dao.ESDAO.stream(q=q, page_size=page_size, limit=limit, keepalive=keepalive, source=source, slices=slices, slice_id=slice_id, types=type, wrap=False, conn=conn):
+            yield self._make_instance(o)
+
+    def delete_by_query(self, query, conn=None, es_version="0.90.13", throttled=None, **kwargs):
         type = self._get_write_type(True)
-        dao.ESDAO.delete_by_query(query, conn=conn, es_version=es_version, type=type)
+        return dao.ESDAO.delete_by_query(query, conn=conn, es_version=es_version, type=type, throttled=throttled, **kwargs)
 
     def object_query(self, q='', terms=None, should_terms=None, facets=None, conn=None, **kwargs):
         type = self._get_read_types(True)
@@ -150,26 +150,52 @@ class JPER(object):
         else:
             return models.OutgoingNotification(j)
 
+    def get_notifications(self, notification_ids, concurrency=None):
+        """
+        :return: generator of (notification_id, notification, exception) in the order given
+        """
+        return http.map_concurrent(self.get_notification, notification_ids, concurrency=concurrency)
+
     def get_content(self, url):
         # just sort out the api_key
         url = self._url(url=url)
 
         # get the response object
         resp, content, downloaded_bytes = http.get_stream(url, read_stream=False)
+        self._check_content_response(resp)
+
+        # return the response object, in case the caller wants access to headers, etc.
+        return resp.raw, resp.headers
 
+    def iter_content(self, url, chunk_size=None, size_limit=None):
+        """
+        Stream the content from the given url chunk by chunk, so that it can be proxied or
+        written to disk without holding it all in memory
+
+        :return: (chunk iterator, response headers)
+        """
+        # just sort out the api_key
+        url = self._url(url=url)
+
+        # get the response object and the iterator over its body
+        resp, chunks = http.iter_stream(url, chunk_size=chunk_size, size_limit=size_limit)
+        self._check_content_response(resp)
+
+        return chunks, resp.headers
+
+    def _check_content_response(self, resp):
         # check for errors or problems with the response
         if resp is None:
             raise JPERConnectionException("Unable to communicate with the JPER API")
 
         if resp.status_code == 401:
+            resp.close()
             raise JPERAuthException("Could not authenticate with JPER with your API key")
 
         if resp.status_code != 200:
+            resp.close()
             raise JPERException("Received unexpected status code: {x}".format(x=resp.status_code))
 
-        # return the response object, in case the caller wants access to headers, etc.
-        return resp.raw, resp.headers
-
     def list_notifications(self, since, page=None, page_size=None, repository_id=None):
         # check that the since date is valid, and get it into the right format
         if not hasattr(since, "strftime"):
@@ -50,6 +50,12 @@ class Lantern(object):
             return resp.json()
         return None
 
+    def get_job_infos(self, job_ids, concurrency=None):
+        """
+        :return: generator of (job_id, job_info, exception) in the order given
+        """
+        return http.map_concurrent(self.get_job_info, job_ids, concurrency=concurrency)
+
     def get_original_data(self, job_id):
         url = self._get_url(job_id + "/original")
         resp = http.get(url)
@@ -11,12 +11,25 @@ class JobsDAO(dao.ESDAO):
         q = DueJobsQuery()
         counter = 0
         total = cls.count(q.query())
-        for res in cls.iterate(q.query()):
-            obj = cls.pull(res.id)
-            state = oag.RequestState.from_json(obj.data)
+        # pull the latest version of each due job, a page of ids at a time
+        ids = []
+        for res in cls.iterate(q.query(), wrap=False):
+            ids.append(res.get("id"))
+            if len(ids) >= 100:
+                for state in cls._due_states(ids):
+                    counter += 1
+                    yield state, counter, total
+                ids = []
+        for state in cls._due_states(ids):
             counter += 1
             yield state, counter, total
 
+    @classmethod
+    def _due_states(cls, ids):
+        for obj in cls.pull_many(ids):
+            if obj is not None:
+                yield oag.RequestState.from_json(obj.data)
+
     @classmethod
     def job_statuses(cls):
         q = JobStatusQuery()
@@ -28,6 +28,12 @@ class RomeoClient(object):
         xml = xmlutil.fromstring(resp.text)
         return SearchResult(xml)
 
+    def get_by_issns(self, issns, concurrency=None):
+        """
+        :return: generator of (issn, search_result, exception) in the order given
+        """
+        return http.map_concurrent(self.get_by_issn, issns, concurrency=concurrency)
+
 
 class SearchResult(object):
     def __init__(self, xml):
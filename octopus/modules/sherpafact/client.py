@@ -1,5 +1,6 @@
 import urllib, requests, simplejson
 from octopus.core import app
+from octopus.lib import http
 from octopus.lib.dataobj import DataObj
 
 class FactClientException(Exception):
@@ -58,11 +59,13 @@ class FactClient(object):
         juliet_ids = self._normalise_juliet(juliet_ids)
         url = self.get_query_url(juliet_ids, journal_title, query_type, issn, output, trail)
         app.logger.info("Making request to Sherpa FACT on url {url}".format(url=url))
-        resp = requests.get(url)
+        resp = http.get(url)
         return resp, url
 
     def query(self, juliet_ids, journal_title=None, query_type=None, issn=None, output="json", trail=False):
         resp, url = self.raw_query(juliet_ids, journal_title, query_type, issn, output, trail)
+        if resp is None:
+            raise FactClientException("Unable to communicate with Sherpa FACT at " + url)
         if resp.status_code != requests.codes.ok:
             raise FactClientException("Request to " + url + " produced status code " + str(resp.status_code))
 
@@ -75,6 +78,14 @@ class FactClient(object):
 
         return None
 
+    def query_by_issns(self, juliet_ids, issns, output="json", trail=False, concurrency=None):
+        """
+        :return: generator of (issn, fact, exception) in the order given
+        """
+        def _query(issn):
+            return self.query(juliet_ids, issn=issn, output=output, trail=trail)
+        return http.map_concurrent(_query, issns, concurrency=concurrency)
+
     def _read_json(self, resp):
         j = None
         source = resp.text
@@ -65,7 +65,7 @@ class StoreLocal(Store):
             shutil.copyfile(source_path, tpath)
         elif source_stream:
             with codecs.open(tpath, "wb") as f:
-                f.write(source_stream.read())
+                shutil.copyfileobj(source_stream, f)
 
     def exists(self, container_id):
         cpath = os.path.join(self.dir, container_id)
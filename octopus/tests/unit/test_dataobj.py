@@ -1,4 +1,6 @@
 from unittest import TestCase
+from copy import deepcopy
+import json
 from octopus.lib import dataobj
 
 class CustomDO(dataobj.DataObj):
@@ -7,6 +9,27 @@ class CustomDO(dataobj.DataObj):
 class InvalidDO(dataobj.DataObj):
     pass
 
+class BatchDO(dataobj.DataObj):
+    def __init__(self, raw=None):
+        struct = {
+            "fields" : {
+                "title" : {"coerce" : "unicode"},
+                "count" : {"coerce" : "integer"}
+            },
+            "required" : ["title"]
+        }
+        super(BatchDO, self).__init__(raw, struct=struct)
+
+    def custom_validate(self):
+        if self.data.get("count", 0) < 0:
+            raise ValueError("count must not be negative")
+
+class NestingDO(dataobj.DataObj):
+    def __init__(self, raw=None, inner=None):
+        # builds another DataObj before its own initialisation
+        self.inner = BatchDO(inner)
+        super(NestingDO, self).__init__(raw, struct={"fields" : {"title" : {"coerce" : "unicode"}}})
+
 class TestDataObj(dataobj.DataObj):
     def __init__(self, raw=None, expose_data=False):
         self._struct = {
@@ -89,6 +112,9 @@ class TestDataObj(dataobj.DataObj):
     def my_list(self, val):
         self._set_list("my_list", val)
 
+class TrackedDO(TestDataObj):
+    TRACK_CHANGES = True
+
 class TestImport(TestCase):
     def setUp(self):
         pass
@@ -777,3 +803,405 @@ class TestImport(TestCase):
                 super(A, self).__init__()
 
         a = A()
+
+    def test_11_accessor_plans(self):
+        # instances with the same struct share the compiled accessors
+        do1 = TestDataObj({"title" : "one", "name" : "first"})
+        do2 = TestDataObj({"title" : "two", "name" : "second"})
+        assert do1.the_name == "first"
+        assert do2.the_name == "second"
+        assert do1._accessor_plan() is do2._accessor_plan()
+
+        # changing the struct recompiles them
+        do1._add_struct({"fields" : {"extra" : {"coerce" : "integer"}}})
+        assert do1._accessor_plan() is not do2._accessor_plan()
+        do1._set_with_struct("extra", "10")
+        assert do1.data["extra"] == "10"
+
+        do1._properties = {"the_extra" : ("extra", None)}
+        do1.the_extra = "11"
+        assert do1.the_extra == 11
+        with self.assertRaises(AttributeError):
+            do1.the_name
+
+        # and the other object is unaffected
+        do2.the_name = "another"
+        assert do2.the_name == "another"
+        with self.assertRaises(AttributeError):
+            do2.the_extra
+
+    def test_12_compiled_struct(self):
+        struct = {
+            "fields" : {
+                "one" : {"coerce" : "unicode"},
+                "two" : {"coerce" : "integer", "allowed_values" : [1, 2]}
+            },
+            "objects" : ["three", "four"],
+            "lists" : {
+                "five" : {"contains" : "field", "coerce" : "integer", "unique" : True},
+                "six" : {"contains" : "object"}
+            },
+            "required" : ["one"],
+            "structs" : {
+                "four" : {
+                    "fields" : {
+                        "alpha" : {"coerce" : "integer"}
+                    }
+                },
+                "six" : {
+                    "fields" : {
+                        "beta" : {"coerce" : "unicode"}
+                    }
+                }
+            }
+        }
+        coerce = dataobj.DataObj.DEFAULT_COERCE
+        compiled = dataobj.compile_struct(struct, coerce)
+        assert dataobj.compile_struct(struct, coerce) is compiled
+
+        good = [
+            {"one" : "hello"},
+            {"one" : "hello", "two" : "2", "three" : {"any" : "thing"}, "four" : {"alpha" : "4"}},
+            {"one" : "hello", "five" : ["1", "1", "2", None], "six" : [{"beta" : 6}, {}]},
+            {"one" : "hello", "five" : [], "six" : []}
+        ]
+        for obj in good:
+            assert compiled.construct(obj) == dataobj.construct(obj, struct, coerce)
+
+        bad = [
+            {},
+            {"one" : "hello", "seven" : "not allowed"},
+            {"one" : "hello", "two" : "3"},
+            {"one" : "hello", "four" : "not an object"},
+            {"one" : "hello", "five" : ["not an int"]},
+            {"one" : "hello", "six" : [{"gamma" : "not allowed"}]}
+        ]
+        for obj in bad:
+            with self.assertRaises(dataobj.DataStructureException):
+                compiled.construct(obj)
+
+        # silent pruning applies all the way down
+        pruned = compiled.construct({"one" : "hello", "seven" : "pruned", "four" : {"alpha" : 1, "omega" : 2}}, silent_prune=True)
+        assert pruned == {"one" : u"hello", "four" : {"alpha" : 1}}
+
+    def test_13_construct_many(self):
+        raws = [
+            {"title" : "one", "count" : "1"},
+            {"count" : 2},
+            {"title" : "three", "count" : -3},
+            {"title" : "four", "other" : "not allowed"},
+            {"title" : "five"}
+        ]
+
+        for processes in [None, 2]:
+            results = list(BatchDO.construct_many(iter(raws), processes=processes, batch_size=2))
+            assert [r[0] for r in results] == raws
+
+            raw, obj, error = results[0]
+            assert error is None
+            assert isinstance(obj, BatchDO)
+            assert obj.data == {"title" : u"one", "count" : 1}
+
+            assert results[1][1] is None
+            assert isinstance(results[1][2], dataobj.DataStructureException)
+
+            assert results[2][1] is None
+            assert isinstance(results[2][2], ValueError)
+
+            assert results[3][1] is None
+            assert isinstance(results[3][2], dataobj.DataStructureException)
+
+            assert results[4][2] is None
+            assert results[4][1].data == {"title" : u"five"}
+
+        # trusted data is only trusted by the object it is given to, not by any other built along the way
+        obj, error = dataobj._construct_one(NestingDO, {"title" : "outer"}, {"inner" : {"count" : 1}}, trusted=True)
+        assert obj is None
+        assert isinstance(error, dataobj.DataStructureException)
+
+        obj, error = dataobj._construct_one(NestingDO, {"title" : "outer"}, {"inner" : {"title" : "inner", "count" : "1"}}, trusted=True)
+        assert error is None
+        assert obj.inner.data == {"title" : u"inner", "count" : 1}
+        assert obj.data == {"title" : "outer"}
+        assert not isinstance(obj.data, dataobj._TrustedData)
+
+    def test_14_slots_class(self):
+        struct = {
+            "fields" : {
+                "title" : {"coerce" : "unicode"},
+                "count" : {"coerce" : "integer"},
+                "class" : {"coerce" : "unicode"}
+            },
+            "objects" : ["meta", "extra"],
+            "lists" : {
+                "tags" : {"contains" : "field", "coerce" : "unicode", "unique" : True},
+                "authors" : {"contains" : "object"}
+            },
+            "required" : ["title"],
+            "structs" : {
+                "meta" : {"fields" : {"source" : {"coerce" : "unicode"}}},
+                "authors" : {"fields" : {"name" : {"coerce" : "unicode"}}}
+            }
+        }
+        raw = {
+            "title" : "Title",
+            "count" : "10",
+            "class" : "A",
+            "meta" : {"source" : "somewhere"},
+            "extra" : {"anything" : ["goes"]},
+            "tags" : ["a", "b", "a"],
+            "authors" : [{"name" : "one"}, {"name" : "two"}]
+        }
+
+        klazz = dataobj.slots_class(struct)
+        assert dataobj.slots_class(struct) is klazz
+
+        obj = klazz.from_raw(raw)
+        assert not hasattr(obj, "__dict__")
+        assert obj.title == u"Title"
+        assert obj.count == 10
+        assert obj._class == u"A"
+        assert obj.meta.source == u"somewhere"
+        assert obj.extra == {"anything" : ["goes"]}
+        assert obj.tags == [u"a", u"b"]
+        assert [a.name for a in obj.authors] == [u"one", u"two"]
+
+        # the raw data is the same as construct would give us
+        constructed = dataobj.construct(raw, struct, dataobj.DataObj.DEFAULT_COERCE)
+        assert obj.to_raw() == constructed
+
+        # setting values coerces them
+        obj.count = "11"
+        assert obj.count == 11
+        obj.authors = [{"name" : "three"}]
+        assert obj.authors[0].name == u"three"
+        obj.meta = None
+        assert "meta" not in obj.to_raw()
+        with self.assertRaises(dataobj.DataStructureException):
+            obj.count = "eleven"
+        with self.assertRaises(AttributeError):
+            obj.other = "not in the struct"
+
+        # and the same checks apply as in construct
+        with self.assertRaises(dataobj.DataStructureException):
+            klazz.from_raw({"count" : 1})
+        with self.assertRaises(dataobj.DataStructureException):
+            klazz.from_raw({"title" : "t", "other" : "field"})
+        assert klazz.from_raw({"title" : "t", "other" : "field"}, silent_prune=True).to_raw() == {"title" : u"t"}
+
+    def test_15_compact_dataobj(self):
+        do = TestDataObj({"title" : "Title", "objy" : {"one" : "1"}, "listy" : [{"three" : "3"}]})
+        compact = do.compact()
+        assert compact.title == u"Title"
+        assert compact.objy.one == u"1"
+        assert compact.listy[0].three == u"3"
+        assert compact.__class__.__name__ == "TestDataObjCompact"
+        assert TestDataObj().compact_class() is compact.__class__
+
+        assert TestDataObj(compact.to_raw()).data == do.data
+
+    def test_16_construct_lazy(self):
+        raw = {"title" : 10, "objy" : {"one" : 1, "two" : 2}, "listy" : [{"three" : 3}], "thelist" : [{"four" : 4}]}
+
+        # the top level is constructed straight away, the objects and lists on first use
+        lazy = dataobj.DataObj(deepcopy(raw), struct=TestDataObj()._struct, construct_lazy=True)
+        assert lazy.data["title"] == u"10"
+        assert lazy.data["objy"] == {"one" : 1, "two" : 2}
+        assert lazy._get_single("objy.one") == u"1"
+        assert lazy.data["objy"] == {"one" : u"1", "two" : u"2"}
+        assert lazy.data["listy"] == [{"three" : 3}]
+
+        # setting inside a list constructs it first
+        lazy._add_to_list("listy", {"three" : u"33"})
+        assert lazy.data["listy"] == [{"three" : u"3"}, {"three" : u"33"}]
+
+        # and everything else is constructed by validate_all
+        assert lazy.data["thelist"] == [{"four" : 4}]
+        lazy.validate_all()
+        assert lazy.data["thelist"] == [{"four" : u"4"}]
+        assert "_lazy_pending" not in lazy.__dict__
+
+        # problems in the nested data are only found when they are constructed
+        bad = dataobj.DataObj({"title" : "t", "objy" : {"one" : "1", "other" : "x"}}, struct=TestDataObj()._struct, construct_lazy=True)
+        with self.assertRaises(dataobj.DataStructureException):
+            bad.json()
+
+        class LazyDO(TestDataObj):
+            CONSTRUCT_LAZY = True
+        lazy = LazyDO(deepcopy(raw))
+        assert lazy.raw_obj == {"one" : u"1", "two" : u"2"}
+        assert lazy.data["listy"] == [{"three" : 3}]
+        assert lazy.compact().listy[0].three == u"3"
+
+    def test_17_clone(self):
+        do = TestDataObj({"title" : "Title", "objy" : {"one" : "1", "two" : "2"}, "listy" : [{"three" : "3"}], "thelist" : [{"four" : "4"}], "theobj" : {"one" : "1"}})
+        c = do.clone()
+        assert c.data == do.data
+        assert isinstance(c, TestDataObj)
+
+        # nothing is copied until it is changed
+        assert c.data is not do.data
+        assert c.data["objy"] is do.data["objy"]
+
+        c._set_single("objy.one", "changed")
+        assert c.data["objy"]["one"] == "changed"
+        assert do.data["objy"]["one"] == "1"
+        assert c.data["thelist"] is do.data["thelist"]
+
+        # changes through the list getters, the wrapped objects and deletes don't reach the other object either
+        c._add_to_list("listy", {"three" : "33"})
+        c.wrap_list[0]._set_single("three", "changed")
+        c.wrap_obj._set_single("two", "changed")
+        c._delete("theobj.one")
+        do._set_single("title", "Original")
+        assert do.data == {"title" : "Original", "objy" : {"one" : "1", "two" : "2"}, "listy" : [{"three" : "3"}], "thelist" : [{"four" : "4"}], "theobj" : {"one" : "1"}}
+        assert c.data == {"title" : "Title", "objy" : {"one" : "changed", "two" : "changed"}, "listy" : [{"three" : "changed"}, {"three" : "33"}], "thelist" : [{"four" : "4"}], "theobj" : {}}
+
+        # and clones of clones are independent too
+        cc = c.clone()
+        cc._add_to_list("thelist", {"four" : "44"})
+        assert len(c.data["thelist"]) == 1
+        assert len(do.data["thelist"]) == 1
+
+    def test_18_dirty_paths(self):
+        do = TrackedDO({"title" : "Title", "objy" : {"one" : "1", "two" : "2"}, "listy" : [{"three" : "3"}], "theobj" : {"one" : "1"}})
+        assert do.dirty_paths() == []
+        assert not do.is_dirty()
+
+        # reading doesn't count, even of the lists and objects handed out by reference
+        do.wrap_obj
+        do._get_single("title")
+        do._get_list("thelist", by_reference=False)
+        raw_list = do.raw_list
+        raw_obj = do.theobj
+        do._get_list("thelist")
+        assert do.dirty_paths() == []
+        assert do.changes() == {}
+        assert do.data["thelist"] == []
+
+        # but changing them does
+        raw_list[0]["three"] = "changed"
+        assert do.dirty_paths() == ["listy"]
+        raw_list[0]["three"] = "3"
+
+        # changes made through wrapped objects belong to the parent, and paths inside another are left out
+        do.wrap_obj._set_single("two", "changed")
+        do._set_single("objy.one", "changed")
+        do._set_single("title", "New")
+        assert do.dirty_paths() == ["listy", "objy.one", "objy.two", "title"]
+        assert do.changes() == {"title" : "New", "objy" : {"one" : "changed", "two" : "changed"}, "listy" : [{"three" : "3"}]}
+
+        do.mark_clean()
+        do.wrap_list[0]._set_single("three", "changed")
+        do.mark_clean()
+        do.wrap_list[0]._set_single("three", "again")
+        assert do.dirty_paths() == ["listy"]
+
+        # a clone starts with the same changes
+        c = do.clone()
+        assert c.dirty_paths() == ["listy"]
+
+        # deletes, and replacing the data, can't be done as a partial update, however they are done
+        do.mark_clean()
+        raw_obj["two"] = "2"
+        assert do.dirty_paths() == ["theobj"]
+        del raw_obj["two"]
+        assert do.dirty_paths() is None
+        do.mark_clean()
+        do._delete("theobj.one")
+        assert do.dirty_paths() is None
+        assert do.changes() is None
+        c.data = {"title" : "Other"}
+        assert c.dirty_paths() is None
+
+    def test_19_json(self):
+        do = TrackedDO({"title" : "Title", "objy" : {"one" : "1"}, "theobj" : {"one" : "1"}, "listy" : [{"three" : "3"}]})
+        j = do.json()
+        assert json.loads(j) == do.data
+        assert do.json() is j
+
+        # each way of changing the data through the object gets a fresh serialisation
+        do._set_single("title", "New")
+        assert json.loads(do.json())["title"] == "New"
+        do.wrap_obj._set_single("one", "changed")
+        assert json.loads(do.json())["objy"]["one"] == "changed"
+        do.theobj["one"] = "changed"
+        assert json.loads(do.json())["theobj"]["one"] == "changed"
+        do._delete("objy")
+        assert "objy" not in json.loads(do.json())
+        do.data = {"title" : "Replaced"}
+        assert json.loads(do.json()) == {"title" : "Replaced"}
+
+        # reading through the getters leaves the serialisation as it was
+        do.data = {"title" : "Replaced", "listy" : [{"three" : "3"}], "thelist" : [{"four" : "4"}]}
+        j = do.json()
+        do._get_single("title")
+        do._get_list("listy")
+        do.wrap_list
+        do.thelist
+        assert do.json() is j
+
+        # but changing what they handed out doesn't
+        do.thelist.append({"four" : "44"})
+        assert json.loads(do.json())["thelist"] == [{"four" : "4"}, {"four" : "44"}]
+
+        # the encoder can be swapped out
+        calls = []
+        def encoder(data):
+            calls.append(data)
+            return json.dumps(data)
+        dataobj.set_json_encoder(encoder)
+        try:
+            do._set_single("title", "Encoded")
+            do.json()
+            assert len(calls) == 1
+        finally:
+            dataobj.set_json_encoder()
+
+        # and big records can be serialised a piece at a time
+        big = TestDataObj({"title" : "Big", "listy" : [{"three" : str(i)} for i in range(1000)]})
+        chunks = list(big.iter_json(chunk_size=1024))
+        assert len(chunks) > 1
+        assert json.loads("".join(chunks)) == big.data
+        j = big.json()
+        assert "".join(big.iter_json(chunk_size=1024)) == j
+
+    def test_20_clone_raw_objects(self):
+        # objects handed out without a wrapper may be changed by the caller, so can't stay shared with a clone
+        do = TestDataObj({"theobj" : {"one" : "1"}})
+        c = do.clone()
+        c.theobj["one"] = "changed"
+        assert do.data["theobj"]["one"] == "1"
+        assert c.dirty_paths() is None
+
+        do = TrackedDO({"theobj" : {"one" : "1"}})
+        c = do.clone()
+        c.theobj["one"] = "changed"
+        assert do.data["theobj"]["one"] == "1"
+        assert c.dirty_paths() == ["theobj"]
+
+    def test_21_untracked_handouts(self):
+        # without TRACK_CHANGES nothing is copied on reading, so whatever is handed out by reference counts as changed
+        do = TestDataObj({"title" : "Title", "listy" : [{"three" : "3"}], "theobj" : {"one" : "1"}})
+        raw_list = do.raw_list
+        assert do.__dict__["_handouts"]["listy"] is dataobj._UNTRACKED
+        assert do.dirty_paths() == ["listy"]
+        assert do.changes() == {"listy" : [{"three" : "3"}]}
+
+        # even after it has been saved, since the caller may still change it
+        do.mark_clean()
+        assert do.dirty_paths() == ["listy"]
+
+        # and the json is not kept, since it can't be told whether the list has changed
+        j = do.json()
+        raw_list.append({"three" : "33"})
+        assert len(json.loads(do.json())["listy"]) == 2
+
+        # keys may have been deleted from an object, so the whole record must be written
+        do.theobj
+        assert do.dirty_paths() is None
+
+        # a clone still gets its own copy of what was handed out
+        c = do.clone()
+        raw_list.append({"three" : "333"})
+        assert len(c.data["listy"]) == 2
@@ -0,0 +1,79 @@
+import unittest, time
+from octopus.core import app
+from octopus.lib import http
+
+class TestHTTP(unittest.TestCase):
+    def setUp(self):
+        http.reset_sessions()
+
+    def tearDown(self):
+        http.reset_sessions()
+
+    def test_01_session_per_host(self):
+        s1 = http.get_session("http://example.com/one")
+        s2 = http.get_session("http://EXAMPLE.com/two?three=four")
+        s3 = http.get_session("https://example.com/one")
+        s4 = http.get_session("http://example.org/one")
+
+        assert s1 is s2
+        assert s1 is not s3
+        assert s1 is not s4
+
+    def test_02_session_after_fork(self):
+        s1 = http.get_session("http://example.com/")
+
+        # pretend that we are now in a forked child process
+        http._sessions_pid = -1
+        s2 = http.get_session("http://example.com/")
+        assert s1 is not s2
+
+        s3 = http.get_session("http://example.com/")
+        assert s2 is s3
+
+    def test_03_map_concurrent(self):
+        def fn(x):
+            if x == 3:
+                raise ValueError("three")
+            time.sleep(0.01 * (5 - x))
+            return x * 2
+
+        results = list(http.map_concurrent(fn, range(5), concurrency=3))
+        assert [r[0] for r in results] == range(5)
+        assert [r[1] for r in results] == [0, 2, 4, None, 8]
+        assert isinstance(results[3][2], ValueError)
+        assert all(r[2] is None for i, r in enumerate(results) if i != 3)
+
+    def test_04_rate_limit(self):
+        limits = app.config.get("HTTP_RATE_LIMITS", {})
+        app.config["HTTP_RATE_LIMITS"] = {"example.com" : 20}
+        try:
+            start = time.time()
+            for i in range(5):
+                http._throttle("http://example.com/")
+            http._throttle("http://example.org/")
+            elapsed = time.time() - start
+            assert elapsed >= 0.19, elapsed
+        finally:
+            app.config["HTTP_RATE_LIMITS"] = limits
+
+    def test_05_iter_chunks(self):
+        body = "abcdefghij" * 10
+
+        resp = http.MockResponse(200, body)
+        chunks = list(http._iter_chunks(resp, 0, 7, 0))
+        assert "".join(chunks) == body
+        assert max([len(c) for c in chunks]) == 7
+
+        # cut off part way through, but still return the chunk that crossed the line
+        resp = http.MockResponse(200, body)
+        chunks = list(http._iter_chunks(resp, 0, 10, 25))
+        assert "".join(chunks) == body[:30]
+
+        # exceed the size limit part way through
+        resp = http.MockResponse(200, body)
+        with self.assertRaises(http.SizeExceededException):
+            for c in http._iter_chunks(resp, 50, 10, 0):
+                pass
+
+if __name__ == '__main__':
+    unittest.main()